@@ -11,6 +11,8 @@ class HTTPStatusCodes(Enum):
     MOVED_TEMPORARILY = 302
     INTERNAL_SERVER_ERROR = 500
     REQUEST_TIMEOUT = 408
+    TOO_MANY_REQUESTS = 429
+    SERVICE_UNAVAILABLE = 503
 
 
 class WalletStatus(Enum):
@@ -23,3 +25,16 @@ class TransactionStatus(Enum):
     FAILED = "failed"
     WITHDRAWAL = "withdrawal"
     DEPOSIT = "deposit"
+    TRANSFER_IN = "transfer_in"
+    TRANSFER_OUT = "transfer_out"
+
+
+class ExportFormat(Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+class TransferOutcome(Enum):
+    CREDITED = "credited"
+    REFUNDED = "refunded"
+    PENDING = "pending"
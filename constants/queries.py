@@ -0,0 +1,474 @@
+# Raw sql used on the hot paths, run through ORMWrapper.raw_sql.
+# Parameters are postgres style ($1, $2 ...).
+
+USER_WALLET_BY_TOKEN = """
+    SELECT u.id AS user_id, u.customer_xid, u.token,
+           w.id, w.amount, w.enabled_at, w.is_enabled
+    FROM users u
+    LEFT JOIN wallet w ON w.customer_xid = u.customer_xid
+    WHERE u.token = $1
+    LIMIT 1
+"""
+
+WALLET_BY_CUSTOMER = """
+    SELECT id, amount, enabled_at, is_enabled
+    FROM wallet
+    WHERE customer_xid = $1
+    LIMIT 1
+"""
+
+# Daily summary of a wallet (wallet_daily_summary), see managers/rollups.py.
+# Transactions count by type, older withdrawals were stored without one.
+DAILY_SUMMARY_COUNTERS = (
+    "deposit_count", "deposit_sum", "withdrawal_count", "withdrawal_sum",
+    "transfer_in_count", "transfer_in_sum", "transfer_out_count", "transfer_out_sum",
+)
+DAILY_SUMMARY_COLUMNS = f"customer_xid, day, {', '.join(DAILY_SUMMARY_COUNTERS)}, closing_balance"
+DAILY_SUMMARY_TOTALS = """
+    SUM(CASE WHEN transaction_type = 'deposit' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN transaction_type = 'deposit' THEN amount ELSE 0 END),
+    SUM(CASE WHEN transaction_type IN ('deposit', 'transfer_in', 'transfer_out') THEN 0 ELSE 1 END),
+    SUM(CASE WHEN transaction_type IN ('deposit', 'transfer_in', 'transfer_out') THEN 0 ELSE amount END),
+    SUM(CASE WHEN transaction_type = 'transfer_in' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN transaction_type = 'transfer_in' THEN amount ELSE 0 END),
+    SUM(CASE WHEN transaction_type = 'transfer_out' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN transaction_type = 'transfer_out' THEN amount ELSE 0 END)
+"""
+# new transactions add to the counters of their day, a rebuilt day replaces them
+DAILY_SUMMARY_ADD = "ON CONFLICT (customer_xid, day) DO UPDATE SET " + ", ".join(
+    [f"{column} = wallet_daily_summary.{column} + excluded.{column}" for column in DAILY_SUMMARY_COUNTERS]
+    + ["closing_balance = excluded.closing_balance"]
+)
+DAILY_SUMMARY_REPLACE = "ON CONFLICT (customer_xid, day) DO UPDATE SET " + ", ".join(
+    f"{column} = excluded.{column}" for column in (*DAILY_SUMMARY_COUNTERS, "closing_balance")
+)
+# UTC day of transactions.transaction_time, per dialect
+TRANSACTION_DAY = {
+    "postgres": "(transaction_time AT TIME ZONE 'UTC')::date",
+    "sqlite": "date(transaction_time)",
+}
+
+# Rolls the rows of an `inserted` CTE into the daily summary, within the
+# statement inserting them. Those rows are all of one customer, credits or
+# a single row, so the highest final_amount is the closing balance.
+# $2: customer_xid
+ROLLUP_INSERTED = f"""
+    INSERT INTO wallet_daily_summary ({DAILY_SUMMARY_COLUMNS})
+    SELECT $2::varchar, {TRANSACTION_DAY["postgres"]}, {DAILY_SUMMARY_TOTALS}, MAX(final_amount)
+    FROM inserted
+    GROUP BY 2
+    {DAILY_SUMMARY_ADD}
+"""
+
+# Outbox events (wallet_outbox) of new ledger rows, see managers/outbox.py.
+OUTBOX_COLUMNS = """
+    transaction_id, customer_xid, transaction_type, amount, final_amount,
+    transaction_to, reference_id, transaction_time, created_at
+"""
+
+# Queues the rows of an `inserted` CTE as outbox events, within the
+# statement inserting them, appended to it as {outbox} when the outbox is on.
+# $2: customer_xid
+OUTBOX_INSERTED = f"""
+    , outbox AS (
+        INSERT INTO wallet_outbox ({OUTBOX_COLUMNS})
+        SELECT id, $2::varchar, transaction_type, amount, final_amount,
+               transaction_to, reference_id, transaction_time, CURRENT_TIMESTAMP
+        FROM inserted
+    )
+"""
+
+# Balance mutation, the conditional update, the ledger insert, the daily
+# summary (and the outbox event) run as one statement so the wallet row
+# lock is only held for that statement.
+# $1: signed balance delta, $2: customer_xid, $3: transaction amount,
+# $4: status, $5: transaction_to, $6: transaction_type, $7: reference_id
+_APPLY_BALANCE_CHANGE = f"""
+    WITH wallet_row AS (
+        UPDATE wallet SET amount = amount + $1
+        WHERE customer_xid = $2 AND is_enabled AND amount + $1 >= 0
+        RETURNING amount
+    ), inserted AS (
+        INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                                  transaction_from, transaction_to, transaction_type, reference_id)
+        SELECT $3::int, wallet_row.amount, $4::varchar, CURRENT_TIMESTAMP,
+               $2::varchar, $5::varchar, $6::varchar, $7::varchar
+        FROM wallet_row
+        RETURNING id, amount, final_amount, transaction_type, transaction_time, transaction_to, reference_id
+    ), summary AS ({ROLLUP_INSERTED}){{outbox}}
+    SELECT id, final_amount, transaction_time FROM inserted
+"""
+APPLY_BALANCE_CHANGE = _APPLY_BALANCE_CHANGE.format(outbox="")
+APPLY_BALANCE_CHANGE_OUTBOX = _APPLY_BALANCE_CHANGE.format(outbox=OUTBOX_INSERTED)
+
+# Same mutation split in two statements, for databases without data
+# modifying CTEs (sqlite). Run inside one transaction.
+UPDATE_WALLET_BALANCE = """
+    UPDATE wallet SET amount = amount + $1
+    WHERE customer_xid = $2 AND is_enabled AND amount + $1 >= 0
+    RETURNING amount
+"""
+
+# $1: amount, $2: final_amount, $3: status, $4: transaction_from,
+# $5: transaction_to, $6: transaction_type, $7: reference_id
+INSERT_TRANSACTION = """
+    INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                              transaction_from, transaction_to, transaction_type, reference_id)
+    VALUES ($1, $2, $3, CURRENT_TIMESTAMP, $4, $5, $6, $7)
+    RETURNING id, final_amount, transaction_time
+"""
+
+# Group commit of several deposits to one wallet: one balance update and one
+# bulk ledger insert. Each row gets the balance right after its own deposit.
+# $1: total of the deposits, $2: customer_xid, $3: status, $4: transaction_type,
+# $5: amounts, $6: running totals of amounts, $7: reference_ids
+_APPLY_DEPOSIT_BATCH = f"""
+    WITH wallet_row AS (
+        UPDATE wallet SET amount = amount + $1
+        WHERE customer_xid = $2 AND is_enabled
+        RETURNING amount
+    ), inserted AS (
+        INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                                  transaction_from, transaction_to, transaction_type, reference_id)
+        SELECT item.amount, wallet_row.amount - $1 + item.running, $3::varchar, CURRENT_TIMESTAMP,
+               $2::varchar, 'self', $4::varchar, item.reference_id
+        FROM wallet_row,
+             unnest($5::int[], $6::int[], $7::varchar[]) WITH ORDINALITY
+                 AS item(amount, running, reference_id, position)
+        ORDER BY item.position
+        RETURNING id, amount, final_amount, transaction_type, transaction_time, transaction_to, reference_id
+    ), summary AS ({ROLLUP_INSERTED}){{outbox}}
+    SELECT id, final_amount, transaction_time FROM inserted
+"""
+APPLY_DEPOSIT_BATCH = _APPLY_DEPOSIT_BATCH.format(outbox="")
+APPLY_DEPOSIT_BATCH_OUTBOX = _APPLY_DEPOSIT_BATCH.format(outbox=OUTBOX_INSERTED)
+
+# Locks the wallet row for a multi statement balance change (postgres
+# appends FOR UPDATE, sqlite serializes transactions anyway).
+WALLET_FOR_BALANCE_CHANGE = """
+    SELECT amount, is_enabled
+    FROM wallet
+    WHERE customer_xid = $1
+"""
+
+# reference_ids of a batch already in the ledger, run after the wallet row
+# is locked (IN_LIST filled in per dialect). $1: reference_ids
+USED_REFERENCE_IDS = """
+    SELECT reference_id FROM transactions WHERE {reference_ids}
+"""
+
+# $1: signed balance delta, $2: customer_xid
+ADD_WALLET_BALANCE = """
+    UPDATE wallet SET amount = amount + $1
+    WHERE customer_xid = $2
+    RETURNING amount
+"""
+
+# Both wallets of a transfer, always read (and locked on postgres, where
+# FOR UPDATE is appended) in customer_xid order so two opposite transfers
+# can't each hold one wallet and wait for the other.
+# $1/$2: customer_xids of the two wallets
+WALLETS_FOR_TRANSFER = """
+    SELECT customer_xid, amount, is_enabled
+    FROM wallet
+    WHERE customer_xid IN ($1, $2)
+    ORDER BY customer_xid
+"""
+
+# Moves the funds of a transfer, both wallets in one statement.
+# $1: sender customer_xid, $2: receiver customer_xid, $3: amount
+APPLY_TRANSFER_BALANCES = """
+    UPDATE wallet
+    SET amount = amount + CASE WHEN customer_xid = $1 THEN -CAST($3 AS INTEGER) ELSE CAST($3 AS INTEGER) END
+    WHERE customer_xid IN ($1, $2)
+    RETURNING customer_xid, amount
+"""
+
+# Both ledger rows of a transfer, each owned (transaction_from) by its wallet.
+# $1: amount, $2: sender balance after, $3: status, $4: sender, $5: receiver,
+# $6: outgoing type, $7: outgoing reference_id, $8: receiver balance after,
+# $9: incoming type, $10: incoming reference_id
+INSERT_TRANSFER = """
+    INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                              transaction_from, transaction_to, transaction_type, reference_id)
+    VALUES ($1, $2, $3, CURRENT_TIMESTAMP, $4, $5, $6, $7),
+           ($1, $8, $3, CURRENT_TIMESTAMP, $5, $4, $9, $10)
+    RETURNING id, transaction_from, final_amount, transaction_time
+"""
+
+# Intent of a cross shard transfer, written in the transaction of the
+# sender's debit. $1: reference_id, $2: sender, $3: receiver, $4: amount,
+# $5: lease end
+INSERT_TRANSFER_INTENT = """
+    INSERT INTO transfer_intents (reference_id, sender_xid, receiver_xid, amount, leased_until, created_at)
+    VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+"""
+
+# Intent of a credited transfer. $1: reference_id
+DELETE_TRANSFER_INTENT = """
+    DELETE FROM transfer_intents WHERE reference_id = $1
+"""
+
+# Intent of a transfer about to be refunded, only while the caller still
+# holds its lease, in the transaction of the refund.
+# $1: reference_id, $2: lease end set by the caller
+REFUND_TRANSFER_INTENT = """
+    DELETE FROM transfer_intents WHERE reference_id = $1 AND leased_until = $2
+    RETURNING id
+"""
+
+# Leases the intents whose lease ran out to the recovery sweep. Postgres
+# fills in FOR UPDATE SKIP LOCKED as {lock}.
+# $1: batch size, $2: new lease end, $3: now
+CLAIM_TRANSFER_INTENTS = """
+    UPDATE transfer_intents SET leased_until = $2
+    WHERE id IN (
+        SELECT id
+        FROM transfer_intents
+        WHERE leased_until < $3
+        ORDER BY id
+        LIMIT $1
+        {lock}
+    )
+    RETURNING reference_id, sender_xid, receiver_xid, amount
+"""
+
+# Incoming ledger row of a transfer on the receiver's shard.
+# $1: reference_id of the row, $2: receiver, $3: incoming type
+TRANSFER_CREDIT = """
+    SELECT id FROM transactions
+    WHERE reference_id = $1 AND transaction_from = $2 AND transaction_type = $3
+"""
+
+# Outcome of a transfer on the sender's shard, for a retried request.
+# $1: reference_id, $2: reference_id of the refund, $3: sender
+TRANSFER_STATE = """
+    SELECT EXISTS (SELECT 1 FROM transactions WHERE reference_id = $2 AND transaction_from = $3) AS refunded,
+           EXISTS (SELECT 1 FROM transfer_intents WHERE reference_id = $1 AND sender_xid = $3) AS pending
+"""
+
+# Keyset pagination of a wallet's history, newest first, on the
+# (transaction_from, transaction_time, id) index.
+# $1: customer_xid, $2: limit, $3/$4: transaction_time/id of the cursor
+TRANSACTION_COLUMNS = """
+    id, amount, final_amount, status, transaction_time,
+    transaction_from, transaction_to, transaction_type, reference_id
+"""
+
+TRANSACTIONS_FIRST_PAGE = f"""
+    SELECT {TRANSACTION_COLUMNS}
+    FROM transactions
+    WHERE transaction_from = $1
+    ORDER BY transaction_time DESC, id DESC
+    LIMIT $2
+"""
+
+TRANSACTIONS_PAGE_BEFORE = f"""
+    SELECT {TRANSACTION_COLUMNS}
+    FROM transactions
+    WHERE transaction_from = $1 AND (transaction_time, id) < ($3, $4)
+    ORDER BY transaction_time DESC, id DESC
+    LIMIT $2
+"""
+
+# oldest first, the caller reverses the page
+TRANSACTIONS_PAGE_AFTER = f"""
+    SELECT {TRANSACTION_COLUMNS}
+    FROM transactions
+    WHERE transaction_from = $1 AND (transaction_time, id) > ($3, $4)
+    ORDER BY transaction_time ASC, id ASC
+    LIMIT $2
+"""
+
+# Full history of a wallet, oldest first, read through a server side cursor.
+# $1: customer_xid
+TRANSACTIONS_EXPORT = f"""
+    SELECT {TRANSACTION_COLUMNS}
+    FROM transactions
+    WHERE transaction_from = $1
+    ORDER BY transaction_time ASC, id ASC
+"""
+
+# Signed effect of a transaction on the balance of transaction_from. Older
+# withdrawals were stored without a transaction_type, so anything that is
+# not a deposit or an incoming transfer takes money out.
+TRANSACTION_DELTA = "CASE WHEN transaction_type IN ('deposit', 'transfer_in') THEN amount ELSE -amount END"
+
+# Wallets with transactions in a time window.
+# $1: window start (inclusive), $2: window end (exclusive)
+WALLETS_WITH_NEW_TRANSACTIONS = """
+    SELECT DISTINCT transaction_from AS customer_xid
+    FROM transactions
+    WHERE transaction_time >= $1 AND transaction_time < $2
+"""
+
+# Keeps the snapshot job of a shard to one worker at a time, until the end
+# of the transaction of its run (postgres). $1: lock key
+SNAPSHOT_RUN_LOCK = """
+    SELECT pg_try_advisory_xact_lock($1) AS locked
+"""
+
+# Transactions before the watermark are snapshotted already.
+SNAPSHOT_WATERMARK = """
+    SELECT watermark FROM balance_snapshot_watermark WHERE id = 1
+"""
+
+# $1: new watermark
+SET_SNAPSHOT_WATERMARK = """
+    INSERT INTO balance_snapshot_watermark (id, watermark) VALUES (1, $1)
+    ON CONFLICT (id) DO UPDATE SET watermark = excluded.watermark
+"""
+
+# Checkpoints the balance of a wallet after every $3-th transaction since its
+# latest snapshot, from a running sum over the new rows only.
+# $1: customer_xid, $2: only rows older than this (settled), $3: snapshot interval in rows
+TAKE_BALANCE_SNAPSHOTS = f"""
+    WITH latest AS (
+        SELECT transaction_time, transaction_id, balance
+        FROM balance_snapshots
+        WHERE customer_xid = $1
+        ORDER BY transaction_time DESC, transaction_id DESC
+        LIMIT 1
+    ), fresh AS (
+        SELECT id, transaction_time,
+               SUM({TRANSACTION_DELTA}) OVER (ORDER BY transaction_time, id) AS running,
+               ROW_NUMBER() OVER (ORDER BY transaction_time, id) AS position
+        FROM transactions
+        WHERE transaction_from = $1 AND transaction_time < $2
+          AND (NOT EXISTS (SELECT 1 FROM latest)
+               OR (transaction_time, id) > (SELECT transaction_time, transaction_id FROM latest))
+    )
+    INSERT INTO balance_snapshots (customer_xid, transaction_time, transaction_id, balance)
+    SELECT $1, fresh.transaction_time, fresh.id,
+           COALESCE((SELECT balance FROM latest), 0) + fresh.running
+    FROM fresh
+    WHERE fresh.position % $3 = 0
+    ON CONFLICT DO NOTHING
+"""
+
+# Balance of a wallet at a point in time: the nearest snapshot at or before
+# it plus the transactions between the two, one bounded index range scan.
+# $1: customer_xid, $2: point in time
+BALANCE_AS_OF = f"""
+    WITH latest AS (
+        SELECT transaction_time, transaction_id, balance
+        FROM balance_snapshots
+        WHERE customer_xid = $1 AND transaction_time <= $2
+        ORDER BY transaction_time DESC, transaction_id DESC
+        LIMIT 1
+    )
+    SELECT (SELECT balance FROM latest) AS snapshot_balance,
+           (SELECT transaction_time FROM latest) AS snapshot_time,
+           COALESCE(SUM({TRANSACTION_DELTA}), 0) AS balance_change,
+           COUNT(id) AS replayed_transactions
+    FROM transactions
+    WHERE transaction_from = $1 AND transaction_time <= $2
+      AND (NOT EXISTS (SELECT 1 FROM latest)
+           OR (transaction_time, id) > (SELECT transaction_time, transaction_id FROM latest))
+"""
+
+# Copy of a customer's ledger to another shard (tools/rebalance.py), in the
+# order of the source so new ids keep the (transaction_time, id) order.
+# $1 .. $8: arrays of amount, final_amount, status, transaction_time,
+# transaction_from, transaction_to, transaction_type, reference_id
+COPY_TRANSACTIONS = """
+    INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                              transaction_from, transaction_to, transaction_type, reference_id)
+    SELECT item.amount, item.final_amount, item.status, item.transaction_time,
+           item.transaction_from, item.transaction_to, item.transaction_type, item.reference_id
+    FROM unnest($1::int[], $2::int[], $3::varchar[], $4::timestamptz[],
+                $5::varchar[], $6::varchar[], $7::varchar[], $8::varchar[]) WITH ORDINALITY
+             AS item(amount, final_amount, status, transaction_time,
+                     transaction_from, transaction_to, transaction_type, reference_id, position)
+    ORDER BY item.position
+"""
+
+# Same copy one row at a time, for databases without arrays (sqlite).
+COPY_TRANSACTION = """
+    INSERT INTO transactions (amount, final_amount, status, transaction_time,
+                              transaction_from, transaction_to, transaction_type, reference_id)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+"""
+
+# Adds transactions rolled up in python to the daily summary, for the
+# paths that insert the ledger rows in a transaction of their own.
+# $1: customer_xid, $2: day, $3 .. $10: DAILY_SUMMARY_COUNTERS, $11: closing balance
+ADD_DAILY_SUMMARY = f"""
+    INSERT INTO wallet_daily_summary ({DAILY_SUMMARY_COLUMNS})
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    {DAILY_SUMMARY_ADD}
+"""
+
+# Rebuilds the daily summary of a wallet from its transactions, the day
+# expression is filled in per dialect (TRANSACTION_DAY).
+# $1: customer_xid, $2: first day left as is
+BACKFILL_DAILY_SUMMARY = f"""
+    INSERT INTO wallet_daily_summary ({DAILY_SUMMARY_COLUMNS})
+    SELECT transaction_from, day, {DAILY_SUMMARY_TOTALS},
+           MAX(CASE WHEN position = 1 THEN final_amount END)
+    FROM (
+        SELECT transaction_from, {{day}} AS day, transaction_type, amount, final_amount,
+               ROW_NUMBER() OVER (PARTITION BY {{day}} ORDER BY transaction_time DESC, id DESC) AS position
+        FROM transactions
+        WHERE transaction_from = $1
+    ) AS daily
+    WHERE day < $2
+    GROUP BY transaction_from, day
+    {DAILY_SUMMARY_REPLACE}
+"""
+
+# Daily summary of a wallet over a range of days, oldest first.
+# $1: customer_xid, $2: first day, $3: last day (inclusive)
+DAILY_SUMMARY_RANGE = f"""
+    SELECT id, {DAILY_SUMMARY_COLUMNS}
+    FROM wallet_daily_summary
+    WHERE customer_xid = $1 AND day >= $2 AND day <= $3
+    ORDER BY day
+"""
+
+# Matches a column against a list passed as one parameter, per dialect
+# (sqlite gets the list as a json array).
+IN_LIST = {
+    "postgres": "{column} = ANY($1)",
+    "sqlite": "{column} IN (SELECT value FROM json_each($1))",
+}
+
+# Queues ledger rows inserted by the other statements of the transaction
+# as outbox events, by reference_id (IN_LIST filled in per dialect).
+# $1: reference_ids
+OUTBOX_FROM_TRANSACTIONS = f"""
+    INSERT INTO wallet_outbox ({OUTBOX_COLUMNS})
+    SELECT id, transaction_from, transaction_type, amount, final_amount,
+           transaction_to, reference_id, transaction_time, CURRENT_TIMESTAMP
+    FROM transactions
+    WHERE {{reference_ids}}
+    ORDER BY id
+"""
+
+# Leases the oldest outbox events not leased by another publisher, in one
+# statement, so no transaction stays open while they are sent. Postgres
+# fills in FOR UPDATE SKIP LOCKED as {lock}, sqlite serializes writes.
+# $1: batch size, $2: lease end, $3: now
+OUTBOX_CLAIM = f"""
+    UPDATE wallet_outbox SET leased_until = $2
+    WHERE id IN (
+        SELECT id
+        FROM wallet_outbox
+        WHERE leased_until IS NULL OR leased_until < $3
+        ORDER BY id
+        LIMIT $1
+        {{lock}}
+    )
+    RETURNING id, {OUTBOX_COLUMNS}
+"""
+
+# Events delivered, by id (IN_LIST filled in per dialect). $1: ids
+OUTBOX_DELETE = """
+    DELETE FROM wallet_outbox WHERE {ids}
+"""
+
+# Hands events the sink refused back to the next claim, by id (IN_LIST
+# filled in per dialect). $1: ids
+OUTBOX_RELEASE = """
+    UPDATE wallet_outbox SET leased_until = NULL WHERE {ids}
+"""
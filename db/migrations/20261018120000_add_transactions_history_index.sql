@@ -0,0 +1,10 @@
+-- migrate:up transaction:false
+
+-- Index for the keyset paginated transaction history of a wallet,
+-- built concurrently so the transactions table stays writable.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_from_time_id_idx
+    ON transactions (transaction_from, transaction_time DESC, id DESC);
+
+-- migrate:down transaction:false
+
+DROP INDEX CONCURRENTLY IF EXISTS transactions_from_time_id_idx;
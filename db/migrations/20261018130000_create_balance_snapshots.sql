@@ -0,0 +1,24 @@
+-- migrate:up transaction:false
+
+-- Periodic per wallet balance checkpoints, see managers/snapshots.py
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    id SERIAL PRIMARY KEY,
+    customer_xid VARCHAR(50) NOT NULL,
+    transaction_time TIMESTAMPTZ NOT NULL,
+    transaction_id INT NOT NULL,
+    balance INT NOT NULL,
+    UNIQUE (customer_xid, transaction_id)
+);
+
+CREATE INDEX IF NOT EXISTS balance_snapshots_customer_time_idx
+    ON balance_snapshots (customer_xid, transaction_time DESC, transaction_id DESC);
+
+-- Wallets with transactions in a time window, for the snapshot job,
+-- built concurrently so the transactions table stays writable.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS transactions_time_idx
+    ON transactions (transaction_time);
+
+-- migrate:down transaction:false
+
+DROP INDEX CONCURRENTLY IF EXISTS transactions_time_idx;
+DROP TABLE IF EXISTS balance_snapshots;
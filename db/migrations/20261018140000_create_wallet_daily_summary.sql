@@ -0,0 +1,24 @@
+-- migrate:up
+
+-- Per customer per (UTC) day totals, written with every transaction,
+-- see managers/rollups.py. Filled for older days by
+-- python -m tools.backfill_summaries
+CREATE TABLE IF NOT EXISTS wallet_daily_summary (
+    id SERIAL PRIMARY KEY,
+    customer_xid VARCHAR(50) NOT NULL,
+    day DATE NOT NULL,
+    deposit_count INT NOT NULL DEFAULT 0,
+    deposit_sum BIGINT NOT NULL DEFAULT 0,
+    withdrawal_count INT NOT NULL DEFAULT 0,
+    withdrawal_sum BIGINT NOT NULL DEFAULT 0,
+    transfer_in_count INT NOT NULL DEFAULT 0,
+    transfer_in_sum BIGINT NOT NULL DEFAULT 0,
+    transfer_out_count INT NOT NULL DEFAULT 0,
+    transfer_out_sum BIGINT NOT NULL DEFAULT 0,
+    closing_balance INT NOT NULL,
+    UNIQUE (customer_xid, day)
+);
+
+-- migrate:down
+
+DROP TABLE IF EXISTS wallet_daily_summary;
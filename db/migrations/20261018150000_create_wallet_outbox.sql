@@ -0,0 +1,22 @@
+-- migrate:up
+
+-- Transactional outbox: one row per ledger row, inserted in the same
+-- transaction, deleted once published, see managers/outbox.py
+CREATE TABLE IF NOT EXISTS wallet_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_id INT NOT NULL,
+    customer_xid VARCHAR(50) NOT NULL,
+    transaction_type VARCHAR(50) NOT NULL,
+    amount INT NOT NULL,
+    final_amount INT NOT NULL,
+    transaction_to VARCHAR(50) NOT NULL,
+    reference_id VARCHAR(50) NOT NULL,
+    transaction_time TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- set while a publisher sends the event
+    leased_until TIMESTAMPTZ
+);
+
+-- migrate:down
+
+DROP TABLE IF EXISTS wallet_outbox;
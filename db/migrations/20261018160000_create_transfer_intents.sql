@@ -0,0 +1,19 @@
+-- migrate:up
+
+-- Cross shard transfers debited but not yet credited or refunded, one row
+-- on the sender's shard, inserted with the debit and deleted once settled,
+-- see managers/transfers.py
+CREATE TABLE IF NOT EXISTS transfer_intents (
+    id BIGSERIAL PRIMARY KEY,
+    reference_id VARCHAR(50) NOT NULL UNIQUE,
+    sender_xid VARCHAR(50) NOT NULL,
+    receiver_xid VARCHAR(50) NOT NULL,
+    amount INT NOT NULL,
+    -- the worker settling the transfer owns it until then
+    leased_until TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- migrate:down
+
+DROP TABLE IF EXISTS transfer_intents;
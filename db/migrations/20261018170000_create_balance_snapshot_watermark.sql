@@ -0,0 +1,12 @@
+-- migrate:up
+
+-- Where the snapshot job of the shard got to, one row, see
+-- managers/snapshots.py
+CREATE TABLE IF NOT EXISTS balance_snapshot_watermark (
+    id SMALLINT PRIMARY KEY,
+    watermark TIMESTAMPTZ NOT NULL
+);
+
+-- migrate:down
+
+DROP TABLE IF EXISTS balance_snapshot_watermark;
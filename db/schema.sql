@@ -13,6 +13,49 @@ SET default_tablespace = '';
 
 SET default_table_access_method = heap;
 
+--
+-- Name: balance_snapshot_watermark; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.balance_snapshot_watermark (
+    id smallint NOT NULL,
+    watermark timestamp with time zone NOT NULL
+);
+
+
+--
+-- Name: balance_snapshots; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.balance_snapshots (
+    id integer NOT NULL,
+    customer_xid character varying(50) NOT NULL,
+    transaction_time timestamp with time zone NOT NULL,
+    transaction_id integer NOT NULL,
+    balance integer NOT NULL
+);
+
+
+--
+-- Name: balance_snapshots_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.balance_snapshots_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: balance_snapshots_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.balance_snapshots_id_seq OWNED BY public.balance_snapshots.id;
+
+
 --
 -- Name: schema_migrations; Type: TABLE; Schema: public; Owner: -
 --
@@ -59,6 +102,40 @@ CREATE SEQUENCE public.transactions_id_seq
 ALTER SEQUENCE public.transactions_id_seq OWNED BY public.transactions.id;
 
 
+--
+-- Name: transfer_intents; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.transfer_intents (
+    id bigint NOT NULL,
+    reference_id character varying(50) NOT NULL,
+    sender_xid character varying(50) NOT NULL,
+    receiver_xid character varying(50) NOT NULL,
+    amount integer NOT NULL,
+    leased_until timestamp with time zone NOT NULL,
+    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+
+--
+-- Name: transfer_intents_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.transfer_intents_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: transfer_intents_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.transfer_intents_id_seq OWNED BY public.transfer_intents.id;
+
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: -
 --
@@ -123,6 +200,91 @@ CREATE SEQUENCE public.wallet_id_seq
 ALTER SEQUENCE public.wallet_id_seq OWNED BY public.wallet.id;
 
 
+--
+-- Name: wallet_daily_summary; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.wallet_daily_summary (
+    id integer NOT NULL,
+    customer_xid character varying(50) NOT NULL,
+    day date NOT NULL,
+    deposit_count integer DEFAULT 0 NOT NULL,
+    deposit_sum bigint DEFAULT 0 NOT NULL,
+    withdrawal_count integer DEFAULT 0 NOT NULL,
+    withdrawal_sum bigint DEFAULT 0 NOT NULL,
+    transfer_in_count integer DEFAULT 0 NOT NULL,
+    transfer_in_sum bigint DEFAULT 0 NOT NULL,
+    transfer_out_count integer DEFAULT 0 NOT NULL,
+    transfer_out_sum bigint DEFAULT 0 NOT NULL,
+    closing_balance integer NOT NULL
+);
+
+
+--
+-- Name: wallet_daily_summary_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.wallet_daily_summary_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: wallet_daily_summary_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.wallet_daily_summary_id_seq OWNED BY public.wallet_daily_summary.id;
+
+
+--
+-- Name: wallet_outbox; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.wallet_outbox (
+    id bigint NOT NULL,
+    transaction_id integer NOT NULL,
+    customer_xid character varying(50) NOT NULL,
+    transaction_type character varying(50) NOT NULL,
+    amount integer NOT NULL,
+    final_amount integer NOT NULL,
+    transaction_to character varying(50) NOT NULL,
+    reference_id character varying(50) NOT NULL,
+    transaction_time timestamp with time zone NOT NULL,
+    created_at timestamp with time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    leased_until timestamp with time zone
+);
+
+
+--
+-- Name: wallet_outbox_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.wallet_outbox_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: wallet_outbox_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.wallet_outbox_id_seq OWNED BY public.wallet_outbox.id;
+
+
+--
+-- Name: balance_snapshots id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.balance_snapshots ALTER COLUMN id SET DEFAULT nextval('public.balance_snapshots_id_seq'::regclass);
+
+
 --
 -- Name: transactions id; Type: DEFAULT; Schema: public; Owner: -
 --
@@ -130,6 +292,13 @@ ALTER SEQUENCE public.wallet_id_seq OWNED BY public.wallet.id;
 ALTER TABLE ONLY public.transactions ALTER COLUMN id SET DEFAULT nextval('public.transactions_id_seq'::regclass);
 
 
+--
+-- Name: transfer_intents id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.transfer_intents ALTER COLUMN id SET DEFAULT nextval('public.transfer_intents_id_seq'::regclass);
+
+
 --
 -- Name: users id; Type: DEFAULT; Schema: public; Owner: -
 --
@@ -144,6 +313,44 @@ ALTER TABLE ONLY public.users ALTER COLUMN id SET DEFAULT nextval('public.users_
 ALTER TABLE ONLY public.wallet ALTER COLUMN id SET DEFAULT nextval('public.wallet_id_seq'::regclass);
 
 
+--
+-- Name: wallet_daily_summary id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_daily_summary ALTER COLUMN id SET DEFAULT nextval('public.wallet_daily_summary_id_seq'::regclass);
+
+
+--
+-- Name: wallet_outbox id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_outbox ALTER COLUMN id SET DEFAULT nextval('public.wallet_outbox_id_seq'::regclass);
+
+
+--
+-- Name: balance_snapshot_watermark balance_snapshot_watermark_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.balance_snapshot_watermark
+    ADD CONSTRAINT balance_snapshot_watermark_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: balance_snapshots balance_snapshots_customer_xid_transaction_id_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.balance_snapshots
+    ADD CONSTRAINT balance_snapshots_customer_xid_transaction_id_key UNIQUE (customer_xid, transaction_id);
+
+
+--
+-- Name: balance_snapshots balance_snapshots_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.balance_snapshots
+    ADD CONSTRAINT balance_snapshots_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -160,6 +367,22 @@ ALTER TABLE ONLY public.transactions
     ADD CONSTRAINT transactions_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: transfer_intents transfer_intents_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.transfer_intents
+    ADD CONSTRAINT transfer_intents_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: transfer_intents transfer_intents_reference_id_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.transfer_intents
+    ADD CONSTRAINT transfer_intents_reference_id_key UNIQUE (reference_id);
+
+
 --
 -- Name: users users_customer_xid_key; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -192,6 +415,51 @@ ALTER TABLE ONLY public.wallet
     ADD CONSTRAINT wallet_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: wallet_daily_summary wallet_daily_summary_customer_xid_day_key; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_daily_summary
+    ADD CONSTRAINT wallet_daily_summary_customer_xid_day_key UNIQUE (customer_xid, day);
+
+
+--
+-- Name: wallet_daily_summary wallet_daily_summary_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_daily_summary
+    ADD CONSTRAINT wallet_daily_summary_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: wallet_outbox wallet_outbox_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.wallet_outbox
+    ADD CONSTRAINT wallet_outbox_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: balance_snapshots_customer_time_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX balance_snapshots_customer_time_idx ON public.balance_snapshots USING btree (customer_xid, transaction_time DESC, transaction_id DESC);
+
+
+--
+-- Name: transactions_from_time_id_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX transactions_from_time_id_idx ON public.transactions USING btree (transaction_from, transaction_time DESC, id DESC);
+
+
+--
+-- Name: transactions_time_idx; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX transactions_time_idx ON public.transactions USING btree (transaction_time);
+
+
 --
 -- Name: wallet wallet_customer_xid_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
@@ -210,4 +478,10 @@ ALTER TABLE ONLY public.wallet
 --
 
 INSERT INTO public.schema_migrations (version) VALUES
-    ('20230807172023');
+    ('20230807172023'),
+    ('20261018120000'),
+    ('20261018130000'),
+    ('20261018140000'),
+    ('20261018150000'),
+    ('20261018160000'),
+    ('20261018170000');
@@ -0,0 +1,215 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from enum import Enum
+
+from constants.enums import HTTPStatusCodes
+from managers.cache import MISSING, user_token_cache
+
+
+class AdmissionConstant(Enum):
+    RATE_PER_S = 50  # sustained requests per second per client
+    BURST = 100  # requests a client may send at once
+    MAX_IN_FLIGHT = 40  # concurrent db bound requests per worker
+    MAX_QUEUE = 200  # requests waiting for an in-flight slot
+    QUEUE_TIMEOUT_MS = 500
+    MAX_BUCKETS = 100000  # least recently seen clients are forgotten past this
+    # routes that never touch the database, the smoke load only waits
+    # for its own requests, which are admitted one by one
+    EXEMPT_ROUTES = ("/", "/metrics", "/api/v1/smoke_load")
+
+
+class AdmissionRejected(Exception):
+    """
+        Raised when a request is refused, status_code is the http status
+        to answer it with, retry_after the seconds a client should wait.
+    """
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+
+
+class AdmissionTicket:
+    """
+        In-flight slot of one admitted request, released once, whichever
+        of the response middleware or the connection close gets there
+        first.
+    """
+    __slots__ = ("_controller", "released")
+
+    def __init__(self, controller):
+        self._controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._controller._release_slot()
+
+
+def admission_key(request):
+    """
+        Client a request counts against: the user of its Authorization
+        token once the token resolved through user_token_cache, the client
+        ip otherwise. Made up tokens thus share the bucket of their ip
+        instead of getting a fresh one each.
+    """
+    auth_token = request.headers.get("Authorization")
+    if auth_token:
+        # "Token <token>", see parse_auth_token
+        scheme, _, token = auth_token.partition(" ")
+        user_details = user_token_cache.peek(token) if scheme == "Token" else MISSING
+        if user_details is not MISSING and user_details:
+            return f"user:{user_details['customer_xid']}"
+    return f"ip:{request.ip}"
+
+
+class AdmissionController:
+    """
+        Admission control in front of the db bound routes of a worker.
+        Every known user (client ip for anything else, see admission_key)
+        has a token bucket refilled at RATE_PER_S up to BURST, a request
+        finding it empty is answered 429 straight away.
+        Past the bucket, at most MAX_IN_FLIGHT requests run at once, the
+        next ones wait first in first out in a queue of MAX_QUEUE. A full
+        queue is answered 503 and a request still queued after
+        QUEUE_TIMEOUT_MS is answered 408, so a spike is shed at the door
+        instead of piling up on the database pool and slowing down the
+        requests already admitted.
+        It is not thread safe, it is meant for the event loop of a single
+        sanic worker, limits are per worker.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.rate = AdmissionConstant.RATE_PER_S.value
+        self.burst = AdmissionConstant.BURST.value
+        self.max_in_flight = AdmissionConstant.MAX_IN_FLIGHT.value
+        self.max_queue = AdmissionConstant.MAX_QUEUE.value
+        self.queue_timeout = AdmissionConstant.QUEUE_TIMEOUT_MS.value / 1000
+        self.max_buckets = AdmissionConstant.MAX_BUCKETS.value
+        self._buckets = OrderedDict()
+        self._waiters = deque()
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def configure(self, enabled=False, rate_per_s=AdmissionConstant.RATE_PER_S.value,
+                  burst=AdmissionConstant.BURST.value, max_in_flight=AdmissionConstant.MAX_IN_FLIGHT.value,
+                  max_queue=AdmissionConstant.MAX_QUEUE.value,
+                  queue_timeout_ms=AdmissionConstant.QUEUE_TIMEOUT_MS.value,
+                  max_buckets=AdmissionConstant.MAX_BUCKETS.value):
+        self.enabled = enabled
+        self.rate = rate_per_s
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.max_buckets = max_buckets
+
+    def exempt(self, route: str):
+        return route in AdmissionConstant.EXEMPT_ROUTES.value
+
+    async def admit(self, key: str):
+        """
+            :param key: client the request counts against, see
+            admission_key
+            :return: AdmissionTicket to release once the request is done
+            :raises AdmissionRejected: 429 out of tokens, 503 queue full,
+            408 queued past QUEUE_TIMEOUT_MS
+        """
+        self._take_token(key)
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+        else:
+            await self._wait_for_slot()
+        self.admitted += 1
+        return AdmissionTicket(self)
+
+    def _take_token(self, key):
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+
+        if bucket.tokens < 1:
+            self.rate_limited += 1
+            raise AdmissionRejected("Too many requests, slow down!", HTTPStatusCodes.TOO_MANY_REQUESTS.value,
+                                    math.ceil((1 - bucket.tokens) / self.rate))
+        bucket.tokens -= 1
+
+    async def _wait_for_slot(self):
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            raise AdmissionRejected("Server is busy, retry later!", HTTPStatusCodes.SERVICE_UNAVAILABLE.value,
+                                    math.ceil(self.queue_timeout))
+
+        self.queued += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # _release_slot hands its slot over by resolving the waiter
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._forget(waiter)
+            self.timed_out += 1
+            raise AdmissionRejected("Request timed out waiting to be served!",
+                                    HTTPStatusCodes.REQUEST_TIMEOUT.value, math.ceil(self.queue_timeout))
+        except asyncio.CancelledError:
+            # client went away, pass on the slot if it was handed over already
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            else:
+                self._forget(waiter)
+            raise
+
+    def _forget(self, waiter):
+        # a release may have popped (and skipped) the cancelled waiter already
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+    def _release_slot(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": len(self._waiters),
+            "max_queue": self.max_queue,
+            "buckets": len(self._buckets),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+        }
+
+
+admission_controller = AdmissionController()
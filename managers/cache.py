@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+from enum import Enum
+
+
+class CacheConstant(Enum):
+    MAX_SIZE = 10000
+    TTL = 300  # seconds
+    NEGATIVE_TTL = 5  # seconds
+
+
+# returned by TTLCache.get when nothing (not even a negative entry) is cached
+MISSING = object()
+
+
+class TTLCache:
+    """
+        Bounded in-process LRU cache where every entry also expires after
+        a ttl. A value of None is treated as a negative lookup and is kept
+        for the (shorter) negative ttl only.
+        It is not thread safe, it is meant to be shared by the coroutines
+        of a single event loop (one sanic worker).
+    """
+
+    def __init__(
+            self,
+            max_size=CacheConstant.MAX_SIZE.value,
+            ttl=CacheConstant.TTL.value,
+            negative_ttl=CacheConstant.NEGATIVE_TTL.value,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+            :param key: cache key
+            :return: cached value (None for a negative entry) or MISSING
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if value is None:
+            self.negative_hits += 1
+        return value
+
+    def peek(self, key):
+        """
+            get() that leaves the counters and the lru order alone.
+            :return: cached value (None for a negative entry) or MISSING
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return MISSING
+        return entry[0]
+
+    def set(self, key, value):
+        """
+            :param key: cache key
+            :param value: value to cache, None caches a negative lookup
+        """
+        ttl = self.negative_ttl if value is None else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "evictions": self.evictions,
+        }
+
+
+# token -> user details, shared by every handler of the worker
+user_token_cache = TTLCache()
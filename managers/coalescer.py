@@ -0,0 +1,111 @@
+import asyncio
+from enum import Enum
+
+from constants.enums import TransactionStatus
+from managers.ledger import apply_balance_change, apply_deposit_batch
+
+
+class CoalescerConstant(Enum):
+    WINDOW_MS = 5
+    MAX_BATCH = 200
+
+
+class DepositCoalescer:
+    """
+        Opt-in group commit for deposits. Concurrent deposits to the same
+        wallet are collected for a short window and written as one balance
+        update plus one bulk ledger insert, every waiting request is then
+        resolved with its own transaction row.
+        When disabled every deposit goes straight to apply_balance_change.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = CoalescerConstant.WINDOW_MS.value / 1000
+        self.max_batch = CoalescerConstant.MAX_BATCH.value
+        self._batches = {}
+        self._flush_tasks = set()
+        self.batches_flushed = 0
+        self.deposits_coalesced = 0
+        self.batch_fallbacks = 0
+
+    def configure(self, enabled=False, window_ms=CoalescerConstant.WINDOW_MS.value,
+                  max_batch=CoalescerConstant.MAX_BATCH.value):
+        self.enabled = enabled
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+
+    async def deposit(self, customer_xid: str, amount: int, reference_id: str):
+        """
+            :param customer_xid: owner of the wallet
+            :param amount: positive amount to deposit
+            :param reference_id: unique id of the transaction
+            :return: dict with id, final_amount and transaction_time
+        """
+        if not self.enabled:
+            return await apply_balance_change(customer_xid, amount, TransactionStatus.DEPOSIT.value, reference_id)
+
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(customer_xid)
+        if batch is None:
+            batch = self._batches[customer_xid] = []
+            loop.call_later(self.window, self._start_flush, customer_xid, batch)
+
+        future = loop.create_future()
+        batch.append((amount, reference_id, future))
+        if len(batch) >= self.max_batch:
+            self._start_flush(customer_xid, batch)
+        return await future
+
+    def _start_flush(self, customer_xid, batch):
+        # both the window timer and the size limit may fire for one batch
+        if self._batches.get(customer_xid) is not batch:
+            return
+        del self._batches[customer_xid]
+        task = asyncio.ensure_future(self._flush(customer_xid, batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, customer_xid, batch):
+        self.batches_flushed += 1
+        if len(batch) > 1:
+            try:
+                rows = await apply_deposit_batch(customer_xid, [
+                    (amount, reference_id) for amount, reference_id, _ in batch
+                ])
+            except Exception:
+                rows = None
+
+            if rows is not None:
+                self.deposits_coalesced += len(batch)
+                for (_, _, future), row in zip(batch, rows):
+                    if not future.done():
+                        future.set_result(row)
+                return
+            self.batch_fallbacks += 1
+
+        # a single bad deposit fails the whole batch statement, so redo them
+        # one by one and give every request its own outcome
+        for amount, reference_id, future in batch:
+            try:
+                row = await apply_balance_change(
+                    customer_xid, amount, TransactionStatus.DEPOSIT.value, reference_id
+                )
+            except Exception as ex:
+                if not future.done():
+                    future.set_exception(ex)
+            else:
+                if not future.done():
+                    future.set_result(row)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending_wallets": len(self._batches),
+            "batches_flushed": self.batches_flushed,
+            "deposits_coalesced": self.deposits_coalesced,
+            "batch_fallbacks": self.batch_fallbacks,
+        }
+
+
+deposit_coalescer = DepositCoalescer()
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from enum import Enum
+
+from sanic.log import logger
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.connection import connections
+from tortoise.utils import get_schema_sql
+
+from managers.replicas import ReplicaConstant
+from managers.shards import shard_map, ShardConstant
+
+
+class DatabaseConstant(Enum):
+    # dev default, production schemas are owned by the dbmate migrations
+    GENERATE_SCHEMAS = True
+    WARM_POOL = False
+    # asyncpg pool settings, config key -> asyncpg/tortoise credential
+    POOL_SETTINGS = {
+        "MIN_SIZE": ("minsize", int),
+        "MAX_SIZE": ("maxsize", int),
+        "STATEMENT_CACHE_SIZE": ("statement_cache_size", int),
+        "MAX_INACTIVE_CONNECTION_LIFETIME": ("max_inactive_connection_lifetime", float),
+        "MAX_QUERIES": ("max_queries", int),
+    }
+    POOLED_ENGINES = ("tortoise.backends.asyncpg",)
+
+
+def build_tortoise_config(db_url: str, pool: dict = None, replica_urls=(), shards=()):
+    """
+        Tortoise config for db_url, the further shards and the read
+        replicas of each, with the pool settings of config.json applied
+        to pooled (postgres) connections.
+
+        :param db_url: database url of shard 0, as given to register_tortoise
+        :param pool: "POOL" section of the database config, keys of
+        DatabaseConstant.POOL_SETTINGS
+        :param replica_urls: urls of the read replicas of db_url, they
+        become the connections replica_0, replica_1 ... (see ReplicaRouter)
+        :param shards: further shards (see ShardMap), list of {"URL",
+        "REPLICA_URLS"}, they become the connections shard_1, shard_2 ...
+        and their replicas shard_1_replica_0 ...
+        :return: tortoise config dict
+    """
+    connections_config = {}
+    for primary, url, replicas in _databases(db_url, replica_urls, shards):
+        connections_config[primary] = _connection_config(url, pool)
+        for replica, replica_url in replicas:
+            connections_config[replica] = _connection_config(replica_url, pool)
+    return {
+        "connections": connections_config,
+        "apps": {"models": {"models": ["models"], "default_connection": ReplicaConstant.PRIMARY.value}},
+    }
+
+
+def database_topology(replica_urls=(), shards=()):
+    """
+        Connection names laid out by build_tortoise_config for the same
+        arguments.
+        :return: {shard primary connection name: replica connection names},
+        in shard order
+    """
+    return {
+        primary: [replica for replica, _ in replicas]
+        for primary, _, replicas in _databases(None, replica_urls, shards)
+    }
+
+
+def _databases(db_url, replica_urls, shards):
+    """
+        :return: list of (primary connection name, url, [(replica connection
+        name, url)]) per shard
+    """
+    databases = [{"URL": db_url, "REPLICA_URLS": replica_urls}, *shards]
+    layout = []
+    for number, database in enumerate(databases):
+        primary = ReplicaConstant.PRIMARY.value if number == 0 else f"{ShardConstant.CONNECTION_PREFIX.value}{number}"
+        replica_prefix = ReplicaConstant.CONNECTION_PREFIX.value
+        if number:
+            replica_prefix = f"{primary}_{replica_prefix}"
+        layout.append((primary, database["URL"], [
+            (f"{replica_prefix}{index}", replica_url)
+            for index, replica_url in enumerate(database.get("REPLICA_URLS", []))
+        ]))
+    return layout
+
+
+def _connection_config(db_url, pool):
+    connection = expand_db_url(db_url)
+    if pool and connection["engine"] in DatabaseConstant.POOLED_ENGINES.value:
+        for key, (credential, cast) in DatabaseConstant.POOL_SETTINGS.value.items():
+            if key in pool:
+                connection["credentials"][credential] = cast(pool[key])
+    return connection
+
+
+async def generate_primary_schema():
+    """
+        Creates the missing tables on the primary of every shard.
+        Tortoise's own generate_schemas would run on the default
+        connection only, the one the models are bound to.
+    """
+    schema = get_schema_sql(connections.get(shard_map.shards[0]), safe=True)
+    for shard in shard_map.shards:
+        client = connections.get(shard)
+        await client.schema_generator(client).generate_from_string(schema)
+
+
+async def warm_pools():
+    """
+        Opens the pool of every tortoise connection before traffic comes
+        in, tortoise would otherwise create it on the first query (once
+        per concurrent first query) and every pooled connection would
+        pay its connect and auth round trips on a live request.
+    """
+    for client in connections.all():
+        # the first query creates the pool with its minimum of connections
+        await client.execute_query("SELECT 1")
+        min_size = getattr(client, "pool_minsize", 1)
+        if min_size > 1:
+            await asyncio.gather(*[client.execute_query("SELECT 1") for _ in range(min_size)])
+
+
+class StartupTimer:
+    """
+        Seconds from the start of the boot to each boot phase of this
+        worker, logged once the worker serves its first request.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        if phase not in self.phases:
+            self.phases[phase] = round(time.perf_counter() - self.started_at, 4)
+
+    def first_request(self):
+        if "first_request" in self.phases:
+            return
+        self.mark("first_request")
+        logger.info("worker startup timing (seconds) %s", self.phases)
+
+    def stats(self):
+        return dict(self.phases)
+
+
+startup_timer = StartupTimer()
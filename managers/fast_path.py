@@ -0,0 +1,70 @@
+from enum import Enum
+
+from tortoise.exceptions import IntegrityError, OperationalError
+
+try:
+    import asyncpg
+except ImportError:  # sqlite only setups
+    asyncpg = None
+
+
+class FastPathConstant(Enum):
+    DIALECT = "postgres"
+
+
+class PreparedStatements:
+    """
+        Fast path of the hot queries (token auth, wallet fetch, balance
+        changes, transaction pages) on postgres. The query runs straight
+        on the asyncpg connection tortoise hands out, whose statement
+        cache (POOL.STATEMENT_CACHE_SIZE) keeps it prepared per
+        connection, and the asyncpg records are returned as is (they are
+        read like dicts). Tortoise's query wrappers and the record to
+        dict copy are skipped.
+        Errors are translated to the tortoise exceptions the handlers
+        expect. Off, or on any other database, ORMWrapper.prepared_sql
+        falls back to raw_sql.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.executions = 0
+        self.failures = 0
+
+    def configure(self, enabled=False):
+        self.enabled = enabled and asyncpg is not None
+
+    def active(self, client):
+        """
+            :param client: tortoise connection (or transaction) to run on
+        """
+        return self.enabled and client.capabilities.dialect == FastPathConstant.DIALECT.value
+
+    async def fetch(self, client, query: str, values):
+        """
+            :param client: tortoise connection (or transaction) to run on
+            :param query: sql with $1, $2 ... parameters
+            :param values: list of parameter values
+            :return: list of asyncpg records
+        """
+        async with client.acquire_connection() as connection:
+            try:
+                rows = await connection.fetch(query, *(values or []))
+            except asyncpg.IntegrityConstraintViolationError as ex:
+                self.failures += 1
+                raise IntegrityError(ex)
+            except (asyncpg.PostgresError, asyncpg.InterfaceError) as ex:
+                self.failures += 1
+                raise OperationalError(ex)
+        self.executions += 1
+        return rows
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "executions": self.executions,
+            "failures": self.failures,
+        }
+
+
+prepared_statements = PreparedStatements()
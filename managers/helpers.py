@@ -1,15 +1,28 @@
-from datetime import datetime, date
+import csv
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from enum import Enum
 from functools import wraps
-from uuid import UUID
-from uuid import UUID as base_uuid
-from sanic import json, response
+from io import StringIO
+import ujson
+from sanic import json, raw
 from tortoise.exceptions import OperationalError, IntegrityError
 
 from constants.enums import HTTPStatusCodes, WalletStatus
+from constants.queries import USER_WALLET_BY_TOKEN
+from managers.cache import MISSING, user_token_cache
 from managers.orm_wrappers import ORMWrapper
+from managers.replicas import replica_router
+from managers.shards import shard_map
+from managers.wallet_cache import wallet_state_cache
 from models import Users, Wallet
 
 
+class HelperConstant(Enum):
+    USER_FIELDS = ("id", "customer_xid", "token")
+    WALLET_FIELDS = ("id", "amount", "enabled_at", "is_enabled")
+
+
 async def send_response(data=None, status_code=HTTPStatusCodes.SUCCESS.value,
                         meta=None, body: dict = None, headers=None, purge_response_keys=False):
     """
@@ -36,7 +49,24 @@ async def send_response(data=None, status_code=HTTPStatusCodes.SUCCESS.value,
     return json(body=data, status=status_code, headers=headers)
 
 
-async def get_user_details(auth_token: str):
+async def send_serialized_response(serialized_data: str, status_code=HTTPStatusCodes.SUCCESS.value,
+                                   meta=None, headers=None):
+    """
+        Same envelope as send_response, for data that is already a json
+        string (see managers.serializers), it is spliced in as is.
+        :param serialized_data: json string of the response data
+        :param status_code: success status code, default is 200
+        :param meta: Optional: meta of the results
+        :param headers: Optional : Response headers to be sent to clients.
+    """
+    status = "success" if status_code in [200, 201] else "fail"
+    body = f'{{"data":{serialized_data},"status":"{status}","status_code":{status_code}'
+    if meta:
+        body += ',"meta":' + ujson.dumps(meta)
+    return raw((body + "}").encode(), status=status_code, headers=headers, content_type="application/json")
+
+
+def parse_auth_token(auth_token: str):
     if not auth_token:
         raise ValueError('Missing or invalid data for required field.')
 
@@ -44,26 +74,99 @@ async def get_user_details(auth_token: str):
     token = auth_token.split(" ")
     if token[0] != "Token":
         raise OperationalError("Invalid Token format")
+    return token[1]
+
+
+async def get_user_details(auth_token: str):
+    # get details of the user based on this token, cache first
+    token = parse_auth_token(auth_token)
+    user_details = user_token_cache.get(token)
+    if user_details is MISSING:
+        # concurrent lookups of tokens are merged into one query
+        users = await _read_by_token(token, lambda shard, primary: ORMWrapper.load_by_key(
+            Users, "token", token, fields=HelperConstant.USER_FIELDS.value, shard=shard, primary=primary
+        ))
+        user_details = None
+        if users:
+            user_details = {field: users[0][field] for field in HelperConstant.USER_FIELDS.value}
+        # negative lookups are cached too, for a shorter ttl
+        user_token_cache.set(token, user_details)
 
-    # get details of the user based on this token
-    token = token[1]
-    user_details = await ORMWrapper.get_by_filters(Users, filters={
-        "token": token
-    })
     if not user_details:
         raise OperationalError("No user found!!")
-    return user_details[0].__dict__
+    return dict(user_details)
+
+
+async def get_user_wallet_details(auth_token: str):
+    """
+        Resolves a token to its user and wallet in a single round trip,
+        a joined users/wallet query on a cache miss, only the wallet row
+        when the user is already cached, and none at all when the wallet
+        is cached too (see WalletStateCache).
+
+        :param auth_token: value of the Authorization header
+        :return: (user_details, wallet_details) as plain dicts,
+        wallet_details is None if the user has no wallet yet.
+    """
+    token = parse_auth_token(auth_token)
+    user_details = user_token_cache.get(token)
+    # what fills the wallet cache is read from the primary, a replica
+    # may lag behind a write the cache has seen already
+    since = wallet_state_cache.generation
+    if user_details is MISSING:
+        rows = await _read_by_token(token, lambda shard, primary: ORMWrapper.prepared_sql(
+            USER_WALLET_BY_TOKEN, [token], connection=shard, read_only=True,
+            primary=primary or wallet_state_cache.enabled
+        ))
+        user_details = None
+        if rows:
+            row = rows[0]
+            user_details = {
+                "id": row["user_id"],
+                "customer_xid": row["customer_xid"],
+                "token": row["token"],
+            }
+        user_token_cache.set(token, user_details)
+    elif user_details:
+        wallet_details = wallet_state_cache.get(user_details["customer_xid"])
+        if wallet_details is not MISSING:
+            return dict(user_details), wallet_details
+        rows = await ORMWrapper.load_by_key(
+            Wallet, "customer_xid", user_details["customer_xid"], fields=HelperConstant.WALLET_FIELDS.value,
+            customer_xid=user_details["customer_xid"], primary=wallet_state_cache.enabled
+        )
 
+    if not user_details:
+        raise OperationalError("No user found!!")
 
-async def get_wallet_details(user_details):
-    wallet_details = await ORMWrapper.get_by_filters(Wallet,
-                                                     filters={
-                                                         "customer_xid": user_details.get("customer_xid")
-                                                     })
-    if not wallet_details:
-        raise OperationalError()
+    wallet_details = None
+    if rows and rows[0]["id"] is not None:
+        row = rows[0]
+        wallet_details = {
+            "id": row["id"],
+            "amount": row["amount"],
+            "customer_xid": user_details["customer_xid"],
+            "enabled_at": row["enabled_at"],
+            "is_enabled": bool(row["is_enabled"]),
+        }
+    wallet_state_cache.fill(user_details["customer_xid"], wallet_details, since)
+    return dict(user_details), wallet_details
 
-    return wallet_details[0].__dict__
+
+async def _read_by_token(token: str, read):
+    """
+        Runs read(shard, primary) on the shards the user of token may be
+        on, until one has it. A user created moments ago may not be on
+        the replicas yet, so a miss is retried on the primary.
+        :return: rows of the first shard with a match, [] if none has
+    """
+    for shard in shard_map.token_shards(token):
+        rows = await read(shard, False)
+        if not rows and replica_router.enabled:
+            rows = await read(shard, True)
+        if rows:
+            return rows
+    return []
 
 
 def wallet_response_formatter(user_details: dict, wallet_details: dict):
@@ -76,19 +179,69 @@ def wallet_response_formatter(user_details: dict, wallet_details: dict):
     }
 
 
-def to_string(result):
-    for key in result:
-        if type(result[key]) == datetime:
-            result[key] = str(result[key])
-        if type(result[key]) == date:
-            result[key] = str(result[key])
-        if type(result[key]) == UUID:
-            result[key] = str(result[key])
-        if type(result[key]) == bool:
-            result[key] = str(result[key])
-        if type(result[key]) == base_uuid:
-            result[key] = str(result[key])
-    return result
+def transaction_response_formatter(transaction: dict):
+    return {
+        "id": transaction.get("id"),
+        "deposited_by": transaction.get("transaction_from"),
+        "deposited_at": str(transaction.get("transaction_time")),
+        "amount": transaction.get("amount"),
+        "final_amount": transaction.get("final_amount"),
+        "transaction_type": transaction.get("transaction_type"),
+        "reference_id": transaction.get("reference_id")
+    }
+
+
+def transfer_response_formatter(transaction: dict):
+    return {
+        "id": transaction.get("id"),
+        "transferred_by": transaction.get("transaction_from"),
+        "transferred_to": transaction.get("transaction_to"),
+        "transferred_at": str(transaction.get("transaction_time")),
+        "amount": transaction.get("amount"),
+        "final_amount": transaction.get("final_amount"),
+        "reference_id": transaction.get("reference_id")
+    }
+
+
+def encode_cursor(transaction_time, transaction_id):
+    """
+        Opaque pagination cursor for a (transaction_time, id) position.
+    """
+    if isinstance(transaction_time, datetime):
+        transaction_time = transaction_time.isoformat()
+    cursor = ujson.dumps([str(transaction_time), transaction_id])
+    return urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+        :return: (transaction_time, id) encoded by encode_cursor
+    """
+    try:
+        transaction_time, transaction_id = ujson.loads(urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(transaction_time), int(transaction_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor!")
+
+
+def list_parameter(values: list, dialect: str):
+    """
+        Parameter of an IN_LIST filter, sqlite reads the list from a json
+        array.
+    """
+    return ujson.dumps(values) if dialect == "sqlite" else values
+
+
+def rows_to_csv(rows, columns, header=False):
+    """
+        Serializes rows as csv lines in the order of columns.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    writer.writerows([row.get(column) for column in columns] for row in rows)
+    return buffer.getvalue()
 
 
 def exceptions_handler(func):
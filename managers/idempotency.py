@@ -0,0 +1,90 @@
+from enum import Enum
+
+from tortoise.exceptions import IntegrityError
+
+from managers.cache import MISSING, TTLCache
+from managers.orm_wrappers import ORMWrapper
+from managers.shards import shard_map
+from models import Transactions
+
+
+class IdempotencyConstant(Enum):
+    MAX_SIZE = 50000
+    TTL = 3600  # seconds
+    TRANSACTION_FIELDS = ("id", "amount", "final_amount", "transaction_time",
+                          "transaction_from", "transaction_to", "transaction_type", "reference_id")
+
+
+class IdempotencyIndex:
+    """
+        Bounded index of recently settled reference_ids, so a retried
+        deposit, withdrawal or transfer is answered with its original
+        transaction without touching the wallet rows.
+        The transactions table stays the source of truth: a reference_id
+        unknown to this worker (evicted, or settled by another worker) is
+        caught by the unique constraint on transactions.reference_id, and
+        its transaction is then read back from the table.
+        reference_ids are unique per shard, entries are keyed by the shard
+        of the customer too. A customer moved by tools/rebalance.py is
+        looked up on its new shard once the workers run the new SHARDING
+        config, which they only read on start: rebalancing restarts them
+        and so empties the index.
+    """
+
+    def __init__(self, max_size=IdempotencyConstant.MAX_SIZE.value, ttl=IdempotencyConstant.TTL.value):
+        self._transactions = TTLCache(max_size=max_size, ttl=ttl)
+        self.replays = 0
+
+    def remember(self, transaction: dict):
+        """
+            :param transaction: settled transaction, with the keys of
+            IdempotencyConstant.TRANSACTION_FIELDS
+        """
+        self._transactions.set(self._key(transaction["transaction_from"], transaction["reference_id"]), transaction)
+
+    def lookup(self, customer_xid: str, reference_id: str, transaction_type: str, amount: int):
+        """
+            :return: the transaction settled earlier for reference_id, None
+            if this worker hasn't seen it
+            :raises IntegrityError: reference_id was used for another
+            customer, type or amount
+        """
+        transaction = self._transactions.get(self._key(customer_xid, reference_id))
+        if transaction is MISSING or transaction is None:
+            return None
+        return self._replay(transaction, customer_xid, transaction_type, amount)
+
+    async def load(self, customer_xid: str, reference_id: str, transaction_type: str, amount: int):
+        """
+            Reads the transaction of a reference_id back from the table,
+            after an insert failed on the unique constraint.
+            :return: the stored transaction, None if there is none
+            :raises IntegrityError: reference_id was used for another
+            customer, type or amount
+        """
+        # the primary, the row may have been written a moment ago
+        rows = await ORMWrapper.get_values_by_filters(
+            Transactions, {"reference_id": reference_id}, list(IdempotencyConstant.TRANSACTION_FIELDS.value),
+            customer_xid=customer_xid, primary=True
+        )
+        if not rows:
+            return None
+        self.remember(rows[0])
+        return self._replay(rows[0], customer_xid, transaction_type, amount)
+
+    @staticmethod
+    def _key(customer_xid, reference_id):
+        return shard_map.connection_name(customer_xid), reference_id
+
+    def _replay(self, transaction, customer_xid, transaction_type, amount):
+        if (transaction["transaction_from"] != customer_xid or transaction["transaction_type"] != transaction_type
+                or transaction["amount"] != amount):
+            raise IntegrityError("reference_id already used for another transaction!")
+        self.replays += 1
+        return transaction
+
+    def stats(self):
+        return dict(self._transactions.stats(), replays=self.replays)
+
+
+idempotency_index = IdempotencyIndex()
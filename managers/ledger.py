@@ -0,0 +1,558 @@
+import asyncio
+from enum import Enum
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+from sanic.log import logger
+from tortoise import Tortoise
+from tortoise.exceptions import IntegrityError, OperationalError
+
+from constants.enums import TransactionStatus, TransferOutcome
+from constants.queries import APPLY_BALANCE_CHANGE, UPDATE_WALLET_BALANCE, INSERT_TRANSACTION, \
+    WALLET_BY_CUSTOMER, APPLY_DEPOSIT_BATCH, WALLET_FOR_BALANCE_CHANGE, ADD_WALLET_BALANCE, \
+    TRANSACTIONS_FIRST_PAGE, TRANSACTIONS_PAGE_BEFORE, TRANSACTIONS_PAGE_AFTER, TRANSACTIONS_EXPORT, \
+    WALLETS_FOR_TRANSFER, APPLY_TRANSFER_BALANCES, INSERT_TRANSFER, APPLY_BALANCE_CHANGE_OUTBOX, \
+    APPLY_DEPOSIT_BATCH_OUTBOX, IN_LIST, USED_REFERENCE_IDS, INSERT_TRANSFER_INTENT, DELETE_TRANSFER_INTENT, \
+    REFUND_TRANSFER_INTENT, TRANSFER_CREDIT, TRANSFER_STATE
+from managers.helpers import encode_cursor, decode_cursor, list_parameter
+from managers.orm_wrappers import ORMWrapper
+from managers.outbox import add_outbox_events, outbox_publisher
+from managers.replicas import replica_router
+from managers.rollups import add_daily_summary
+from managers.shards import shard_map
+from managers.wallet_cache import wallet_state_cache
+from models import Transactions
+
+
+class LedgerConstant(Enum):
+    MAX_BATCH_ITEMS = 5000
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    EXPORT_COLUMNS = ("id", "amount", "final_amount", "status", "transaction_time",
+                      "transaction_from", "transaction_to", "transaction_type", "reference_id")
+    # reference_id of the receiver's ledger row of a transfer
+    TRANSFER_IN_SUFFIX = ":in"
+    # reference_id of the sender's refund of a failed cross shard transfer
+    TRANSFER_REFUND_SUFFIX = ":rf"
+    # a cross shard transfer is left to the call that debited it for this
+    # long before the recovery sweep may settle it, longer than the credit
+    # may take
+    TRANSFER_LEASE_S = 60
+    TRANSFER_CREDIT_TIMEOUT_S = 10
+    REFERENCE_ID_MAX_LENGTH = 50
+    # a batch losing a reference_id to another wallet between the check
+    # and the insert is run again, to report it per item
+    BATCH_ATTEMPTS = 3
+    DEBIT_TYPES = (TransactionStatus.WITHDRAWAL.value, TransactionStatus.TRANSFER_OUT.value)
+
+
+def valid_reference_id(reference_id, suffix: str = ""):
+    """
+        :param suffix: appended to reference_id for another ledger row
+        :return: True for a non empty string that fits the reference_id
+        column, with suffix
+    """
+    return isinstance(reference_id, str) and \
+        0 < len(reference_id) <= LedgerConstant.REFERENCE_ID_MAX_LENGTH.value - len(suffix)
+
+
+async def apply_balance_change(customer_xid: str, amount: int, transaction_type: str,
+                               reference_id: str, transaction_to: str = "self"):
+    """
+        Moves the balance of a wallet and records the ledger entry, its
+        daily summary and outbox event atomically, the balance is computed
+        and the funds are checked in the database, never in python.
+
+        :param customer_xid: owner of the wallet
+        :param amount: positive amount of the transaction
+        :param transaction_type: TransactionStatus value, withdrawals and
+        outgoing transfers debit the wallet, the rest credit it
+        :param reference_id: unique id of the transaction
+        :param transaction_to: receiver of the transaction
+        :return: dict with id, final_amount and transaction_time of the
+        inserted transaction
+    """
+    delta = -amount if transaction_type in LedgerConstant.DEBIT_TYPES.value else amount
+    status = TransactionStatus.SUCCESS.value
+
+    with wallet_state_cache.write(customer_xid) as write:
+        if Tortoise.get_connection("default").capabilities.dialect == "postgres":
+            query = APPLY_BALANCE_CHANGE_OUTBOX if outbox_publisher.enabled else APPLY_BALANCE_CHANGE
+            rows = await ORMWrapper.prepared_sql(query, [
+                delta, customer_xid, amount, status, transaction_to, transaction_type, reference_id
+            ], customer_xid=customer_xid)
+        else:
+            async with ORMWrapper.in_transaction(customer_xid=customer_xid) as connection:
+                rows = await _write_balance_change(connection, customer_xid, amount, transaction_type, reference_id,
+                                                   transaction_to)
+
+        if not rows:
+            await _raise_balance_change_error(customer_xid)
+        write.update(amount=rows[0]["final_amount"])
+    replica_router.record_write(customer_xid)
+    return rows[0]
+
+
+async def _write_balance_change(connection, customer_xid: str, amount: int, transaction_type: str,
+                                reference_id: str, transaction_to: str):
+    """
+        apply_balance_change as separate statements, in the open
+        transaction of connection.
+        :return: [inserted transaction], [] if the wallet is missing,
+        disabled or short of funds
+    """
+    delta = -amount if transaction_type in LedgerConstant.DEBIT_TYPES.value else amount
+    rows = await ORMWrapper.raw_sql(UPDATE_WALLET_BALANCE, [delta, customer_xid], connection)
+    if not rows:
+        return rows
+    rows = await ORMWrapper.raw_sql(INSERT_TRANSACTION, [
+        amount, rows[0]["amount"], TransactionStatus.SUCCESS.value, customer_xid,
+        transaction_to, transaction_type, reference_id
+    ], connection)
+    await add_daily_summary(customer_xid, [
+        dict(rows[0], amount=amount, transaction_type=transaction_type)
+    ], connection)
+    await add_outbox_events([reference_id], connection)
+    return rows
+
+
+async def apply_deposit_batch(customer_xid: str, deposits: list):
+    """
+        Applies several deposits to one wallet as a single balance update
+        plus one bulk ledger insert. Any failure (duplicate reference_id,
+        disabled wallet ...) fails the whole batch and nothing is written.
+
+        :param customer_xid: owner of the wallet
+        :param deposits: list of (amount, reference_id), amounts positive
+        :return: list of dicts with id, final_amount and transaction_time,
+        in the order of deposits
+    """
+    amounts = [amount for amount, _ in deposits]
+    reference_ids = [reference_id for _, reference_id in deposits]
+    running_totals = list(accumulate(amounts))
+    total = running_totals[-1]
+    status = TransactionStatus.SUCCESS.value
+    transaction_type = TransactionStatus.DEPOSIT.value
+
+    with wallet_state_cache.write(customer_xid) as write:
+        if Tortoise.get_connection("default").capabilities.dialect == "postgres":
+            query = APPLY_DEPOSIT_BATCH_OUTBOX if outbox_publisher.enabled else APPLY_DEPOSIT_BATCH
+            rows = await ORMWrapper.prepared_sql(query, [
+                total, customer_xid, status, transaction_type, amounts, running_totals, reference_ids
+            ], customer_xid=customer_xid)
+            # amounts are positive, so final_amount grows with the position
+            # in the batch, RETURNING itself does not promise any order
+            rows.sort(key=lambda row: row["final_amount"])
+        else:
+            async with ORMWrapper.in_transaction(customer_xid=customer_xid) as connection:
+                wallet_rows = await ORMWrapper.raw_sql(UPDATE_WALLET_BALANCE, [total, customer_xid], connection)
+                rows = []
+                if wallet_rows:
+                    opening_balance = wallet_rows[0]["amount"] - total
+                    for amount, running, reference_id in zip(amounts, running_totals, reference_ids):
+                        inserted = await ORMWrapper.raw_sql(INSERT_TRANSACTION, [
+                            amount, opening_balance + running, status, customer_xid,
+                            "self", transaction_type, reference_id
+                        ], connection)
+                        rows.append(inserted[0])
+                    await add_daily_summary(customer_xid, [
+                        dict(row, amount=amount, transaction_type=transaction_type)
+                        for row, amount in zip(rows, amounts)
+                    ], connection)
+                    await add_outbox_events(reference_ids, connection)
+
+        if not rows:
+            await _raise_balance_change_error(customer_xid)
+        write.update(amount=rows[-1]["final_amount"])
+    replica_router.record_write(customer_xid)
+    return rows
+
+
+def _validate_batch_items(items):
+    """
+        Validates every item of a batch in one pass.
+        :return: list of error messages, None for the valid items
+    """
+    errors = []
+    seen_reference_ids = set()
+    transaction_types = (TransactionStatus.DEPOSIT.value, TransactionStatus.WITHDRAWAL.value)
+    for item in items:
+        error = None
+        if not isinstance(item, dict):
+            error = "Invalid item!"
+        elif type(item.get("amount")) != int or item["amount"] <= 0:
+            error = "invalid amount!"
+        elif item.get("type") not in transaction_types:
+            error = "invalid type!"
+        elif not item.get("reference_id"):
+            error = "Missing reference_id!"
+        elif not valid_reference_id(item["reference_id"]):
+            error = "invalid reference_id!"
+        elif item["reference_id"] in seen_reference_ids:
+            error = "Duplicate reference_id!"
+        else:
+            seen_reference_ids.add(item["reference_id"])
+        errors.append(error)
+    return errors
+
+
+async def apply_transaction_batch(customer_xid: str, items: list):
+    """
+        Applies a batch of deposits and withdrawals to one wallet, in order.
+        The wallet row is locked once, the net change is written with one
+        update and the ledger rows with one bulk insert. Invalid items,
+        already used reference_ids and withdrawals the running balance can't
+        cover are reported as failed, the rest of the batch still applies.
+        A reference_id another wallet takes between the check and the
+        insert fails the insert, the batch is then run again (up to
+        BATCH_ATTEMPTS times) and reports it as used.
+
+        :param customer_xid: owner of the wallet
+        :param items: list of {"amount", "reference_id", "type"} dicts
+        :return: (final balance, list of per item results)
+    """
+    if len(items) > LedgerConstant.MAX_BATCH_ITEMS.value:
+        raise ValueError(f"Batch can have at most {LedgerConstant.MAX_BATCH_ITEMS.value} items!")
+
+    errors = _validate_batch_items(items)
+    lock_query = WALLET_FOR_BALANCE_CHANGE
+    if Tortoise.get_connection("default").capabilities.dialect == "postgres":
+        lock_query += "FOR UPDATE"
+
+    with wallet_state_cache.write(customer_xid) as write:
+        for attempt in range(LedgerConstant.BATCH_ATTEMPTS.value):
+            try:
+                async with ORMWrapper.in_transaction(customer_xid=customer_xid) as connection:
+                    balance, results = await _write_transaction_batch(connection, customer_xid, items, errors,
+                                                                      lock_query)
+                break
+            except IntegrityError:
+                # a reference_id was taken by another wallet after the
+                # check, the next attempt sees it committed
+                if attempt == LedgerConstant.BATCH_ATTEMPTS.value - 1:
+                    raise
+        write.update(amount=balance)
+
+    replica_router.record_write(customer_xid)
+    return balance, results
+
+
+async def _write_transaction_batch(connection, customer_xid: str, items: list, errors: list, lock_query: str):
+    """
+        apply_transaction_batch in the open transaction of connection.
+        :param errors: _validate_batch_items of items
+        :return: (final balance, list of per item results)
+    """
+    dialect = connection.capabilities.dialect
+    reference_ids = [item["reference_id"] for item, error in zip(items, errors) if not error]
+    wallet_rows = await ORMWrapper.raw_sql(lock_query, [customer_xid], connection)
+    if not wallet_rows:
+        raise ValueError("Wallet not found!")
+    if not wallet_rows[0]["is_enabled"]:
+        raise OperationalError("Wallet disabled!")
+
+    # checked under the wallet lock, a concurrent batch of this wallet
+    # reusing a reference_id has committed by now
+    if reference_ids:
+        used_reference_ids = {row["reference_id"] for row in await ORMWrapper.raw_sql(
+            USED_REFERENCE_IDS.format(reference_ids=IN_LIST[dialect].format(column="reference_id")),
+            [list_parameter(reference_ids, dialect)], connection
+        )}
+        errors = [
+            "Duplicate reference_id!" if not error and item["reference_id"] in used_reference_ids else error
+            for item, error in zip(items, errors)
+        ]
+
+    balance = wallet_rows[0]["amount"]
+    results = []
+    ledger_rows = []
+    for item, error in zip(items, errors):
+        if not error:
+            delta = item["amount"]
+            if item["type"] == TransactionStatus.WITHDRAWAL.value:
+                delta = -delta
+            if balance + delta < 0:
+                error = "Insufficient balance!"
+
+        if error:
+            results.append({
+                "reference_id": item.get("reference_id") if isinstance(item, dict) else None,
+                "status": TransactionStatus.FAILED.value,
+                "error": error,
+            })
+            continue
+
+        balance += delta
+        ledger_rows.append({
+            "amount": item["amount"],
+            "final_amount": balance,
+            "status": TransactionStatus.SUCCESS.value,
+            "transaction_from": customer_xid,
+            "transaction_to": "self",
+            "transaction_type": item["type"],
+            "reference_id": item["reference_id"],
+        })
+        results.append({
+            "reference_id": item["reference_id"],
+            "status": TransactionStatus.SUCCESS.value,
+            "transaction_type": item["type"],
+            "amount": item["amount"],
+            "final_amount": balance,
+        })
+
+    if ledger_rows:
+        await ORMWrapper.raw_sql(ADD_WALLET_BALANCE, [balance - wallet_rows[0]["amount"], customer_xid],
+                                 connection)
+        await ORMWrapper.bulk_create(Transactions, ledger_rows, using_db=connection)
+        # the ledger rows are stamped with the current (UTC) time
+        await add_daily_summary(customer_xid, ledger_rows, connection, day=datetime.now(timezone.utc).date())
+        await add_outbox_events([row["reference_id"] for row in ledger_rows], connection)
+    return balance, results
+
+
+async def apply_transfer(sender_xid: str, receiver_xid: str, amount: int, reference_id: str):
+    """
+        Moves funds from one wallet to another atomically. Both wallet
+        rows are locked in customer_xid order whichever way the money
+        goes, so concurrent opposite transfers queue instead of
+        deadlocking. The two balance updates and the two ledger rows are
+        written with one statement each. Wallets on different shards
+        go through _apply_cross_shard_transfer instead.
+
+        :param sender_xid: owner of the debited wallet
+        :param receiver_xid: owner of the credited wallet
+        :param amount: positive amount to move
+        :param reference_id: unique id of the transfer, the receiver's
+        ledger row gets it with TRANSFER_IN_SUFFIX appended
+        :return: dict with id, final_amount and transaction_time of the
+        sender's ledger row
+    """
+    if sender_xid == receiver_xid:
+        raise ValueError("Cannot transfer to the same wallet!")
+    if not valid_reference_id(reference_id, LedgerConstant.TRANSFER_IN_SUFFIX.value):
+        raise ValueError("invalid reference_id!")
+
+    shard = shard_map.connection_name(sender_xid, write=True)
+    if shard_map.connection_name(receiver_xid, write=True) != shard:
+        return await _apply_cross_shard_transfer(sender_xid, receiver_xid, amount, reference_id)
+
+    lock_query = WALLETS_FOR_TRANSFER
+    if Tortoise.get_connection("default").capabilities.dialect == "postgres":
+        lock_query += "FOR UPDATE"
+
+    with wallet_state_cache.write(sender_xid) as sender_write, \
+            wallet_state_cache.write(receiver_xid) as receiver_write:
+        async with ORMWrapper.in_transaction(shard) as connection:
+            wallets = {
+                row["customer_xid"]: row
+                for row in await ORMWrapper.raw_sql(lock_query, [sender_xid, receiver_xid], connection)
+            }
+            sender, receiver = wallets.get(sender_xid), wallets.get(receiver_xid)
+            if not sender:
+                raise ValueError("Wallet not found!")
+            if not sender["is_enabled"]:
+                raise OperationalError("Wallet disabled!")
+            if not receiver:
+                raise ValueError("Receiver wallet not found!")
+            if not receiver["is_enabled"]:
+                raise OperationalError("Receiver wallet disabled!")
+            if sender["amount"] < amount:
+                raise OperationalError("Insufficient balance!")
+
+            balances = {
+                row["customer_xid"]: row["amount"]
+                for row in await ORMWrapper.raw_sql(APPLY_TRANSFER_BALANCES, [sender_xid, receiver_xid, amount],
+                                                    connection)
+            }
+            rows = await ORMWrapper.raw_sql(INSERT_TRANSFER, [
+                amount, balances[sender_xid], TransactionStatus.SUCCESS.value, sender_xid, receiver_xid,
+                TransactionStatus.TRANSFER_OUT.value, reference_id,
+                balances[receiver_xid], TransactionStatus.TRANSFER_IN.value, reference_id + suffix
+            ], connection)
+            for row in rows:
+                transaction_type = TransactionStatus.TRANSFER_OUT.value
+                if row["transaction_from"] == receiver_xid:
+                    transaction_type = TransactionStatus.TRANSFER_IN.value
+                await add_daily_summary(row["transaction_from"], [
+                    dict(row, amount=amount, transaction_type=transaction_type)
+                ], connection)
+            await add_outbox_events([reference_id, reference_id + suffix], connection)
+        sender_write.update(amount=balances[sender_xid])
+        receiver_write.update(amount=balances[receiver_xid])
+
+    replica_router.record_write(sender_xid, receiver_xid)
+    return next(row for row in rows if row["transaction_from"] == sender_xid)
+
+
+async def _apply_cross_shard_transfer(sender_xid: str, receiver_xid: str, amount: int, reference_id: str):
+    """
+        Transfer between wallets on different shards, no database
+        transaction spans both. The receiver's wallet is checked first,
+        then the sender is debited on its shard together with the
+        transfer's intent, leased to this call for TRANSFER_LEASE_S, and
+        the transfer is settled by settle_transfer. Should this worker
+        stop midway, the intent outlives it and TransferRecovery settles
+        the transfer once the lease ran out.
+        :return: dict with id, final_amount and transaction_time of the
+        sender's ledger row
+    """
+    receiver_rows = await ORMWrapper.raw_sql(WALLET_BY_CUSTOMER, [receiver_xid], customer_xid=receiver_xid)
+    if not receiver_rows:
+        raise ValueError("Receiver wallet not found!")
+    if not receiver_rows[0]["is_enabled"]:
+        raise OperationalError("Receiver wallet disabled!")
+
+    lease = datetime.now(timezone.utc) + timedelta(seconds=LedgerConstant.TRANSFER_LEASE_S.value)
+    with wallet_state_cache.write(sender_xid) as write:
+        async with ORMWrapper.in_transaction(customer_xid=sender_xid) as connection:
+            rows = await _write_balance_change(connection, sender_xid, amount, TransactionStatus.TRANSFER_OUT.value,
+                                               reference_id, receiver_xid)
+            if rows:
+                await ORMWrapper.raw_sql(INSERT_TRANSFER_INTENT, [
+                    reference_id, sender_xid, receiver_xid, amount, lease
+                ], connection)
+        if not rows:
+            await _raise_balance_change_error(sender_xid)
+        write.update(amount=rows[0]["final_amount"])
+    replica_router.record_write(sender_xid)
+
+    outcome = await settle_transfer(sender_xid, receiver_xid, amount, reference_id, lease)
+    if outcome == TransferOutcome.REFUNDED:
+        raise OperationalError("Transfer failed, amount refunded!")
+    if outcome == TransferOutcome.PENDING:
+        raise OperationalError("Transfer pending, retry later!")
+    return dict(rows[0], transaction_from=sender_xid)
+
+
+async def settle_transfer(sender_xid: str, receiver_xid: str, amount: int, reference_id: str, lease: datetime):
+    """
+        Credits the receiver of a debited cross shard transfer and drops
+        its intent, or refunds the sender when the credit is refused. The
+        credit can only happen once (reference_id + TRANSFER_IN_SUFFIX),
+        and the refund only while lease is still the intent's and the
+        receiver has no credit, so no transfer is both credited and
+        refunded, whoever settles it.
+        :param lease: leased_until of the intent, held by the caller
+        :return: TransferOutcome, PENDING when the outcome of the credit
+        is unknown or the lease was lost, the next lease holder settles it
+    """
+    try:
+        await asyncio.wait_for(apply_balance_change(
+            receiver_xid, amount, TransactionStatus.TRANSFER_IN.value,
+            reference_id + LedgerConstant.TRANSFER_IN_SUFFIX.value, transaction_to=sender_xid
+        ), LedgerConstant.TRANSFER_CREDIT_TIMEOUT_S.value)
+    except Exception as credit_error:
+        try:
+            credited = await ORMWrapper.raw_sql(TRANSFER_CREDIT, [
+                reference_id + LedgerConstant.TRANSFER_IN_SUFFIX.value, receiver_xid,
+                TransactionStatus.TRANSFER_IN.value
+            ], customer_xid=receiver_xid)
+            if not credited:
+                refunded = await _refund_transfer(sender_xid, receiver_xid, amount, reference_id, lease)
+                return TransferOutcome.REFUNDED if refunded else TransferOutcome.PENDING
+        except Exception as settle_error:
+            logger.warning("transfer %s of %s from %s to %s left pending: %r, %r",
+                           reference_id, amount, sender_xid, receiver_xid, credit_error, settle_error)
+            return TransferOutcome.PENDING
+
+    try:
+        await ORMWrapper.raw_sql(DELETE_TRANSFER_INTENT, [reference_id], customer_xid=sender_xid)
+    except Exception as ex:
+        # credited all the same, the recovery sweep drops the intent
+        logger.warning("intent of credited transfer %s not dropped: %r", reference_id, ex)
+    return TransferOutcome.CREDITED
+
+
+async def _refund_transfer(sender_xid, receiver_xid, amount, reference_id, lease):
+    with wallet_state_cache.write(sender_xid) as write:
+        async with ORMWrapper.in_transaction(customer_xid=sender_xid) as connection:
+            if not await ORMWrapper.raw_sql(REFUND_TRANSFER_INTENT, [reference_id, lease], connection):
+                return False
+            rows = await _write_balance_change(connection, sender_xid, amount, TransactionStatus.TRANSFER_IN.value,
+                                               reference_id + LedgerConstant.TRANSFER_REFUND_SUFFIX.value,
+                                               receiver_xid)
+            if not rows:
+                # rolls the intent back in, to be refunded later
+                raise OperationalError("Wallet disabled!")
+        write.update(amount=rows[0]["final_amount"])
+    replica_router.record_write(sender_xid)
+    return True
+
+
+async def check_transfer_settled(sender_xid: str, reference_id: str):
+    """
+        For a retried transfer whose reference_id is taken: the sender's
+        ledger row alone doesn't tell if a cross shard transfer went
+        through.
+        :raises OperationalError: the transfer was refunded, or is not
+        settled yet
+    """
+    state = (await ORMWrapper.raw_sql(TRANSFER_STATE, [
+        reference_id, reference_id + LedgerConstant.TRANSFER_REFUND_SUFFIX.value, sender_xid
+    ], customer_xid=sender_xid))[0]
+    if state["refunded"]:
+        raise OperationalError("Transfer failed, amount refunded!")
+    if state["pending"]:
+        raise OperationalError("Transfer pending, retry later!")
+
+
+async def get_transactions_page(customer_xid: str, limit: int = LedgerConstant.DEFAULT_PAGE_SIZE.value,
+                                before: str = None, after: str = None):
+    """
+        Keyset paginated transaction history of a wallet, newest first.
+        Every page is one index range scan, however deep it is.
+
+        :param customer_xid: owner of the wallet
+        :param limit: page size
+        :param before: cursor, fetch transactions older than it
+        :param after: cursor, fetch transactions newer than it
+        :return: (rows, meta) where meta has the cursors of the next
+        (older) and previous (newer) pages, None when there is none
+    """
+    if before and after:
+        raise ValueError("Use either before or after cursor, not both!")
+    if limit <= 0 or limit > LedgerConstant.MAX_PAGE_SIZE.value:
+        raise ValueError(f"limit should be between 1 and {LedgerConstant.MAX_PAGE_SIZE.value}!")
+
+    # one extra row tells if there is a page beyond this one
+    if before:
+        query, values = TRANSACTIONS_PAGE_BEFORE, [customer_xid, limit + 1, *decode_cursor(before)]
+    elif after:
+        query, values = TRANSACTIONS_PAGE_AFTER, [customer_xid, limit + 1, *decode_cursor(after)]
+    else:
+        query, values = TRANSACTIONS_FIRST_PAGE, [customer_xid, limit + 1]
+    rows = await ORMWrapper.prepared_sql(query, values, read_only=True, customer_xid=customer_xid)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after:
+        rows.reverse()
+
+    has_older = has_more if not after else bool(rows)
+    has_newer = has_more if after else bool(before and rows)
+    meta = {
+        "limit": limit,
+        "next_cursor": encode_cursor(rows[-1]["transaction_time"], rows[-1]["id"]) if has_older else None,
+        "prev_cursor": encode_cursor(rows[0]["transaction_time"], rows[0]["id"]) if has_newer else None,
+    }
+    return rows, meta
+
+
+def stream_transactions(customer_xid: str):
+    """
+        Full transaction history of a wallet, oldest first.
+        :return: async generator of chunks (lists) of transaction rows
+    """
+    return ORMWrapper.stream_raw_sql(TRANSACTIONS_EXPORT, [customer_xid], connection=replica_router.read_connection(
+        customer_xid, shard_map.connection_name(customer_xid)
+    ))
+
+
+async def _raise_balance_change_error(customer_xid: str):
+    # only runs on the failure path, to tell the caller why nothing changed
+    wallet_rows = await ORMWrapper.raw_sql(WALLET_BY_CUSTOMER, [customer_xid], customer_xid=customer_xid)
+    if not wallet_rows:
+        raise ValueError("Wallet not found!")
+    if not wallet_rows[0]["is_enabled"]:
+        raise OperationalError("Wallet disabled!")
+    raise OperationalError("Insufficient balance!")
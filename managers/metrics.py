@@ -0,0 +1,184 @@
+import inspect
+import time
+from bisect import bisect_left
+from enum import Enum
+from functools import wraps
+
+from tortoise.connection import connections
+
+from managers.profiler import query_profiler
+
+
+class MetricsConstant(Enum):
+    # seconds, upper bounds of the histogram buckets
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+        Fixed bucket latency histogram. Counters are plain ints, all
+        updates happen on the event loop thread of the worker so no lock
+        is needed.
+    """
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        # one count per bucket plus the +Inf bucket
+        self.counts = [0] * (len(MetricsConstant.BUCKETS.value) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(MetricsConstant.BUCKETS.value, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+        Latency histograms keyed by label values, per worker process.
+    """
+
+    def __init__(self):
+        self.requests = {}  # (route, method, status) -> Histogram
+        self.queries = {}  # (model, operation) -> Histogram
+        self.pool_waits = {}  # (connection,) -> Histogram
+        self.gauges = []  # (name, help, label names, function returning {labels: value})
+
+    @staticmethod
+    def _observe(histograms, labels, value):
+        histogram = histograms.get(labels)
+        if histogram is None:
+            histogram = histograms[labels] = Histogram()
+        histogram.observe(value)
+
+    def observe_request(self, route, method, status, seconds):
+        self._observe(self.requests, (route, method, str(status)), seconds)
+
+    def observe_query(self, model, operation, seconds):
+        self._observe(self.queries, (model, operation), seconds)
+
+    def observe_pool_wait(self, connection, seconds):
+        self._observe(self.pool_waits, (connection,), seconds)
+
+    def register_gauge(self, name, help_text, label_names, collect):
+        """
+            :param name: metric name
+            :param help_text: description of the metric
+            :param label_names: tuple of label names
+            :param collect: function returning a dict of label values tuple
+            -> value, called on every scrape
+        """
+        self.gauges.append((name, help_text, label_names, collect))
+
+    def render(self):
+        """
+            :return: all metrics in the prometheus text exposition format
+        """
+        lines = []
+        _render_histograms(lines, "wallet_http_request_duration_seconds",
+                           "Latency of http requests by route, method and status.",
+                           ("route", "method", "status"), self.requests)
+        _render_histograms(lines, "wallet_db_query_duration_seconds",
+                           "Latency of ORMWrapper calls by model and operation.",
+                           ("model", "operation"), self.queries)
+        _render_histograms(lines, "wallet_db_pool_wait_seconds",
+                           "Time spent waiting for a pooled database connection.",
+                           ("connection",), self.pool_waits)
+        for name, help_text, label_names, collect in self.gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for label_values, value in collect().items():
+                lines.append(f"{name}{_labels(label_names, label_values)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _render_histograms(lines, name, help_text, label_names, histograms):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for label_values, histogram in list(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(MetricsConstant.BUCKETS.value, histogram.counts):
+            cumulative += count
+            bucket_labels = _labels(label_names, label_values, 'le="%s"' % bound)
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        bucket_labels = _labels(label_names, label_values, 'le="+Inf"')
+        labels = _labels(label_names, label_values)
+        lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+        lines.append(f"{name}_sum{labels} {histogram.total}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+
+
+metrics = MetricsRegistry()
+
+
+def timed_query(operation):
+    """
+        Decorator timing an ORMWrapper call per model and operation, and
+        handing it to the query profiler when that is enabled. The model
+        is read from the "model" argument of the wrapped method, calls
+        without one (raw sql) are labelled "raw".
+    """
+    def decorator(func):
+        parameters = list(inspect.signature(func).parameters)
+        model_index = parameters.index("model") if "model" in parameters else None
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            model = kwargs.get("model")
+            if model is None and model_index is not None and len(args) > model_index:
+                model = args[model_index]
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started
+                model_name = model.__name__ if model is not None else "raw"
+                metrics.observe_query(model_name, operation, seconds)
+                if query_profiler.enabled:
+                    query_profiler.observe(operation, model_name, seconds, {"args": args[1:], "kwargs": kwargs})
+        return wrapper
+    return decorator
+
+
+class TimedPool:
+    """
+        Wraps a database connection pool to time how long acquire waits.
+        Everything else is delegated to the wrapped pool.
+    """
+
+    def __init__(self, pool, connection_name):
+        self._wrapped_pool = pool
+        self._connection_name = connection_name
+
+    async def acquire(self, *args, **kwargs):
+        started = time.perf_counter()
+        connection = await self._wrapped_pool.acquire(*args, **kwargs)
+        metrics.observe_pool_wait(self._connection_name, time.perf_counter() - started)
+        return connection
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped_pool, name)
+
+
+def instrument_pools():
+    """
+        Wraps the pool of every open pooled tortoise connection with
+        TimedPool, to be called once the connections are up.
+    """
+    for client in connections.all():
+        pool = getattr(client, "_pool", None)
+        if pool is not None and not isinstance(pool, TimedPool):
+            client._pool = TimedPool(pool, client.connection_name)
@@ -1,17 +1,31 @@
+import asyncio
+import re
 from enum import Enum
+from functools import lru_cache
 
 from tortoise import Tortoise
 from tortoise.contrib.postgres.functions import Random
 from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+
+from managers.fast_path import prepared_statements
+from managers.metrics import timed_query
+from managers.profiler import query_profiler
+from managers.replicas import replica_router, ReplicaConstant, REPLICA_FAILURES
+from managers.shards import shard_map
 
 
 class ORMConstant(Enum):
     DEFAULT_LIMIT = 100
     DEFAULT_OFFSET = 0
+    STREAM_CHUNK_SIZE = 1000
+    # keys of one coalesced lookup per IN (...) query
+    MAX_BATCH_KEYS = 500
 
 
 class ORMWrapper:
     @classmethod
+    @timed_query("get_by_filters")
     async def get_by_filters(
             cls,
             model,
@@ -20,8 +34,12 @@ class ORMWrapper:
             only=None,
             limit=ORMConstant.DEFAULT_LIMIT.value,
             offset=ORMConstant.DEFAULT_OFFSET.value,
+            customer_xid=None,
+            primary=False,
+            shard=None,
     ):
         """
+            Read only, may run on a replica, see ReplicaRouter.
             :param offset: no. of rows to skip
             :param limit: no. of records to fetch
             :param model: database model class
@@ -29,6 +47,11 @@ class ORMWrapper:
             :param order_by: for ordering on queryset
             :: Pass string value 'random' to fetch rows randomly
             :param only: Fetch ONLY specified fields to create a partial model
+            :param customer_xid: owner of the rows, picks the shard read and
+            keeps the read on the primary right after that customer wrote
+            :param primary: always read from the primary
+            :param shard: connection name of the shard primary to read,
+            when the rows can't be told by customer_xid
             :return: list of model objects returned by the where clause
         """
 
@@ -50,11 +73,66 @@ class ORMWrapper:
                 only = [only]
             queryset = queryset.only(*only)
 
-        return await queryset
+        if query_profiler.enabled:
+            query_profiler.set_statement(queryset.sql())
+        return await cls._read(queryset.using_db, customer_xid, primary, shard)
+
+    @classmethod
+    async def load_by_key(cls, model, key_field, key, fields=None, customer_xid=None, primary=False, shard=None):
+        """
+            Read only single key lookup, coalesced by batch_loader with the
+            concurrent lookups of the same model and key_field into one
+            query (see BatchLoader).
+            :param model: database model class
+            :param key_field: field looked up, e.g. "token"
+            :param key: value of key_field
+            :param fields: columns to return as dicts, model objects if None
+            :param customer_xid: owner of the rows, picks the shard read and
+            keeps the read on the primary right after that customer wrote
+            :param primary: always read from the primary
+            :param shard: connection name of the shard primary to read,
+            when the rows can't be told by customer_xid
+            :return: list of the rows having key
+        """
+        shard = shard or shard_map.connection_name(customer_xid)
+        primary = primary or replica_router.pinned(customer_xid)
+        if not batch_loader.enabled:
+            return await cls.get_by_keys(model, key_field, [key], fields, primary, shard)
+        return await batch_loader.load(model, key_field, key, fields, primary, shard)
+
+    @classmethod
+    @timed_query("get_by_keys")
+    async def get_by_keys(cls, model, key_field, keys, fields=None, primary=False, shard="default"):
+        """
+            Read only, may run on a replica, see ReplicaRouter.
+            :param model: database model class
+            :param key_field: field filtered on
+            :param keys: values of key_field, one IN (...) query
+            :param fields: columns to return as dicts, model objects if None
+            :param primary: always read from the primary
+            :param shard: connection name of the shard primary to read
+            :return: list of the rows having any of keys
+        """
+        queryset = model.filter(**{f"{key_field}__in": keys})
+        if fields:
+            # key_field too, so rows can be told apart by key
+            columns = list(dict.fromkeys([key_field, *fields]))
+            if query_profiler.enabled:
+                query_profiler.set_statement(queryset.values(*columns).sql())
+
+            def bind(connection):
+                if prepared_statements.active(connection):
+                    return prepared_statements.fetch(connection, _keys_query(model, key_field, tuple(columns)), [keys])
+                return queryset.using_db(connection).values(*columns)
+            return await cls._read(bind, primary=primary, shard=shard)
+        if query_profiler.enabled:
+            query_profiler.set_statement(queryset.sql())
+        return await cls._read(queryset.using_db, primary=primary, shard=shard)
 
     @classmethod
+    @timed_query("update_with_filters")
     async def update_with_filters(
-            cls, row, model, payload, where_clause=None, update_fields=None
+            cls, row, model, payload, where_clause=None, update_fields=None, customer_xid=None
     ):
         """
         :param row: database model instance which needs to be updated
@@ -64,20 +142,33 @@ class ORMWrapper:
         :param payload: values which will be updated in the database.
         :param where_clause: conditions on which update will work.
         :param update_fields: fields to update in case of model object update
+        :param customer_xid: owner of the rows, picks the shard written
         :return: None. update doesn't return any values
         """
+        connection = Tortoise.get_connection(shard_map.connection_name(customer_xid, write=True))
         if where_clause:
-            await model.filter(**where_clause).update(**payload)
+            await model.filter(**where_clause).using_db(connection).update(**payload)
         else:
             for key, value in payload.items():
                 setattr(row, key, value)
-            await row.save(update_fields=update_fields)
+            await row.save(update_fields=update_fields, using_db=connection)
         return None
 
     @classmethod
-    async def create(cls, model, payload):
+    @timed_query("create")
+    async def create(cls, model, payload, customer_xid=None):
+        """
+        :param model: database model class
+        :param payload: values of the row
+        :param customer_xid: owner of the row, picks the shard written,
+        the customer_xid of payload by default
+        :return: created model object
+        """
+        connection = Tortoise.get_connection(
+            shard_map.connection_name(customer_xid or payload.get("customer_xid"), write=True)
+        )
         try:
-            row = await model.create(**payload)
+            row = await model.create(using_db=connection, **payload)
             return row
         except IntegrityError as e:
             # Handle the unique constraint violation here
@@ -85,53 +176,188 @@ class ORMWrapper:
             raise IntegrityError("Duplicate entry: Unique constraint violation") from e
 
     @classmethod
-    async def get_or_create_object(cls, model, payload, defaults=None):
+    @timed_query("bulk_create")
+    async def bulk_create(cls, model, payloads, batch_size=None, using_db=None, customer_xid=None):
+        """
+            :param model: database model class
+            :param payloads: list of dicts, one per row to insert
+            :param batch_size: rows per insert statement, all at once if None
+            :param using_db: connection to use, e.g. of an open transaction
+            :param customer_xid: owner of the rows, picks the shard written
+            when using_db is None
+            :return: None. bulk insert doesn't populate generated keys
+        """
+        if using_db is None:
+            using_db = Tortoise.get_connection(shard_map.connection_name(customer_xid, write=True))
+        await model.bulk_create(
+            [model(**payload) for payload in payloads], batch_size=batch_size, using_db=using_db
+        )
+
+    @classmethod
+    @timed_query("get_or_create_object")
+    async def get_or_create_object(cls, model, payload, defaults=None, customer_xid=None):
         """
             :param model: database model class which needs to be get or created
             :param payload: values on which get or create will happen
             :param defaults: values on which will used to create the data which
             we do not
             want to include in filtering
+            :param customer_xid: owner of the row, picks the shard, the
+            customer_xid of payload by default
             :return: model object and created - true/false
         """
         defaults = defaults or {}
-        row, created = await model.get_or_create(defaults=defaults, **payload)
+        connection = Tortoise.get_connection(
+            shard_map.connection_name(customer_xid or payload.get("customer_xid"), write=True)
+        )
+        row, created = await model.get_or_create(defaults=defaults, using_db=connection, **payload)
         return row, created
 
     @classmethod
-    async def delete_with_filters(cls, row, model, where_clause):
+    @timed_query("delete_with_filters")
+    async def delete_with_filters(cls, row, model, where_clause, customer_xid=None):
         """
         :param row: model object
         :param model: db model
         :param where_clause: where conditional
+        :param customer_xid: owner of the rows, picks the shard written
         :return: None
         """
+        connection = Tortoise.get_connection(shard_map.connection_name(customer_xid, write=True))
         if where_clause:
-            await model.filter(**where_clause).delete()
+            await model.filter(**where_clause).using_db(connection).delete()
         else:
-            await row.delete()
+            await row.delete(using_db=connection)
 
     @classmethod
-    async def raw_sql(cls, query, connection="default"):
+    @timed_query("raw_sql")
+    async def raw_sql(cls, query, values=None, connection="default", read_only=False, customer_xid=None,
+                      primary=False):
         """
-        :param query: contains raw sql query which have to be executed
-        :param connection: connection on which raw sql will be run
-        :return:
+        :param query: contains raw sql query which have to be executed,
+        parameters are written postgres style ($1, $2 ...)
+        :param values: list of values for the query parameters
+        :param connection: connection name on which raw sql will be run,
+        or an already acquired connection (e.g. of an open transaction).
+        The default one stands for the shard of customer_xid.
+        :param read_only: the query only reads, it may run on a replica
+        of the shard
+        :param customer_xid: owner of the rows, picks the shard and keeps
+        a read only query on the primary right after that customer wrote
+        :param primary: keep a read only query on the primary
+        :return: list of rows as dicts
         """
-        conn = Tortoise.get_connection(connection)
-        result = await conn.execute_query_dict(query)
+        return await cls._route_sql(cls._execute_raw_sql, query, values, connection, read_only, customer_xid,
+                                    primary)
+
+    @classmethod
+    @timed_query("prepared_sql")
+    async def prepared_sql(cls, query, values=None, connection="default", read_only=False, customer_xid=None,
+                           primary=False):
+        """
+        Same as raw_sql, for the hot queries. On postgres with the fast
+        path on, the query runs as a named prepared statement (see
+        PreparedStatements) and the rows are asyncpg records, read them
+        like dicts (row["id"], row.get("id"), dict(row)) but don't
+        modify them. Otherwise it is raw_sql.
+        :return: list of rows
+        """
+        return await cls._route_sql(cls._execute_prepared_sql, query, values, connection, read_only, customer_xid,
+                                    primary)
+
+    @classmethod
+    async def _route_sql(cls, execute, query, values, connection, read_only, customer_xid, primary):
+        if not isinstance(connection, str):
+            return await execute(connection, query, values)
+        if connection == ReplicaConstant.PRIMARY.value:
+            connection = shard_map.connection_name(customer_xid, write=not read_only)
+        if read_only:
+            return await cls._read(lambda conn: execute(conn, query, values), customer_xid,
+                                   primary=primary, shard=connection)
+        return await execute(Tortoise.get_connection(connection), query, values)
+
+    @classmethod
+    async def _execute_raw_sql(cls, conn, query, values):
+        if values and conn.capabilities.dialect == "sqlite":
+            # sqlite (local setups) numbers its parameters as ?1, ?2 ...
+            query = re.sub(r"\$(\d+)", r"?\1", query)
+        if query_profiler.enabled:
+            query_profiler.set_statement(query, values)
+        result = await conn.execute_query_dict(query, values)
         return result
 
     @classmethod
+    async def _execute_prepared_sql(cls, conn, query, values):
+        if not prepared_statements.active(conn):
+            return await cls._execute_raw_sql(conn, query, values)
+        if query_profiler.enabled:
+            query_profiler.set_statement(query, values)
+        return await prepared_statements.fetch(conn, query, values)
+
+    @classmethod
+    async def stream_raw_sql(cls, query, values=None, chunk_size=ORMConstant.STREAM_CHUNK_SIZE.value,
+                             connection="default"):
+        """
+        :param query: raw sql query, parameters written postgres style ($1, $2 ...)
+        :param values: list of values for the query parameters
+        :param chunk_size: rows fetched from the database per round trip
+        :param connection: connection name on which the query will be run
+        :return: async generator of lists of rows as dicts, read through a
+        server side cursor so memory stays bounded by chunk_size
+        """
+        values = values or []
+        conn = Tortoise.get_connection(connection)
+        if conn.capabilities.dialect == "postgres":
+            async with conn.acquire_connection() as raw_connection:
+                # postgres cursors only live inside a transaction
+                async with raw_connection.transaction(readonly=True):
+                    cursor = await raw_connection.cursor(query, *values)
+                    while True:
+                        rows = await cursor.fetch(chunk_size)
+                        if not rows:
+                            break
+                        yield [dict(row) for row in rows]
+        else:
+            query = re.sub(r"\$(\d+)", r"?\1", query)
+            async with conn.acquire_connection() as raw_connection:
+                async with raw_connection.execute(query, values) as cursor:
+                    while True:
+                        rows = await cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield [dict(row) for row in rows]
+
+    @classmethod
+    def in_transaction(cls, connection="default", customer_xid=None):
+        """
+        :param connection: connection name on which transaction will be
+        opened, the default one stands for the shard of customer_xid
+        :param customer_xid: owner of the rows written
+        :return: async context manager yielding the transaction connection,
+        pass it as connection to raw_sql to run statements inside it
+        """
+        if connection == ReplicaConstant.PRIMARY.value:
+            connection = shard_map.connection_name(customer_xid, write=True)
+        return in_transaction(connection)
+
+    @classmethod
+    @timed_query("get_by_filters_count")
     async def get_by_filters_count(
-            cls, model, filters, order_by=None, limit=None, offset=None
+            cls, model, filters, order_by=None, limit=None, offset=None, customer_xid=None, primary=False,
+            shard=None
     ):
         """
+        Read only, may run on a replica, see ReplicaRouter.
         :param model: database model class
         :param filters: where conditions for filter
         :param order_by: for ordering on queryset
         :param limit: limit queryset result
         :param offset: offset queryset results
+        :param customer_xid: owner of the rows, picks the shard read and
+        keeps the read on the primary right after that customer wrote
+        :param primary: always read from the primary
+        :param shard: connection name of the shard primary to read,
+        when the rows can't be told by customer_xid
         :return: list of model objects returned by the where clause
         """
         queryset = model.filter(**filters)
@@ -143,14 +369,163 @@ class ORMWrapper:
         if offset:
             queryset = queryset.offset(offset)
 
-        return await queryset.count()
+        if query_profiler.enabled:
+            query_profiler.set_statement(queryset.count().sql())
+        # count and values queries can't be rebound, the queryset can
+        return await cls._read(lambda connection: queryset.using_db(connection).count(), customer_xid, primary, shard)
 
     @classmethod
-    async def get_values_by_filters(cls, model, filters, columns):
+    @timed_query("get_values_by_filters")
+    async def get_values_by_filters(cls, model, filters, columns, customer_xid=None, primary=False, shard=None):
         """
+        Read only, may run on a replica, see ReplicaRouter.
         :param model: model object
         :param filters: where conditions for filter
         :param columns: list of columns ['patient_id', 'prescription_id']
+        :param customer_xid: owner of the rows, picks the shard read and
+        keeps the read on the primary right after that customer wrote
+        :param primary: always read from the primary
+        :param shard: connection name of the shard primary to read,
+        when the rows can't be told by customer_xid
+        """
+        queryset = model.filter(**filters)
+        if query_profiler.enabled:
+            query_profiler.set_statement(queryset.values(*columns).sql())
+        return await cls._read(lambda connection: queryset.using_db(connection).values(*columns), customer_xid,
+                               primary, shard)
+
+    @classmethod
+    async def _read(cls, bind, customer_xid=None, primary=False, shard=None):
+        """
+        Runs a read on the shard of customer_xid, on the connection picked
+        by replica_router. A replica that fails it with a connection
+        error (REPLICA_FAILURES) is marked down and the read
+        moves on to the next connection, the primary being the last
+        resort. Other errors are raised as is.
+        :param bind: function(connection) -> awaitable running the read
+        :param customer_xid: owner of the rows read, if known
+        :param primary: skip the replicas
+        :param shard: connection name of the shard primary, by default
+        the shard of customer_xid
+        """
+        shard = shard or shard_map.connection_name(customer_xid)
+        if primary:
+            return await bind(Tortoise.get_connection(shard))
+        while True:
+            connection_name = replica_router.read_connection(customer_xid, shard)
+            if connection_name == shard:
+                return await bind(Tortoise.get_connection(connection_name))
+            try:
+                return await bind(Tortoise.get_connection(connection_name))
+            except REPLICA_FAILURES as ex:
+                replica_router.mark_down(connection_name, ex)
+
+
+class BatchLoader:
+    """
+        DataLoader style coalescing of ORMWrapper.load_by_key. Lookups
+        made in the same event loop tick for the same model, key field,
+        columns and connection are queued and run on the next tick as one
+        WHERE key_field IN (...) query, lookups of the same key in that
+        tick share one result. A lookup never joins a query already sent,
+        which may have been read before a write the caller has seen.
+        The rows (model objects or dicts) of a key are shared by its
+        lookups and must not be modified.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_batch_keys = ORMConstant.MAX_BATCH_KEYS.value
+        # (event loop, model, key field, fields, primary, shard) -> {key: future}
+        self._batches = {}
+        self._tasks = set()
+        self.lookups = 0
+        self.shared_lookups = 0
+        self.queries = 0
+
+    def configure(self, enabled=False, max_batch_keys=ORMConstant.MAX_BATCH_KEYS.value):
+        self.enabled = enabled
+        self.max_batch_keys = max_batch_keys
+
+    async def load(self, model, key_field, key, fields, primary, shard):
         """
-        queryset = await model.filter(**filters).values(*columns)
-        return queryset
+            :return: list of the rows of model having key_field == key
+        """
+        loop = asyncio.get_running_loop()
+        batch_key = (loop, model, key_field, tuple(fields) if fields else None, primary, shard)
+        self.lookups += 1
+        batch = self._batches.get(batch_key)
+        if batch is None:
+            batch = self._batches[batch_key] = {}
+            loop.call_soon(self._dispatch, batch_key)
+        future = batch.get(key)
+        if future is None:
+            future = batch[key] = loop.create_future()
+        else:
+            self.shared_lookups += 1
+        # a cancelled lookup must not cancel the others sharing the future
+        rows = await asyncio.shield(future)
+        return list(rows)
+
+    def _dispatch(self, batch_key):
+        batch = self._batches.pop(batch_key)
+        task = asyncio.ensure_future(self._run(batch_key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch_key, batch):
+        _, model, key_field, fields, primary, shard = batch_key
+        keys = list(batch)
+        try:
+            for start in range(0, len(keys), self.max_batch_keys):
+                chunk = keys[start:start + self.max_batch_keys]
+                self.queries += 1
+                try:
+                    rows = await ORMWrapper.get_by_keys(model, key_field, chunk, fields, primary, shard)
+                except Exception as ex:
+                    for key in chunk:
+                        _resolve(batch[key], exception=ex)
+                    continue
+                rows_by_key = {key: [] for key in chunk}
+                for row in rows:
+                    key = row[key_field] if fields else getattr(row, key_field)
+                    rows_by_key.setdefault(key, []).append(row)
+                for key in chunk:
+                    _resolve(batch[key], rows_by_key[key])
+        finally:
+            for future in batch.values():
+                _resolve(future, exception=asyncio.CancelledError())
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "shared_lookups": self.shared_lookups,
+            "queries": self.queries,
+            "pending_batches": len(self._batches),
+            "running_queries": len(self._tasks),
+        }
+
+
+@lru_cache(maxsize=None)
+def _keys_query(model, key_field, columns):
+    """
+        get_by_keys as one postgres statement, the keys passed as a single
+        array parameter so every batch size shares the prepared statement.
+    """
+    projection = model._meta.fields_db_projection
+    select = ", ".join(f'"{projection[column]}" AS "{column}"' for column in columns)
+    return f'SELECT {select} FROM "{model._meta.db_table}" WHERE "{projection[key_field]}" = ANY($1)'
+
+
+def _resolve(future, rows=None, exception=None):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+        # every lookup of the key may have been cancelled, nobody retrieves it then
+        future.add_done_callback(lambda done: done.exception())
+    else:
+        future.set_result(rows)
+
+
+batch_loader = BatchLoader()
@@ -0,0 +1,292 @@
+import asyncio
+import os
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
+import ujson
+from sanic.log import logger
+from tortoise import Tortoise
+
+from constants.queries import IN_LIST, OUTBOX_CLAIM, OUTBOX_DELETE, OUTBOX_FROM_TRANSACTIONS, OUTBOX_RELEASE
+from managers.helpers import list_parameter
+from managers.orm_wrappers import ORMWrapper
+from managers.shards import shard_map
+
+
+class OutboxConstant(Enum):
+    SINK = "file"
+    SINK_PATH = "wallet_events.jsonl"
+    BATCH_SIZE = 500
+    POLL_INTERVAL_MS = 200
+    BACKOFF_MIN_MS = 100
+    BACKOFF_MAX_MS = 30000
+    SINK_TIMEOUT_S = 5
+    # how long a claimed batch is left to its publisher, longer than the
+    # sink timeout so it is never sent by two publishers at once
+    LEASE_S = 30
+    SINK_ACK = b"ok"
+    EVENT_FIELDS = ("transaction_id", "customer_xid", "transaction_type", "amount", "final_amount",
+                    "transaction_to", "reference_id", "transaction_time")
+
+
+class FileSink:
+    """
+        Appends the events as json lines to a local file, a batch counts
+        as delivered once it is fsynced.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def send(self, events: list):
+        lines = "".join(ujson.dumps(event) + "\n" for event in events)
+        await asyncio.get_running_loop().run_in_executor(None, self._append, lines)
+
+    def _append(self, lines):
+        # runs in the default executor
+        with open(self.path, "a") as events_file:
+            events_file.write(lines)
+            events_file.flush()
+            os.fsync(events_file.fileno())
+
+    async def close(self):
+        pass
+
+
+class UnixSocketSink:
+    """
+        Streams the events as json lines to a unix socket server, every
+        batch ended by an empty line, which the server answers with one
+        "ok" line once it took the batch over (see tools/outbox_listen.py).
+        The connection is kept open between batches and reopened after a
+        failure.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader = None
+        self._writer = None
+
+    async def send(self, events: list):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        try:
+            self._writer.write("".join(ujson.dumps(event) + "\n" for event in events).encode() + b"\n")
+            await self._writer.drain()
+            ack = await self._reader.readline()
+            if ack.strip() != OutboxConstant.SINK_ACK.value:
+                raise ConnectionError(f"outbox sink answered {ack!r}")
+        except BaseException:
+            # the stream may be mid batch, start over on a new connection
+            await self.close()
+            raise
+
+    async def close(self):
+        if self._writer is None:
+            return
+        writer, self._reader, self._writer = self._writer, None, None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+# sink names of the OUTBOX config, any object with async send(events) and
+# close() can be passed to OutboxPublisher.configure
+SINKS = {
+    "file": FileSink,
+    "unix_socket": UnixSocketSink,
+}
+
+
+def build_sink(name: str, path: str):
+    if name not in SINKS:
+        raise ValueError(f"unknown outbox sink {name}, expected one of {', '.join(SINKS)}")
+    return SINKS[name](path)
+
+
+def _utc(value):
+    # raw sql on sqlite hands timestamps back as (UTC) strings
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def _event(row):
+    event = {field: row[field] for field in OutboxConstant.EVENT_FIELDS.value}
+    event["event_id"] = row["id"]
+    event["transaction_time"] = _utc(event["transaction_time"]).isoformat()
+    return event
+
+
+class OutboxPublisher:
+    """
+        Transactional outbox of the ledger. Every ledger row is queued in
+        wallet_outbox by the statement (or transaction) inserting it, so
+        an event exists if and only if its transaction committed. A
+        background task per worker drains the outbox of every shard in
+        batches of BATCH_SIZE, oldest first, into the sink. A batch is
+        claimed by setting its lease (leased_until) in one statement, sent
+        with no transaction open, and deleted by a second statement once
+        the sink took it; a batch the sink refused is handed back.
+
+        Delivery is at least once: a worker dying between the sink and the
+        delete leaves the batch to be claimed again once its LEASE_S runs
+        out, consumers dedupe by event_id (or transaction_id). Workers
+        claim batches side by side, so events of different batches may
+        arrive out of order. A failing sink or database is retried with
+        exponential backoff from BACKOFF_MIN_MS to BACKOFF_MAX_MS.
+        lag_ms is the age of the oldest event of the last batch read,
+        0 once the outbox is drained.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sink = None
+        self.batch_size = OutboxConstant.BATCH_SIZE.value
+        self.poll_interval = OutboxConstant.POLL_INTERVAL_MS.value / 1000
+        self.backoff_min = OutboxConstant.BACKOFF_MIN_MS.value / 1000
+        self.backoff_max = OutboxConstant.BACKOFF_MAX_MS.value / 1000
+        self.sink_timeout = OutboxConstant.SINK_TIMEOUT_S.value
+        self.lease = timedelta(seconds=OutboxConstant.LEASE_S.value)
+        self._task = None
+        self._lag = {}
+        self.published = 0
+        self.batches = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.backoff = 0
+        self.last_published_at = None
+
+    def configure(self, enabled=False, sink=None, batch_size=OutboxConstant.BATCH_SIZE.value,
+                  poll_interval_ms=OutboxConstant.POLL_INTERVAL_MS.value,
+                  backoff_min_ms=OutboxConstant.BACKOFF_MIN_MS.value,
+                  backoff_max_ms=OutboxConstant.BACKOFF_MAX_MS.value,
+                  sink_timeout_s=OutboxConstant.SINK_TIMEOUT_S.value, lease_s=OutboxConstant.LEASE_S.value):
+        """
+            :param enabled: queue an event with every ledger row and
+            publish them
+            :param sink: object with async send(events) and close(), see
+            build_sink
+            :param lease_s: lease of a claimed batch, longer than
+            sink_timeout_s
+        """
+        if lease_s <= sink_timeout_s:
+            raise ValueError("outbox LEASE_S should be longer than SINK_TIMEOUT_S")
+        self.enabled = enabled
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval_ms / 1000
+        self.backoff_min = backoff_min_ms / 1000
+        self.backoff_max = backoff_max_ms / 1000
+        self.sink_timeout = sink_timeout_s
+        self.lease = timedelta(seconds=lease_s)
+
+    def start(self):
+        """
+            Starts the publisher if enabled, to be called once the loop is
+            running.
+        """
+        if self.enabled and self.sink is not None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # a batch being sent is claimed again once its lease ran out
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.sink.close()
+
+    async def _run(self):
+        while True:
+            try:
+                backlog = await self.publish_once()
+            except Exception as ex:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.backoff = min(self.backoff_max, self.backoff_min * 2 ** (self.consecutive_failures - 1))
+                logger.warning("outbox publish failed, retrying in %.1fs: %r", self.backoff, ex)
+                await asyncio.sleep(self.backoff)
+                continue
+            self.consecutive_failures = 0
+            self.backoff = 0
+            # straight on while there is a backlog
+            await asyncio.sleep(0 if backlog else self.poll_interval)
+
+    async def publish_once(self):
+        """
+            Publishes one batch of every shard.
+            :return: True if a shard had a full batch, more may be queued
+        """
+        backlog = False
+        for shard in shard_map.shards:
+            backlog = await self._publish_batch(shard) == self.batch_size or backlog
+        return backlog
+
+    async def _publish_batch(self, shard):
+        dialect = Tortoise.get_connection(shard).capabilities.dialect
+        now = datetime.now(timezone.utc)
+        lock = "FOR UPDATE SKIP LOCKED" if dialect == "postgres" else ""
+        rows = await ORMWrapper.raw_sql(OUTBOX_CLAIM.format(lock=lock), [self.batch_size, now + self.lease, now],
+                                        connection=shard)
+        if not rows:
+            self._lag[shard] = 0
+            return 0
+
+        # RETURNING keeps no order
+        rows.sort(key=lambda row: row["id"])
+        self._lag[shard] = (now - _utc(rows[0]["created_at"])).total_seconds() * 1000
+        by_id = IN_LIST[dialect].format(column="id")
+        ids = [list_parameter([row["id"] for row in rows], dialect)]
+        try:
+            await asyncio.wait_for(self.sink.send([_event(row) for row in rows]), self.sink_timeout)
+        except Exception:
+            # hand the batch back now rather than once the lease runs out
+            with suppress(Exception):
+                await ORMWrapper.raw_sql(OUTBOX_RELEASE.format(ids=by_id), ids, connection=shard)
+            raise
+        await ORMWrapper.raw_sql(OUTBOX_DELETE.format(ids=by_id), ids, connection=shard)
+
+        self.published += len(rows)
+        self.batches += 1
+        self.last_published_at = time.time()
+        return len(rows)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "published": self.published,
+            "batches": self.batches,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "backoff_ms": self.backoff * 1000,
+            "lag_ms": max(self._lag.values(), default=0),
+            "since_last_publish_ms": (time.time() - self.last_published_at) * 1000
+            if self.last_published_at else 0,
+        }
+
+
+async def add_outbox_events(reference_ids: list, connection):
+    """
+        Queues the ledger rows of reference_ids as outbox events, to be
+        run in the transaction that inserted them (the postgres single
+        statement paths queue theirs with OUTBOX_INSERTED instead).
+        Nothing is queued with the outbox off.
+        :param connection: connection of that transaction
+    """
+    if not outbox_publisher.enabled or not reference_ids:
+        return
+    dialect = connection.capabilities.dialect
+    query = OUTBOX_FROM_TRANSACTIONS.format(reference_ids=IN_LIST[dialect].format(column="reference_id"))
+    await ORMWrapper.raw_sql(query, [list_parameter(reference_ids, dialect)], connection)
+
+
+outbox_publisher = OutboxPublisher()
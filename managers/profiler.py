@@ -0,0 +1,121 @@
+import asyncio
+import random
+from contextvars import ContextVar
+from enum import Enum
+
+import ujson
+from sanic.log import logger
+from tortoise import Tortoise
+
+
+class ProfilerConstant(Enum):
+    SLOW_QUERY_MS = 100
+    EXPLAIN_SAMPLE_RATE = 0.0
+    EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS) "
+
+
+class QueryProfiler:
+    """
+        Opt-in profiling of ORMWrapper calls. When enabled it logs every
+        call slower than the threshold with its sql, parameters and the
+        route being served, runs EXPLAIN (ANALYZE, BUFFERS) in the
+        background for a sample of slow selects, and flags identical
+        queries repeated while serving one request.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_query_seconds = ProfilerConstant.SLOW_QUERY_MS.value / 1000
+        self.explain_sample_rate = ProfilerConstant.EXPLAIN_SAMPLE_RATE.value
+        # (sql, parameters) of the query an ORMWrapper call is about to run
+        self.statement = ContextVar("profiled_statement", default=None)
+        # route and query counts of the request being served
+        self.request_state = ContextVar("profiled_request", default=None)
+        self._explain_tasks = set()
+        self.slow_queries = 0
+        self.repeated_queries = 0
+        self.explained_queries = 0
+
+    def configure(self, enabled=False, slow_query_ms=ProfilerConstant.SLOW_QUERY_MS.value,
+                  explain_sample_rate=ProfilerConstant.EXPLAIN_SAMPLE_RATE.value):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.explain_sample_rate = explain_sample_rate
+
+    def start_request(self, route):
+        if self.enabled:
+            self.request_state.set({"route": route, "queries": {}})
+
+    def set_statement(self, sql, parameters=None):
+        """
+            Called by ORMWrapper right before running a query it knows the
+            sql of, only when profiling is enabled.
+        """
+        self.statement.set((sql, parameters))
+
+    def observe(self, operation, model, seconds, call_arguments):
+        """
+            :param operation: ORMWrapper method name
+            :param model: model name, "raw" for raw sql
+            :param seconds: duration of the call
+            :param call_arguments: arguments of the call, described when
+            the sql of the call isn't known
+        """
+        statement = self.statement.get()
+        self.statement.set(None)
+        if statement is None:
+            statement = (f"{operation} {model}", call_arguments)
+        sql, parameters = statement
+        sql = " ".join(sql.split())
+        parameters = list(parameters) if isinstance(parameters, (list, tuple)) else parameters
+
+        request_state = self.request_state.get()
+        route = request_state["route"] if request_state else None
+        if request_state is not None:
+            key = (sql, repr(parameters))
+            count = request_state["queries"].get(key, 0) + 1
+            request_state["queries"][key] = count
+            if count == 2:
+                self.repeated_queries += 1
+                logger.warning("repeated query %s", ujson.dumps({
+                    "route": route, "operation": operation, "model": model,
+                    "sql": sql, "parameters": parameters,
+                }, default=str))
+
+        if seconds < self.slow_query_seconds:
+            return
+        self.slow_queries += 1
+        logger.warning("slow query %s", ujson.dumps({
+            "route": route, "operation": operation, "model": model, "duration_ms": round(seconds * 1000, 3),
+            "sql": sql, "parameters": parameters,
+        }, default=str))
+
+        if (self.explain_sample_rate and sql.lstrip().lower().startswith("select")
+                and random.random() < self.explain_sample_rate):
+            task = asyncio.ensure_future(self._explain(sql, parameters if isinstance(parameters, list) else None))
+            self._explain_tasks.add(task)
+            task.add_done_callback(self._explain_tasks.discard)
+
+    async def _explain(self, sql, parameters):
+        connection = Tortoise.get_connection("default")
+        if connection.capabilities.dialect != "postgres":
+            return
+        try:
+            rows = await connection.execute_query_dict(ProfilerConstant.EXPLAIN_PREFIX.value + sql, parameters)
+        except Exception as ex:
+            logger.warning("explain failed for %s: %s", sql, ex)
+            return
+        self.explained_queries += 1
+        plan = "\n".join(str(next(iter(row.values()))) for row in rows)
+        logger.warning("query plan for %s\n%s", sql, plan)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "slow_queries": self.slow_queries,
+            "repeated_queries": self.repeated_queries,
+            "explained_queries": self.explained_queries,
+        }
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import time
+from enum import Enum
+
+from sanic.log import logger
+from tortoise.exceptions import DBConnectionError
+
+from managers.cache import MISSING, TTLCache
+
+try:
+    import asyncpg
+except ImportError:  # sqlite only setups
+    asyncpg = None
+
+
+class ReplicaConstant(Enum):
+    PRIMARY = "default"
+    CONNECTION_PREFIX = "replica_"
+    READ_YOUR_WRITES_MS = 1000
+    FAILOVER_COOLDOWN_S = 30
+    MAX_TRACKED_CUSTOMERS = 100000
+
+
+# connection level errors, telling a replica is unreachable. Tortoise
+# raises bad queries and bad parameters as OperationalError (every error
+# on sqlite), those fail the same on every connection and are left out
+REPLICA_FAILURES = (DBConnectionError, OSError, asyncio.TimeoutError)
+if asyncpg is not None:
+    REPLICA_FAILURES += (asyncpg.PostgresConnectionError, asyncpg.InterfaceError)
+
+
+class ReplicaRouter:
+    """
+        Picks the connection ORMWrapper runs a read-only query on.
+        Reads go round robin to the healthy replicas, except for a
+        customer who wrote through this worker within the read-your-writes
+        window, whose reads stay on the primary until the replicas have
+        caught up. A replica that fails a read is taken out for a cooldown
+        and the read is retried on the next connection, the primary last.
+        With no replicas configured every read goes to the primary.
+        Each shard (see ShardMap) has its own primary and replicas.
+    """
+
+    def __init__(self):
+        self.replicas = {}
+        self.failover_cooldown = ReplicaConstant.FAILOVER_COOLDOWN_S.value
+        self._recent_writes = TTLCache(
+            max_size=ReplicaConstant.MAX_TRACKED_CUSTOMERS.value,
+            ttl=ReplicaConstant.READ_YOUR_WRITES_MS.value / 1000
+        )
+        self._down_until = {}
+        self._next_replica = {}
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.pinned_reads = 0
+        self.failovers = 0
+
+    @property
+    def enabled(self):
+        return any(self.replicas.values())
+
+    def configure(self, replicas=None, read_your_writes_ms=ReplicaConstant.READ_YOUR_WRITES_MS.value,
+                  failover_cooldown_s=ReplicaConstant.FAILOVER_COOLDOWN_S.value):
+        """
+            :param replicas: {primary connection name: connection names of
+            its replicas}
+            :param read_your_writes_ms: how long reads of a customer stay
+            on the primary after it wrote, above the replication lag
+            :param failover_cooldown_s: how long a failed replica is skipped
+        """
+        self.replicas = {primary: list(names) for primary, names in (replicas or {}).items()}
+        self._next_replica = {primary: itertools.cycle(names) for primary, names in self.replicas.items()}
+        self._recent_writes = TTLCache(
+            max_size=ReplicaConstant.MAX_TRACKED_CUSTOMERS.value, ttl=read_your_writes_ms / 1000
+        )
+        self.failover_cooldown = failover_cooldown_s
+
+    def record_write(self, *customer_xids):
+        """
+            Pins the reads of these customers to the primary for the
+            read-your-writes window.
+        """
+        if self.enabled:
+            for customer_xid in customer_xids:
+                self._recent_writes.set(customer_xid, True)
+
+    def pinned(self, customer_xid):
+        """
+            :return: True while reads of customer_xid stay on the primary
+        """
+        return customer_xid is not None and self.enabled and self._recent_writes.get(customer_xid) is not MISSING
+
+    def read_connection(self, customer_xid=None, primary=ReplicaConstant.PRIMARY.value):
+        """
+            :param customer_xid: owner of the rows read, if known
+            :param primary: connection name of the primary of the shard read
+            :return: name of the connection to read from
+        """
+        replicas = self.replicas.get(primary)
+        if not replicas:
+            self.primary_reads += 1
+            return primary
+        if customer_xid is not None and self._recent_writes.get(customer_xid) is not MISSING:
+            self.pinned_reads += 1
+            return primary
+
+        now = time.monotonic()
+        for _ in range(len(replicas)):
+            replica = next(self._next_replica[primary])
+            if self._down_until.get(replica, 0) <= now:
+                self.replica_reads += 1
+                return replica
+        self.primary_reads += 1
+        return primary
+
+    def mark_down(self, replica, error):
+        self.failovers += 1
+        self._down_until[replica] = time.monotonic() + self.failover_cooldown
+        logger.warning("replica %s failed a read, skipped for %ss: %r", replica, self.failover_cooldown, error)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "replicas": sum(len(names) for names in self.replicas.values()),
+            "replicas_down": sum(1 for until in self._down_until.values() if until > now),
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "pinned_reads": self.pinned_reads,
+            "failovers": self.failovers,
+        }
+
+
+replica_router = ReplicaRouter()
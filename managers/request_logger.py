@@ -0,0 +1,206 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime
+from enum import Enum
+
+import ujson
+
+
+class RequestLogConstant(Enum):
+    PATH = "request.log"
+    FORMAT = "json"
+    SAMPLE_RATE = 1.0
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL_MS = 1000
+    MAX_FILE_BYTES = 50 * 1024 * 1024
+    BACKUP_COUNT = 5
+    REDACTED_HEADERS = ("authorization", "cookie", "proxy-authorization")
+
+
+class RequestLogger:
+    """
+        Request logging off the hot path. log() only samples the request
+        and puts a small record on a bounded queue, it never blocks and
+        drops the record when the queue is full. One long lived writer
+        task formats records in batches and appends them to the log file
+        with a single write per batch, rotating the file by size.
+    """
+
+    def __init__(self):
+        self.path = RequestLogConstant.PATH.value
+        self.format = RequestLogConstant.FORMAT.value
+        self.sample_rate = RequestLogConstant.SAMPLE_RATE.value
+        self.batch_size = RequestLogConstant.BATCH_SIZE.value
+        self.flush_interval = RequestLogConstant.FLUSH_INTERVAL_MS.value / 1000
+        self.max_file_bytes = RequestLogConstant.MAX_FILE_BYTES.value
+        self.backup_count = RequestLogConstant.BACKUP_COUNT.value
+        self.queue_size = RequestLogConstant.QUEUE_SIZE.value
+        self._queue = None
+        self._writer_task = None
+        self._file = None
+        self.logged = 0
+        self.dropped = 0
+        self.written = 0
+
+    def configure(self, path=RequestLogConstant.PATH.value, log_format=RequestLogConstant.FORMAT.value,
+                  sample_rate=RequestLogConstant.SAMPLE_RATE.value, queue_size=RequestLogConstant.QUEUE_SIZE.value,
+                  batch_size=RequestLogConstant.BATCH_SIZE.value,
+                  flush_interval_ms=RequestLogConstant.FLUSH_INTERVAL_MS.value,
+                  max_file_bytes=RequestLogConstant.MAX_FILE_BYTES.value,
+                  backup_count=RequestLogConstant.BACKUP_COUNT.value):
+        self.path = path
+        self.format = log_format
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_file_bytes = max_file_bytes
+        self.backup_count = backup_count
+
+    def start(self):
+        """
+            Starts the writer task, to be called once the loop is running.
+        """
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._writer_task = asyncio.ensure_future(self._writer())
+
+    async def stop(self):
+        """
+            Stops the writer task, flushing whatever is still queued.
+        """
+        if self._writer_task is None:
+            return
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def log(self, request):
+        """
+            Queues a record of the request, never blocks.
+        """
+        if self._queue is None:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        try:
+            data = request.json
+        except Exception:
+            data = None
+        record = (
+            time.time(),
+            request.method,
+            request.headers.get("Host"),
+            request.url,
+            dict(request.headers),
+            data,
+        )
+        try:
+            self._queue.put_nowait(record)
+            self.logged += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        writing = None
+        try:
+            while True:
+                # wait for the first record, then fill the batch until it is
+                # full or the flush interval is over
+                batch.append(await self._queue.get())
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # shielded, cancelling the task must not drop the future of a
+                # write the executor thread carries on with
+                writing = loop.run_in_executor(None, self._write, batch)
+                await asyncio.shield(writing)
+                writing = None
+                batch = []
+        except asyncio.CancelledError:
+            remaining = batch
+            if writing is not None:
+                # let the thread finish its batch before the file is written
+                # again or closed
+                remaining = []
+                await writing
+            while not self._queue.empty():
+                remaining.append(self._queue.get_nowait())
+            if remaining:
+                self._write(remaining)
+            raise
+
+    def _format(self, record):
+        logged_at, method, host, url, headers, data = record
+        for header in headers:
+            if header.lower() in RequestLogConstant.REDACTED_HEADERS.value:
+                headers[header] = "[REDACTED]"
+        logged_at = datetime.fromtimestamp(logged_at)
+
+        if self.format == "json":
+            return ujson.dumps({
+                "time": logged_at.isoformat(),
+                "method": method,
+                "host": host,
+                "url": url,
+                "headers": headers,
+                "data": data,
+            }, default=str) + "\n"
+
+        return (f"Request method: {method}\n"
+                f"Request Host: {host}\n"
+                f"Request URL: {url}\n"
+                f"Request headers: {headers}\n"
+                f"Request data: {data}\n"
+                f"Request time: {logged_at}\n\n")
+
+    def _write(self, batch):
+        # runs in the default executor, one thread hop per batch
+        payload = "".join(self._format(record) for record in batch)
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(payload)
+        self._file.flush()
+        self.written += len(batch)
+        if self.max_file_bytes and self._file.tell() >= self.max_file_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "logged": self.logged,
+            "dropped": self.dropped,
+            "written": self.written,
+        }
+
+
+request_logger = RequestLogger()
@@ -0,0 +1,99 @@
+from datetime import date, datetime, timedelta, timezone
+from enum import Enum
+
+from tortoise import Tortoise
+
+from constants.enums import TransactionStatus
+from constants.queries import ADD_DAILY_SUMMARY, BACKFILL_DAILY_SUMMARY, DAILY_SUMMARY_RANGE, \
+    DAILY_SUMMARY_COUNTERS, TRANSACTION_DAY
+from managers.orm_wrappers import ORMWrapper
+
+
+class RollupConstant(Enum):
+    DEFAULT_DAYS = 30
+    MAX_DAYS = 366
+    # counter position in DAILY_SUMMARY_COUNTERS per transaction type, anything
+    # else (older withdrawals have no type) counts as a withdrawal
+    COUNTER_INDEX = {
+        TransactionStatus.DEPOSIT.value: 0,
+        TransactionStatus.TRANSFER_IN.value: 4,
+        TransactionStatus.TRANSFER_OUT.value: 6,
+    }
+    WITHDRAWAL_INDEX = 2
+
+
+def _utc_day(transaction_time):
+    # raw sql on sqlite hands timestamps back as strings
+    if isinstance(transaction_time, str):
+        transaction_time = datetime.fromisoformat(transaction_time)
+    if transaction_time.tzinfo is not None:
+        transaction_time = transaction_time.astimezone(timezone.utc)
+    return transaction_time.date()
+
+
+def daily_totals(customer_xid: str, transactions: list, day: date = None):
+    """
+        Rolls transactions of one customer up per day.
+        :param transactions: dicts with amount, transaction_type and
+        final_amount, in the order they were applied
+        :param day: day of all the transactions, read from their
+        transaction_time if None
+        :return: list of ADD_DAILY_SUMMARY parameters, one per day
+    """
+    totals = {}
+    for transaction in transactions:
+        transaction_day = day or _utc_day(transaction["transaction_time"])
+        row = totals.setdefault(transaction_day, [0] * len(DAILY_SUMMARY_COUNTERS) + [None])
+        index = RollupConstant.COUNTER_INDEX.value.get(
+            transaction["transaction_type"], RollupConstant.WITHDRAWAL_INDEX.value
+        )
+        row[index] += 1
+        row[index + 1] += transaction["amount"]
+        row[-1] = transaction["final_amount"]
+    return [[customer_xid, transaction_day, *row] for transaction_day, row in totals.items()]
+
+
+async def add_daily_summary(customer_xid: str, transactions: list, connection, day: date = None):
+    """
+        Adds freshly inserted transactions to the daily summary of their
+        wallet, to be run in the transaction that inserted them.
+        :param connection: connection of that transaction
+    """
+    for values in daily_totals(customer_xid, transactions, day):
+        await ORMWrapper.raw_sql(ADD_DAILY_SUMMARY, values, connection)
+
+
+async def backfill_daily_summary(customer_xid: str, before: date, connection="default"):
+    """
+        Rebuilds the daily summary of a wallet from its transactions, for
+        the days before `before`. Days still taking transactions are kept
+        up to date by the ledger, rebuilding one of them could overwrite
+        a concurrent update.
+        :param connection: open transaction or connection name, the
+        shard of customer_xid by default
+    """
+    dialect = Tortoise.get_connection("default").capabilities.dialect
+    query = BACKFILL_DAILY_SUMMARY.format(day=TRANSACTION_DAY[dialect])
+    await ORMWrapper.raw_sql(query, [customer_xid, before], connection, customer_xid=customer_xid)
+
+
+async def get_daily_summary(customer_xid: str, first_day: date = None, last_day: date = None):
+    """
+        :param customer_xid: owner of the wallet
+        :param first_day: first day, DEFAULT_DAYS before last_day if None
+        :param last_day: last day (inclusive), today (UTC) if None
+        :return: (daily summary rows, days without transactions left
+        out, meta with the range and the totals over it)
+    """
+    last_day = last_day or datetime.now(timezone.utc).date()
+    first_day = first_day or last_day - timedelta(days=RollupConstant.DEFAULT_DAYS.value - 1)
+    if first_day > last_day:
+        raise ValueError("from should not be after to!")
+    if (last_day - first_day).days >= RollupConstant.MAX_DAYS.value:
+        raise ValueError(f"Range can be at most {RollupConstant.MAX_DAYS.value} days!")
+
+    rows = await ORMWrapper.raw_sql(DAILY_SUMMARY_RANGE, [customer_xid, first_day, last_day], read_only=True,
+                                    customer_xid=customer_xid)
+    totals = {counter: sum(row[counter] for row in rows) for counter in DAILY_SUMMARY_COUNTERS}
+    totals["closing_balance"] = rows[-1]["closing_balance"] if rows else None
+    return rows, {"from": first_day.isoformat(), "to": last_day.isoformat(), "totals": totals}
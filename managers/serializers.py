@@ -0,0 +1,86 @@
+from datetime import datetime, date, time
+from uuid import UUID
+
+import ujson
+from tortoise import fields
+
+from models import Users, Wallet, Transactions, WalletDailySummary
+
+
+class ModelSerializer:
+    """
+        JSON serializer generated once from the field definitions of a
+        model. A compiled projection picks only the public data fields of
+        a row and converts dates, times, UUIDs and bools to json native
+        values, the rows are then encoded by a single ujson call per
+        response instead of being walked key by key in python.
+        Rows may be mappings (raw sql results) or model instances.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.field_names = tuple(
+            name for name, field in model._meta.fields_map.items()
+            if not name.startswith("_") and name in model._meta.db_fields
+        )
+        converters = [self._field_converter(model._meta.fields_map[name]) for name in self.field_names]
+        self.values = self._compile("row[{name!r}]", converters)
+        self.instance_values = self._compile("row.{name}", converters)
+
+    @staticmethod
+    def _field_converter(field):
+        # raw sql on sqlite hands dates back as strings, those pass through
+        if isinstance(field, fields.DatetimeField):
+            return "({value}.isoformat(' ') if type({value}) is datetime else {value})"
+        if isinstance(field, fields.DateField):
+            return "({value}.isoformat() if type({value}) is date else {value})"
+        if isinstance(field, fields.TimeField):
+            return "({value}.isoformat() if type({value}) is time else {value})"
+        if isinstance(field, fields.UUIDField):
+            return "(str({value}) if type({value}) is UUID else {value})"
+        if isinstance(field, fields.BooleanField):
+            return "({value} if {value} is None else bool({value}))"
+        return "{value}"
+
+    def _compile(self, accessor, converters):
+        """
+            :param accessor: expression reading a field out of `row`
+            :param converters: expression converting `{value}`, per field
+            :return: function(row) -> dict of json native values
+        """
+        lines = ["def project(row):"]
+        items = []
+        for index, (name, converter) in enumerate(zip(self.field_names, converters)):
+            lines.append(f"    v{index} = " + accessor.format(name=name))
+            items.append(f"{name!r}: " + converter.format(value=f"v{index}"))
+        lines.append("    return {" + ", ".join(items) + "}")
+
+        namespace = {"datetime": datetime, "date": date, "time": time, "UUID": UUID}
+        exec(compile("\n".join(lines), f"<{self.model.__name__} serializer>", "exec"), namespace)
+        return namespace["project"]
+
+    def dumps(self, row):
+        """
+            :return: json object string of one row
+        """
+        return ujson.dumps(self.values(row))
+
+    def many(self, rows):
+        """
+            :return: json array string of the rows
+        """
+        project = self.values
+        return ujson.dumps([project(row) for row in rows])
+
+    def ndjson(self, rows):
+        """
+            :return: rows as newline delimited json, one object per line
+        """
+        project = self.values
+        return "".join([ujson.dumps(project(row)) + "\n" for row in rows])
+
+
+user_serializer = ModelSerializer(Users)
+wallet_serializer = ModelSerializer(Wallet)
+transaction_serializer = ModelSerializer(Transactions)
+daily_summary_serializer = ModelSerializer(WalletDailySummary)
@@ -0,0 +1,137 @@
+import uuid
+import zlib
+from enum import Enum
+
+from tortoise.exceptions import OperationalError
+
+from managers.replicas import ReplicaConstant
+
+
+class ShardConstant(Enum):
+    # customers hash to a slot and slots are assigned to shards. Tokens
+    # carry the slot of their customer, so the number of slots is fixed
+    # for good, only the slot -> shard assignment changes.
+    SLOTS = 1024
+    CONNECTION_PREFIX = "shard_"
+    TOKEN_SEPARATOR = "."
+
+
+def parse_slot_ranges(ranges):
+    """
+        :param ranges: iterable of "first-last" (inclusive) or single
+        slot strings, e.g. ["0-255", "512"]
+        :return: set of slot numbers
+    """
+    slots = set()
+    for slot_range in ranges:
+        first, _, last = str(slot_range).partition("-")
+        first, last = int(first), int(last or first)
+        if not 0 <= first <= last < ShardConstant.SLOTS.value:
+            raise ValueError(f"invalid slot range {slot_range}!")
+        slots.update(range(first, last + 1))
+    return slots
+
+
+def format_slot_ranges(slots):
+    """
+        :return: sorted slots collapsed back into "first-last" strings
+    """
+    ranges = []
+    for slot in sorted(slots):
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+    return [f"{first}-{last}" if first != last else str(first) for first, last in ranges]
+
+
+class ShardMap:
+    """
+        Places every customer, with its user, wallet and transactions, on
+        one of the shards (the primary connection of a database, replicas
+        aside). customer_xid hashes to one of the SLOTS slots, and each slot
+        belongs to a shard: as configured, or evenly split in contiguous
+        ranges. Moving customers between shards means reassigning slots,
+        see tools/rebalance.py. While a slot is frozen its customers can
+        still be read but every write to them is refused.
+        With a single shard everything lives on the default connection.
+    """
+
+    def __init__(self):
+        self.shards = [ReplicaConstant.PRIMARY.value]
+        self._slot_shards = [ReplicaConstant.PRIMARY.value] * ShardConstant.SLOTS.value
+        self.frozen_slots = frozenset()
+        self.rejected_writes = 0
+
+    @property
+    def enabled(self):
+        return len(self.shards) > 1
+
+    def configure(self, shards=(ReplicaConstant.PRIMARY.value,), slots=None, frozen_slots=()):
+        """
+            :param shards: connection names of the shard primaries, the
+            position in the list is the shard number
+            :param slots: {shard number: list of slot ranges}, slots left
+            out are split evenly between all the shards
+            :param frozen_slots: slot ranges being moved, writes refused
+        """
+        self.shards = list(shards)
+        slot_count = ShardConstant.SLOTS.value
+        self._slot_shards = [self.shards[slot * len(self.shards) // slot_count] for slot in range(slot_count)]
+        for shard_number, ranges in (slots or {}).items():
+            shard = self.shards[int(shard_number)]
+            for slot in parse_slot_ranges(ranges):
+                self._slot_shards[slot] = shard
+        self.frozen_slots = frozenset(parse_slot_ranges(frozen_slots))
+
+    @staticmethod
+    def slot(customer_xid: str):
+        # crc32, unlike hash(), is the same in every process
+        return zlib.crc32(str(customer_xid).encode()) % ShardConstant.SLOTS.value
+
+    def shard_of_slot(self, slot: int):
+        return self._slot_shards[slot]
+
+    def connection_name(self, customer_xid: str = None, write=False):
+        """
+            :param customer_xid: owner of the rows, shard 0 if None
+            :param write: the connection is used to write, refused while
+            the slot of customer_xid is frozen
+            :return: connection name of the shard primary of customer_xid
+        """
+        if customer_xid is None or not self.enabled:
+            return self.shards[0]
+        slot = self.slot(customer_xid)
+        if write and slot in self.frozen_slots:
+            self.rejected_writes += 1
+            raise OperationalError("Wallet is being moved, retry later!")
+        return self._slot_shards[slot]
+
+    def new_token(self, customer_xid: str):
+        """
+            :return: random auth token carrying the slot of customer_xid,
+            so the user is looked up on its shard only
+        """
+        return f"{uuid.uuid4()}{ShardConstant.TOKEN_SEPARATOR.value}{self.slot(customer_xid)}"
+
+    def token_shards(self, token: str):
+        """
+            :return: connection names of the shards the user of token may
+            be on, all of them for tokens issued before sharding
+        """
+        _, separator, slot = token.rpartition(ShardConstant.TOKEN_SEPARATOR.value)
+        if not self.enabled:
+            return self.shards[:1]
+        if separator and slot.isdigit() and int(slot) < ShardConstant.SLOTS.value:
+            return [self._slot_shards[int(slot)]]
+        return list(self.shards)
+
+    def stats(self):
+        return {
+            "shards": len(self.shards),
+            "frozen_slots": len(self.frozen_slots),
+            "rejected_writes": self.rejected_writes,
+        }
+
+
+shard_map = ShardMap()
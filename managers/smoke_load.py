@@ -0,0 +1,176 @@
+import asyncio
+import hmac
+import time
+from enum import Enum
+
+import httpx
+
+
+class SmokeLoadConstant(Enum):
+    HOST = "127.0.0.1"
+    # operator credential of the route, compared to SMOKE_LOAD.TOKEN
+    TOKEN_HEADER = "X-Smoke-Load-Token"
+    REQUESTS = 100
+    CONCURRENCY = 8
+    MAX_REQUESTS = 5000
+    MAX_CONCURRENCY = 32
+    TIMEOUT_S = 10
+    METHODS = ("GET", "POST", "PATCH", "PUT", "DELETE")
+    PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def parse_routes(routes, own_path: str):
+    """
+        :param routes: list of paths (sent as GET) or dicts with "path"
+        and optional "method", "headers" and "json"
+        :param own_path: path of the smoke load route, refused
+        :return: list of (method, path, headers, json)
+    """
+    if not routes or not isinstance(routes, list):
+        raise ValueError("routes should be a non empty list!")
+    parsed = []
+    for route in routes:
+        if isinstance(route, str):
+            route = {"path": route}
+        if not isinstance(route, dict) or not isinstance(route.get("path"), str):
+            raise ValueError("every route needs a path!")
+        path = route["path"]
+        # paths only, the requests never leave this server
+        if not path.startswith("/") or path.startswith("//"):
+            raise ValueError(f"invalid path {path}!")
+        if path.split("?")[0].rstrip("/") == own_path.rstrip("/"):
+            raise ValueError("smoke load can not call itself!")
+        method = str(route.get("method", "GET")).upper()
+        if method not in SmokeLoadConstant.METHODS.value:
+            raise ValueError(f"invalid method {method}!")
+        headers = route.get("headers") or {}
+        if not isinstance(headers, dict):
+            raise ValueError("headers should be an object!")
+        parsed.append((method, path, {str(key): str(value) for key, value in headers.items()}, route.get("json")))
+    return parsed
+
+
+class SmokeLoader:
+    """
+        Drives a mix of routes of this service through its own port with
+        an async http client, at most `concurrency` requests in flight,
+        so the worker running it keeps serving its other requests in the
+        meantime. Meant as a post deploy check, the request count and
+        concurrency are capped and it is off unless configured, with an
+        operator token callers have to present.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.token = None
+        self.max_requests = SmokeLoadConstant.MAX_REQUESTS.value
+        self.max_concurrency = SmokeLoadConstant.MAX_CONCURRENCY.value
+        self.timeout = SmokeLoadConstant.TIMEOUT_S.value
+
+    def configure(self, enabled=False, token=None, max_requests=SmokeLoadConstant.MAX_REQUESTS.value,
+                  max_concurrency=SmokeLoadConstant.MAX_CONCURRENCY.value,
+                  timeout_s=SmokeLoadConstant.TIMEOUT_S.value):
+        """
+            :param enabled: serve the smoke load route
+            :param token: operator token callers send in TOKEN_HEADER, the
+            route refuses everyone without one configured
+        """
+        self.enabled = enabled
+        self.token = token
+        self.max_requests = max_requests
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout_s
+
+    def authorized(self, token):
+        """
+            :param token: value of the TOKEN_HEADER header of the request
+        """
+        if not self.token or not token:
+            return False
+        return hmac.compare_digest(token.encode(), self.token.encode())
+
+    async def run(self, base_url: str, routes: list, requests: int, concurrency: int, headers: dict = None):
+        """
+            :param base_url: http url of this server on the loopback
+            :param routes: parsed routes (see parse_routes), requests are
+            spread over them in turn
+            :param requests: total requests to send
+            :param concurrency: requests in flight at most
+            :param headers: default headers of every request, the route's
+            own headers win
+            :return: overall throughput, and per route the throughput,
+            latency distribution (ms) and status codes
+        """
+        if not 0 < requests <= self.max_requests:
+            raise ValueError(f"requests should be between 1 and {self.max_requests}!")
+        if not 0 < concurrency <= self.max_concurrency:
+            raise ValueError(f"concurrency should be between 1 and {self.max_concurrency}!")
+
+        latencies = [[] for _ in routes]
+        status_codes = [{} for _ in routes]
+        next_index = iter(range(requests))
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=self.timeout) as client:
+            async def worker():
+                for index in next_index:
+                    route_index = index % len(routes)
+                    method, path, route_headers, body = routes[route_index]
+                    started = time.perf_counter()
+                    try:
+                        response = await client.request(method, path, headers={**(headers or {}), **route_headers},
+                                                        json=body)
+                        status = str(response.status_code)
+                    except httpx.HTTPError as ex:
+                        status = type(ex).__name__
+                    latencies[route_index].append((time.perf_counter() - started) * 1000)
+                    codes = status_codes[route_index]
+                    codes[status] = codes.get(status, 0) + 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            duration = time.perf_counter() - started
+
+        return {
+            "requests": requests,
+            "concurrency": concurrency,
+            "duration_s": round(duration, 4),
+            "throughput_rps": round(requests / duration, 2),
+            "routes": [
+                _route_report(route, route_latencies, codes, duration)
+                for route, route_latencies, codes in zip(routes, latencies, status_codes)
+            ],
+        }
+
+
+def _route_report(route, latencies, status_codes, duration):
+    method, path, _, _ = route
+    latencies.sort()
+    report = {
+        "method": method,
+        "path": path,
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / duration, 2),
+        "status_codes": status_codes,
+        "errors": sum(count for status, count in status_codes.items() if not status.startswith("2")),
+        "latency_ms": None,
+    }
+    if latencies:
+        report["latency_ms"] = {
+            "min": round(latencies[0], 3),
+            "mean": round(sum(latencies) / len(latencies), 3),
+            **{f"p{percent}": round(percentile(latencies, percent), 3)
+               for percent in SmokeLoadConstant.PERCENTILES.value},
+            "max": round(latencies[-1], 3),
+        }
+    return report
+
+
+smoke_loader = SmokeLoader()
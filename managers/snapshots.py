@@ -0,0 +1,140 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
+from sanic.log import logger
+
+from constants.queries import WALLETS_WITH_NEW_TRANSACTIONS, TAKE_BALANCE_SNAPSHOTS, BALANCE_AS_OF, \
+    SNAPSHOT_RUN_LOCK, SNAPSHOT_WATERMARK, SET_SNAPSHOT_WATERMARK
+from managers.orm_wrappers import ORMWrapper
+from managers.shards import shard_map
+
+
+class SnapshotConstant(Enum):
+    INTERVAL_S = 60
+    EVERY_TRANSACTIONS = 500
+    # transactions younger than this may still be uncommitted behind a
+    # lower id, they are left for the next run
+    SETTLE_SECONDS = 30
+    # pg_try_advisory_xact_lock key of the job
+    LOCK_KEY = 7001
+    EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+
+class BalanceSnapshotter:
+    """
+        Periodic job writing balance checkpoints per wallet. Every run
+        picks the wallets with transactions since the previous run and
+        extends their snapshots from the latest one, one checkpoint per
+        EVERY_TRANSACTIONS rows, so a balance-as-of query never replays
+        more rows than that. Where the job got to is kept per shard in
+        balance_snapshot_watermark, written in the transaction of the
+        run, so the very first run backfills the table and a restarted
+        worker carries on from there.
+        On postgres the run of a shard holds an advisory lock, every
+        worker schedules the job but only one runs it at a time, the
+        others skip the shard. Snapshots are keyed by (customer_xid,
+        transaction_id) and inserted with ON CONFLICT DO NOTHING, so even
+        overlapping runs (sqlite) only duplicate work, never rows.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = SnapshotConstant.INTERVAL_S.value
+        self.every_transactions = SnapshotConstant.EVERY_TRANSACTIONS.value
+        self.settle = timedelta(seconds=SnapshotConstant.SETTLE_SECONDS.value)
+        self._task = None
+        self.runs = 0
+        self.wallets_snapshotted = 0
+        self.failed_runs = 0
+        self.skipped_shards = 0
+
+    def configure(self, enabled=False, interval_s=SnapshotConstant.INTERVAL_S.value,
+                  every_transactions=SnapshotConstant.EVERY_TRANSACTIONS.value,
+                  settle_seconds=SnapshotConstant.SETTLE_SECONDS.value):
+        self.enabled = enabled
+        self.interval = interval_s
+        self.every_transactions = every_transactions
+        self.settle = timedelta(seconds=settle_seconds)
+
+    def start(self):
+        """
+            Starts the periodic job if enabled, to be called once the loop
+            is running.
+        """
+        if self.enabled:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as ex:
+                self.failed_runs += 1
+                logger.warning("balance snapshot run failed: %s", ex)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """
+            Snapshots every wallet with settled transactions since the
+            watermark, shard by shard, one transaction per shard.
+        """
+        settled_before = datetime.now(timezone.utc) - self.settle
+        for shard in shard_map.shards:
+            async with ORMWrapper.in_transaction(shard) as connection:
+                if connection.capabilities.dialect == "postgres":
+                    lock = await ORMWrapper.raw_sql(SNAPSHOT_RUN_LOCK, [SnapshotConstant.LOCK_KEY.value], connection)
+                    if not lock[0]["locked"]:
+                        # another worker is on this shard
+                        self.skipped_shards += 1
+                        continue
+                rows = await ORMWrapper.raw_sql(SNAPSHOT_WATERMARK, [], connection)
+                watermark = rows[0]["watermark"] if rows else SnapshotConstant.EPOCH.value
+                wallets = await ORMWrapper.raw_sql(WALLETS_WITH_NEW_TRANSACTIONS, [watermark, settled_before],
+                                                   connection)
+                for wallet in wallets:
+                    await ORMWrapper.raw_sql(TAKE_BALANCE_SNAPSHOTS, [
+                        wallet["customer_xid"], settled_before, self.every_transactions
+                    ], connection)
+                await ORMWrapper.raw_sql(SET_SNAPSHOT_WATERMARK, [settled_before], connection)
+            self.wallets_snapshotted += len(wallets)
+        self.runs += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "runs": self.runs,
+            "failed_runs": self.failed_runs,
+            "wallets_snapshotted": self.wallets_snapshotted,
+            "skipped_shards": self.skipped_shards,
+        }
+
+
+async def get_balance_at(customer_xid: str, at: datetime):
+    """
+        :param customer_xid: owner of the wallet
+        :param at: point in time
+        :return: dict with the balance at that time, the time of the
+        snapshot it was computed from (None if there was none) and the
+        number of transactions replayed on top of it
+    """
+    row = (await ORMWrapper.raw_sql(BALANCE_AS_OF, [customer_xid, at], read_only=True,
+                                    customer_xid=customer_xid))[0]
+    return {
+        "balance": (row["snapshot_balance"] or 0) + row["balance_change"],
+        "snapshot_time": row["snapshot_time"],
+        "replayed_transactions": row["replayed_transactions"],
+    }
+
+
+balance_snapshotter = BalanceSnapshotter()
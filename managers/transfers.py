@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+
+from sanic.log import logger
+from tortoise import Tortoise
+
+from constants.enums import TransferOutcome
+from constants.queries import CLAIM_TRANSFER_INTENTS
+from managers.ledger import settle_transfer, LedgerConstant
+from managers.orm_wrappers import ORMWrapper
+from managers.shards import shard_map
+
+
+class TransferRecoveryConstant(Enum):
+    INTERVAL_S = 30
+    BATCH_SIZE = 100
+
+
+class TransferRecovery:
+    """
+        Periodic sweep of the cross shard transfers left unsettled, their
+        worker stopped or lost a shard between the sender's debit and the
+        receiver's credit. Every run leases the intents whose lease ran
+        out, shard by shard, and settles each with settle_transfer: the
+        receiver is credited, or the sender refunded if the credit is
+        refused. A transfer still unsettled is leased again by a later
+        run. Intents are claimed with SKIP LOCKED (postgres) under a new
+        lease, so several workers running the sweep never settle the same
+        transfer at once. On by default, it only runs with more than one
+        shard.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.interval = TransferRecoveryConstant.INTERVAL_S.value
+        self.batch_size = TransferRecoveryConstant.BATCH_SIZE.value
+        self._task = None
+        self.runs = 0
+        self.failed_runs = 0
+        self.credited = 0
+        self.refunded = 0
+        self.unsettled = 0
+
+    def configure(self, enabled=True, interval_s=TransferRecoveryConstant.INTERVAL_S.value,
+                  batch_size=TransferRecoveryConstant.BATCH_SIZE.value):
+        self.enabled = enabled
+        self.interval = interval_s
+        self.batch_size = batch_size
+
+    def start(self):
+        """
+            Starts the periodic sweep if enabled and sharded, to be called
+            once the loop is running.
+        """
+        if self.enabled and shard_map.enabled:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as ex:
+                self.failed_runs += 1
+                logger.warning("transfer recovery run failed: %s", ex)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """
+            Settles the transfers of every shard whose lease ran out.
+        """
+        for shard in shard_map.shards:
+            dialect = Tortoise.get_connection(shard).capabilities.dialect
+            lock = "FOR UPDATE SKIP LOCKED" if dialect == "postgres" else ""
+            now = datetime.now(timezone.utc)
+            lease = now + timedelta(seconds=LedgerConstant.TRANSFER_LEASE_S.value)
+            intents = await ORMWrapper.raw_sql(CLAIM_TRANSFER_INTENTS.format(lock=lock),
+                                               [self.batch_size, lease, now], connection=shard)
+            for intent in intents:
+                outcome = await settle_transfer(intent["sender_xid"], intent["receiver_xid"], intent["amount"],
+                                                intent["reference_id"], lease)
+                if outcome == TransferOutcome.CREDITED:
+                    self.credited += 1
+                elif outcome == TransferOutcome.REFUNDED:
+                    self.refunded += 1
+                else:
+                    self.unsettled += 1
+                logger.warning("transfer %s recovered: %s", intent["reference_id"], outcome.value)
+        self.runs += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "runs": self.runs,
+            "failed_runs": self.failed_runs,
+            "credited": self.credited,
+            "refunded": self.refunded,
+            "unsettled": self.unsettled,
+        }
+
+
+transfer_recovery = TransferRecovery()
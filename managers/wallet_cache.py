@@ -0,0 +1,294 @@
+import asyncio
+import os
+import socket
+from collections import OrderedDict
+from contextlib import contextmanager
+from enum import Enum
+
+from sanic.log import logger
+
+from managers.cache import MISSING, TTLCache
+
+
+class WalletCacheConstant(Enum):
+    MAX_SIZE = 100000
+    # safety net for changes made outside the handlers (tools, manual sql)
+    TTL = 60  # seconds
+    NEGATIVE_TTL = 5  # seconds, users without a wallet yet
+    SOCKET_SUFFIX = ".sock"
+    MAX_MESSAGE_BYTES = 65536
+
+
+class WalletWrite:
+    """
+        Change of one wallet made under WalletStateCache.write, applied to
+        the cache once the database write went through.
+    """
+    __slots__ = ("changes", "state")
+
+    def __init__(self):
+        self.changes = {}
+        self.state = None
+
+    def update(self, **changes):
+        """
+            Fields changed on the existing wallet, e.g. amount=final_amount,
+            applied only if the wallet is cached.
+        """
+        self.changes.update(changes)
+
+    def replace(self, state: dict):
+        """
+            Whole wallet state (a new wallet), cached as is.
+        """
+        self.state = state
+
+
+class InvalidationChannel:
+    """
+        Unix datagram socket per worker in a shared directory. A worker
+        changing a wallet sends its customer_xid to every other socket of
+        the directory, which drop it from their cache. Delivery is best
+        effort (a peer with a full socket buffer misses the message), the
+        cache ttl bounds how long such a peer serves the old state.
+        The directory must only be writable by the service user.
+    """
+
+    def __init__(self, directory: str, on_invalidate):
+        self.directory = directory
+        self._on_invalidate = on_invalidate
+        self._socket = None
+        self.path = None
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}{WalletCacheConstant.SOCKET_SUFFIX.value}")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._socket.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._socket.fileno(), self._receive)
+
+    def stop(self):
+        if self._socket is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, customer_xid: str):
+        if self._socket is None:
+            return
+        message = customer_xid.encode()
+        suffix = WalletCacheConstant.SOCKET_SUFFIX.value
+        # listed on every publish, workers come and go
+        for name in os.listdir(self.directory):
+            peer = os.path.join(self.directory, name)
+            if not name.endswith(suffix) or peer == self.path:
+                continue
+            try:
+                self._socket.sendto(message, peer)
+                self.sent += 1
+            except ConnectionRefusedError:
+                # nobody bound to it, a worker that died without cleanup
+                self._unlink(peer)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self.dropped += 1
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._socket.recv(WalletCacheConstant.MAX_MESSAGE_BYTES.value)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            self._on_invalidate(message.decode())
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {"sent": self.sent, "received": self.received, "dropped": self.dropped}
+
+
+class WalletStateCache:
+    """
+        Write-through cache of wallet state (id, amount, is_enabled,
+        enabled_at) by customer_xid, so balance reads need no database
+        round trip. Every handler changing a wallet does so under write(),
+        which updates the cache once the database write went through.
+        Bounded LRU with a ttl, see TTLCache.
+
+        State read from the database only fills the cache if no write or
+        invalidation of that wallet happened since the read started, and
+        two writes of one wallet in flight at once drop it instead of
+        guessing which landed last. With several worker processes the
+        invalidation channel (INVALIDATION_DIR) tells the other workers
+        to drop a wallet changed here, without it they may serve a stale
+        state for up to the ttl.
+        It is not thread safe, it is meant for the event loop of a single
+        sanic worker.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._cache = TTLCache()
+        self._channel = None
+        # customer_xid -> [writes in flight, dirty]
+        self._writes = {}
+        # customer_xid -> generation of its last write or invalidation
+        self._touched = OrderedDict()
+        self._touched_floor = 0
+        self.generation = 0
+        self.write_throughs = 0
+        self.write_invalidations = 0
+        self.stale_fills = 0
+        self.remote_invalidations = 0
+
+    def configure(self, enabled=False, max_size=WalletCacheConstant.MAX_SIZE.value,
+                  ttl_s=WalletCacheConstant.TTL.value, invalidation_dir=None):
+        """
+            :param invalidation_dir: directory of the cross worker
+            invalidation sockets, no channel if None
+        """
+        self.enabled = enabled
+        self._cache = TTLCache(max_size=max_size, ttl=ttl_s, negative_ttl=WalletCacheConstant.NEGATIVE_TTL.value)
+        self._channel = InvalidationChannel(invalidation_dir, self._invalidate_remote) \
+            if enabled and invalidation_dir else None
+
+    def start(self):
+        if self._channel is not None:
+            self._channel.start()
+            logger.info("wallet cache invalidation channel on %s", self._channel.path)
+
+    def stop(self):
+        if self._channel is not None:
+            self._channel.stop()
+
+    def get(self, customer_xid: str):
+        """
+            :return: copy of the cached wallet state, None for a user
+            without a wallet, MISSING if not cached (or disabled)
+        """
+        if not self.enabled:
+            return MISSING
+        state = self._cache.get(customer_xid)
+        return state if state is MISSING or state is None else dict(state)
+
+    def fill(self, customer_xid: str, state, since: int):
+        """
+            Caches state read from the primary.
+            :param state: wallet state, None if the user has no wallet
+            :param since: generation taken before the read started
+        """
+        if not self.enabled:
+            return
+        if self._touched.get(customer_xid, self._touched_floor) > since or customer_xid in self._writes:
+            self.stale_fills += 1
+            return
+        self._cache.set(customer_xid, dict(state) if state else None)
+
+    @contextmanager
+    def write(self, customer_xid: str):
+        """
+            Wraps a database write of the wallet of customer_xid:
+
+                with wallet_state_cache.write(customer_xid) as write:
+                    rows = await ...
+                    write.update(amount=rows[0]["final_amount"])
+
+            The change is cached once the block completes, a block
+            raising drops the wallet from the cache. Either way the other
+            workers are told to drop it.
+        """
+        if not self.enabled:
+            yield WalletWrite()
+            return
+
+        writes = self._writes.get(customer_xid)
+        if writes is None:
+            writes = self._writes[customer_xid] = [0, False]
+        else:
+            writes[1] = True
+        writes[0] += 1
+        self._touch(customer_xid)
+        write = WalletWrite()
+        try:
+            yield write
+            self._apply(customer_xid, write, dirty=writes[1])
+        except BaseException:
+            self._cache.invalidate(customer_xid)
+            raise
+        finally:
+            writes[0] -= 1
+            if not writes[0]:
+                del self._writes[customer_xid]
+            self._touch(customer_xid)
+            if self._channel is not None:
+                self._channel.publish(customer_xid)
+
+    def _apply(self, customer_xid, write, dirty):
+        if dirty:
+            self.write_invalidations += 1
+            self._cache.invalidate(customer_xid)
+        elif write.state is not None:
+            self.write_throughs += 1
+            self._cache.set(customer_xid, dict(write.state))
+        else:
+            state = self._cache.get(customer_xid)
+            if state is not MISSING and state is not None and write.changes:
+                self.write_throughs += 1
+                self._cache.set(customer_xid, dict(state, **write.changes))
+            else:
+                self._cache.invalidate(customer_xid)
+
+    def invalidate(self, customer_xid: str):
+        if not self.enabled:
+            return
+        self._touch(customer_xid)
+        self._cache.invalidate(customer_xid)
+        if self._channel is not None:
+            self._channel.publish(customer_xid)
+
+    def _invalidate_remote(self, customer_xid):
+        self.remote_invalidations += 1
+        writes = self._writes.get(customer_xid)
+        if writes is not None:
+            writes[1] = True
+        self._touch(customer_xid)
+        self._cache.invalidate(customer_xid)
+
+    def _touch(self, customer_xid):
+        self.generation += 1
+        self._touched[customer_xid] = self.generation
+        self._touched.move_to_end(customer_xid)
+        if len(self._touched) > self._cache.max_size:
+            _, generation = self._touched.popitem(last=False)
+            self._touched_floor = max(self._touched_floor, generation)
+
+    def stats(self):
+        stats = dict(
+            self._cache.stats(),
+            write_throughs=self.write_throughs,
+            write_invalidations=self.write_invalidations,
+            stale_fills=self.stale_fills,
+            remote_invalidations=self.remote_invalidations,
+        )
+        if self._channel is not None:
+            stats.update({f"channel_{key}": value for key, value in self._channel.stats().items()})
+        return stats
+
+
+wallet_state_cache = WalletStateCache()
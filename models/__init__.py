@@ -1,3 +1,8 @@
 from .users import Users
 from .wallet import Wallet
 from .transactions import Transactions
+from .balance_snapshots import BalanceSnapshots
+from .balance_snapshot_watermark import BalanceSnapshotWatermark
+from .wallet_daily_summary import WalletDailySummary
+from .wallet_outbox import WalletOutbox
+from .transfer_intents import TransferIntents
@@ -0,0 +1,11 @@
+from tortoise import Model, fields
+
+
+class BalanceSnapshotWatermark(Model):
+    # single row, transactions before watermark are snapshotted, see
+    # managers/snapshots.py
+    id = fields.SmallIntField(pk=True, generated=False)
+    watermark = fields.DatetimeField()
+
+    class Meta:
+        table = "balance_snapshot_watermark"
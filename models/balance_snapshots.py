@@ -0,0 +1,16 @@
+from tortoise import Model, fields
+
+
+class BalanceSnapshots(Model):
+    # balance of a wallet right after one of its transactions, see
+    # managers/snapshots.py
+    id = fields.IntField(pk=True)
+    customer_xid = fields.CharField(max_length=50)
+    transaction_time = fields.DatetimeField()
+    transaction_id = fields.IntField()
+    balance = fields.IntField()
+
+    class Meta:
+        table = "balance_snapshots"
+        unique_together = (("customer_xid", "transaction_id"),)
+        indexes = (("customer_xid", "transaction_time", "transaction_id"),)
@@ -10,4 +10,9 @@ class Transactions(Model):
     transaction_from = fields.CharField(max_length=50)
     transaction_to = fields.CharField(max_length=50)
     transaction_type = fields.CharField(max_length=50)
-    reference_id = fields.CharField(max_length=50)
+    reference_id = fields.CharField(max_length=50, unique=True)
+
+    class Meta:
+        # keyset pagination of a wallet's history and wallets with new
+        # transactions for the balance snapshots, see db/migrations
+        indexes = (("transaction_from", "transaction_time", "id"), ("transaction_time",))
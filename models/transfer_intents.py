@@ -0,0 +1,16 @@
+from tortoise import Model, fields
+
+
+class TransferIntents(Model):
+    # cross shard transfer debited but not settled yet, on the sender's
+    # shard, see managers/transfers.py
+    id = fields.BigIntField(pk=True)
+    reference_id = fields.CharField(max_length=50, unique=True)
+    sender_xid = fields.CharField(max_length=50)
+    receiver_xid = fields.CharField(max_length=50)
+    amount = fields.IntField()
+    leased_until = fields.DatetimeField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "transfer_intents"
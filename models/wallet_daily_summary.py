@@ -0,0 +1,22 @@
+from tortoise import Model, fields
+
+
+class WalletDailySummary(Model):
+    # per customer per (UTC) day totals, kept up to date with every
+    # transaction insert, see managers/rollups.py
+    id = fields.IntField(pk=True)
+    customer_xid = fields.CharField(max_length=50)
+    day = fields.DateField()
+    deposit_count = fields.IntField(default=0)
+    deposit_sum = fields.BigIntField(default=0)
+    withdrawal_count = fields.IntField(default=0)
+    withdrawal_sum = fields.BigIntField(default=0)
+    transfer_in_count = fields.IntField(default=0)
+    transfer_in_sum = fields.BigIntField(default=0)
+    transfer_out_count = fields.IntField(default=0)
+    transfer_out_sum = fields.BigIntField(default=0)
+    closing_balance = fields.IntField()
+
+    class Meta:
+        table = "wallet_daily_summary"
+        unique_together = (("customer_xid", "day"),)
@@ -0,0 +1,21 @@
+from tortoise import Model, fields
+
+
+class WalletOutbox(Model):
+    # event per ledger row, inserted in the transaction of the row and
+    # deleted once published, see managers/outbox.py
+    id = fields.BigIntField(pk=True)
+    transaction_id = fields.IntField()
+    customer_xid = fields.CharField(max_length=50)
+    transaction_type = fields.CharField(max_length=50)
+    amount = fields.IntField()
+    final_amount = fields.IntField()
+    transaction_to = fields.CharField(max_length=50)
+    reference_id = fields.CharField(max_length=50)
+    transaction_time = fields.DatetimeField()
+    created_at = fields.DatetimeField(auto_now_add=True)
+    # set while a publisher sends the event
+    leased_until = fields.DatetimeField(null=True)
+
+    class Meta:
+        table = "wallet_outbox"
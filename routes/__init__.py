@@ -1,9 +1,11 @@
 from routes.apis import user
+from routes.metrics_apis import monitoring
 from routes.wallet_apis import wallet
 from sanic import Blueprint
 
 
 blueprint_group = Blueprint.group(
     user,
-    wallet
+    wallet,
+    monitoring
 )
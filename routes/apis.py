@@ -1,13 +1,12 @@
-import uuid
-
-import httpx
-from sanic import Blueprint, json
+from sanic import Blueprint
 from sanic.request import Request
-from tortoise.exceptions import IntegrityError
+from tortoise.exceptions import IntegrityError, OperationalError
 
 from constants.enums import HTTPStatusCodes, WalletStatus
 from managers.helpers import send_response
 from managers.orm_wrappers import ORMWrapper
+from managers.shards import shard_map
+from managers.smoke_load import smoke_loader, parse_routes, SmokeLoadConstant
 from models.users import Users
 
 user = Blueprint("user", url_prefix='api/v1')
@@ -28,15 +27,15 @@ async def init(request: Request):
     """
 
     try:
-        new_token = str(uuid.uuid4())
-
         data = request.json
         if not data or not isinstance(data, dict) or not data.get('customer_xid'):
             raise ValueError('Missing or invalid data for required field.')
 
         customer_xid = data['customer_xid']
+        # the token tells the shard of the user, see ShardMap
+        new_token = shard_map.new_token(customer_xid)
 
-        # Create user in the database
+        # Create user in the database, on the shard of customer_xid
         await ORMWrapper.create(Users, {
             "customer_xid": customer_xid,
             "token": new_token
@@ -67,19 +66,55 @@ async def init(request: Request):
         }
         return await send_response(data=result_json, status_code=HTTPStatusCodes.BAD_REQUEST.value)
 
+    except OperationalError as ex:
+        # e.g. the shard of customer_xid is being rebalanced
+        result_json = {
+            "error": str(ex)
+        }
+        return await send_response(data=result_json, status_code=HTTPStatusCodes.BAD_REQUEST.value)
 
-@user.route('/hyper_test', methods=['POST'])
-async def hyper_test(request: Request):
-    print("user test\n")
-    host = request.host
 
-    api_url = "https://localhost:8000/api/route"
-    data = {}
+@user.route('/smoke_load', methods=['POST'])
+async def smoke_load(request: Request):
+    """
+        This route runs a smoke load against routes of this service,
+        through its own port and without blocking the worker (see
+        SmokeLoader), to check a deploy. The Authorization header of
+        the request is passed on to every route without its own.
 
-    for route in user.routes:
-        print(f"/{route.path} ")
-        response = httpx.post(api_url, json=data)
-        data.update({
-            "data": response
-        })
-    return json({"data": data})
+        Args:
+            request: request with the operator token of SMOKE_LOAD in the
+            X-Smoke-Load-Token header, "routes" (paths, or objects with
+            path, method, headers and json), "requests" (total) and
+            "concurrency"
+
+        Returns:
+            json: throughput of the run and per route the throughput,
+            latency distribution and status codes, or failure response.
+    """
+
+    if not smoke_loader.enabled:
+        return await send_response(data={"error": "Smoke load is disabled!"},
+                                   status_code=HTTPStatusCodes.FORBIDDEN.value)
+    if not smoke_loader.authorized(request.headers.get(SmokeLoadConstant.TOKEN_HEADER.value)):
+        return await send_response(data={"error": "Invalid smoke load token!"},
+                                   status_code=HTTPStatusCodes.UNAUTHORIZED.value)
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            raise ValueError("Missing or invalid data for required field.")
+        routes = parse_routes(data.get("routes"), f"/{request.route.path}")
+        requests = int(data.get("requests", SmokeLoadConstant.REQUESTS.value))
+        concurrency = int(data.get("concurrency", SmokeLoadConstant.CONCURRENCY.value))
+        headers = {}
+        if request.headers.get("Authorization"):
+            headers["Authorization"] = request.headers["Authorization"]
+
+        # the port the worker accepted this connection on, never what the
+        # client claims in its Host or forwarded headers
+        base_url = f"http://{SmokeLoadConstant.HOST.value}:{request.conn_info.server_port}"
+        result_json = await smoke_loader.run(base_url, routes, requests, concurrency, headers)
+        return await send_response(data=result_json)
+
+    except (ValueError, TypeError) as ex:
+        return await send_response(data={"error": str(ex)}, status_code=HTTPStatusCodes.BAD_REQUEST.value)
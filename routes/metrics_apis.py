@@ -0,0 +1,67 @@
+from sanic import Blueprint, response
+from sanic.request import Request
+
+from managers.admission import admission_controller
+from managers.cache import user_token_cache
+from managers.coalescer import deposit_coalescer
+from managers.database import startup_timer
+from managers.fast_path import prepared_statements
+from managers.idempotency import idempotency_index
+from managers.metrics import metrics, MetricsConstant
+from managers.orm_wrappers import batch_loader
+from managers.outbox import outbox_publisher
+from managers.profiler import query_profiler
+from managers.replicas import replica_router
+from managers.request_logger import request_logger
+from managers.shards import shard_map
+from managers.snapshots import balance_snapshotter
+from managers.transfers import transfer_recovery
+from managers.wallet_cache import wallet_state_cache
+
+monitoring = Blueprint("monitoring")
+
+
+def _stats_gauge(stats):
+    return lambda: {(key,): int(value) for key, value in stats().items()}
+
+
+metrics.register_gauge("wallet_token_cache", "Token to user cache counters.", ("counter",),
+                       _stats_gauge(user_token_cache.stats))
+metrics.register_gauge("wallet_deposit_coalescer", "Deposit group commit counters.", ("counter",),
+                       _stats_gauge(deposit_coalescer.stats))
+metrics.register_gauge("wallet_request_logger", "Request logger counters.", ("counter",),
+                       _stats_gauge(request_logger.stats))
+metrics.register_gauge("wallet_query_profiler", "Slow and repeated query counters.", ("counter",),
+                       _stats_gauge(query_profiler.stats))
+metrics.register_gauge("wallet_idempotency_index", "Recent reference_id index counters.", ("counter",),
+                       _stats_gauge(idempotency_index.stats))
+metrics.register_gauge("wallet_balance_snapshots", "Balance snapshot job counters.", ("counter",),
+                       _stats_gauge(balance_snapshotter.stats))
+metrics.register_gauge("wallet_transfer_recovery", "Cross shard transfer recovery counters.", ("counter",),
+                       _stats_gauge(transfer_recovery.stats))
+metrics.register_gauge("wallet_outbox", "Outbox publisher counters, backoff and lag.", ("counter",),
+                       _stats_gauge(outbox_publisher.stats))
+metrics.register_gauge("wallet_read_replicas", "Read routing and replica failover counters.", ("counter",),
+                       _stats_gauge(replica_router.stats))
+metrics.register_gauge("wallet_shards", "Shard map counters.", ("counter",),
+                       _stats_gauge(shard_map.stats))
+metrics.register_gauge("wallet_admission", "Admission control state and rejection counters.", ("counter",),
+                       _stats_gauge(admission_controller.stats))
+metrics.register_gauge("wallet_state_cache", "Wallet state cache counters.", ("counter",),
+                       _stats_gauge(wallet_state_cache.stats))
+metrics.register_gauge("wallet_batch_loader", "Coalesced key lookup counters.", ("counter",),
+                       _stats_gauge(batch_loader.stats))
+metrics.register_gauge("wallet_fast_path", "Prepared statement fast path counters.", ("counter",),
+                       _stats_gauge(prepared_statements.stats))
+metrics.register_gauge("wallet_startup_seconds", "Seconds from boot to each startup phase of the worker.", ("phase",),
+                       lambda: {(phase,): seconds for phase, seconds in startup_timer.stats().items()})
+
+
+@monitoring.route('/metrics', methods=['GET'])
+async def get_metrics(request: Request):
+    """
+        This route exposes the metrics of this worker (request and
+        query latency histograms, pool wait time and counters of the
+        caches and queues) in prometheus text format.
+    """
+    return response.text(metrics.render(), content_type=MetricsConstant.CONTENT_TYPE.value)
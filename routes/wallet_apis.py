@@ -1,14 +1,26 @@
-from datetime import datetime
+from contextlib import suppress
+from datetime import datetime, timezone, date
 
+import ujson
 from sanic import Blueprint
+from sanic.log import logger
 from sanic.request import Request
-from tortoise.exceptions import OperationalError
+from tortoise.exceptions import OperationalError, IntegrityError
 
-from constants.enums import HTTPStatusCodes, WalletStatus, TransactionStatus
+from constants.enums import HTTPStatusCodes, WalletStatus, TransactionStatus, ExportFormat
+from managers.coalescer import deposit_coalescer
 from managers.helpers import send_response, get_user_details, exceptions_handler, wallet_response_formatter, \
-    get_wallet_details, to_string
+    get_user_wallet_details, rows_to_csv, send_serialized_response, transaction_response_formatter, \
+    transfer_response_formatter
+from managers.idempotency import idempotency_index
+from managers.ledger import apply_balance_change, apply_transaction_batch, get_transactions_page, \
+    stream_transactions, apply_transfer, check_transfer_settled, valid_reference_id, LedgerConstant
 from managers.orm_wrappers import ORMWrapper
-from models import Transactions
+from managers.replicas import replica_router
+from managers.rollups import get_daily_summary
+from managers.serializers import transaction_serializer, wallet_serializer, daily_summary_serializer
+from managers.snapshots import get_balance_at
+from managers.wallet_cache import wallet_state_cache
 from models.wallet import Wallet
 
 wallet = Blueprint("wallet", url_prefix='api/v1')
@@ -36,37 +48,42 @@ async def init_wallet(request: Request):
 
     # if wallet of this user is already active return failure.
     auth_token = request.headers.get("Authorization")
-    user_details = await get_user_details(auth_token)
+    # check if wallet already present with this customer_xid
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
     status_code = HTTPStatusCodes.CREATED.value
     result_json = {}
 
-    # check if wallet already present with this customer_xid
-    wallet_instance = await ORMWrapper.get_by_filters(Wallet, {
-        "customer_xid": user_details.get("customer_xid")
-    })
-    if wallet_instance:
-        wallet_details = wallet_instance[0].__dict__
+    if wallet_details:
         if wallet_details.get("is_enabled"):
             status_code = HTTPStatusCodes.BAD_REQUEST.value
             result_json = {
                 "data": "Already enabled!"
             }
-        await ORMWrapper.update_with_filters(
-            wallet_instance[0],
-            Wallet,
-            {
-                "is_enabled": WalletStatus.ENABLED.value,
-            }
-        )
+        with wallet_state_cache.write(user_details.get("customer_xid")) as write:
+            await ORMWrapper.update_with_filters(
+                None,
+                Wallet,
+                {
+                    "is_enabled": WalletStatus.ENABLED.value,
+                },
+                where_clause={"id": wallet_details.get("id")},
+                customer_xid=user_details.get("customer_xid")
+            )
+            write.update(is_enabled=WalletStatus.ENABLED.value)
     else:
         # Create wallet for the user in database
-        wallet_details = await ORMWrapper.create(Wallet, {
-            "is_enabled": True,
-            "amount": 0,
-            "customer_xid": user_details.get("customer_xid"),
-            "enabled_at": datetime.now(),
-        })
-        result_json = wallet_response_formatter(user_details, wallet_details.__dict__)
+        with wallet_state_cache.write(user_details.get("customer_xid")) as write:
+            wallet_details = await ORMWrapper.create(Wallet, {
+                "is_enabled": True,
+                "amount": 0,
+                "customer_xid": user_details.get("customer_xid"),
+                # enabled_at is a TimeField (TIME column)
+                "enabled_at": datetime.now().time(),
+            })
+            wallet_details = wallet_serializer.instance_values(wallet_details)
+            write.replace(wallet_details)
+        result_json = wallet_response_formatter(user_details, wallet_details)
+    replica_router.record_write(user_details.get("customer_xid"))
     return await send_response(data=result_json, status_code=status_code)
 
 
@@ -91,10 +108,9 @@ async def get_wallet_balance(request: Request):
 
     # if token wrong or not given
     auth_token = request.headers.get("Authorization")
-    user_details = await get_user_details(auth_token)
 
-    # fetch wallet details based on customer_xid
-    wallet_details = await get_wallet_details(user_details)
+    # fetch user and wallet details in one go
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
     if not wallet_details:
         raise OperationalError()
 
@@ -107,17 +123,104 @@ async def get_wallet_balance(request: Request):
     return await send_response(data=result_json, status_code=HTTPStatusCodes.SUCCESS.value)
 
 
+# Balance of my wallet at a past moment
+@wallet.route('/wallet/balance', methods=['GET'])
+@exceptions_handler
+async def get_wallet_balance_at(request: Request):
+    """
+        This route is responsible for fetching the balance the wallet
+        had at a given time, from the nearest balance snapshot plus the
+        transactions after it.
+
+        Args:
+            request: request with Authorization token and query param
+            "at", an ISO 8601 datetime (UTC when no offset is given),
+            now by default
+
+        Returns:
+            Returns json of resultant data, with these parameters.
+              "owned_by": customer_xid
+              "balance": balance of the wallet at that time
+              "as_of": the time asked for
+              "snapshot_time": time of the snapshot used, if any
+              "replayed_transactions": transactions added on top of it
+    """
+    auth_token = request.headers.get("Authorization")
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
+    if not wallet_details:
+        raise ValueError("Wallet not found!")
+
+    at = request.args.get("at")
+    try:
+        at = datetime.fromisoformat(at) if at else datetime.now(timezone.utc)
+    except ValueError:
+        raise ValueError("invalid at!")
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+
+    balance_details = await get_balance_at(user_details.get("customer_xid"), at)
+    result_json = {
+        "owned_by": user_details.get("customer_xid"),
+        "balance": balance_details.get("balance"),
+        "as_of": str(at),
+        "snapshot_time": str(balance_details.get("snapshot_time")) if balance_details.get("snapshot_time") else None,
+        "replayed_transactions": balance_details.get("replayed_transactions")
+    }
+    return await send_response(data=result_json)
+
+
+# Daily totals of my wallet
+@wallet.route('/wallet/summary', methods=['GET'])
+@exceptions_handler
+async def get_wallet_summary(request: Request):
+    """
+        This route is responsible for fetching the per day totals of
+        the wallet, from the daily summary kept with every transaction,
+        so the cost grows with the days asked for, not the transactions.
+
+        Args:
+            request: request with Authorization token, optional query
+            params "from" and "to", ISO 8601 (UTC) days, inclusive, the
+            last 30 days by default
+
+        Returns:
+            Returns json of resultant data, one entry per day with
+            transactions, oldest first, with these parameters.
+              "day": the day
+              "deposit_count", "deposit_sum": deposits of the day
+              "withdrawal_count", "withdrawal_sum": withdrawals of the day
+              "transfer_in_count", "transfer_in_sum": incoming transfers
+              "transfer_out_count", "transfer_out_sum": outgoing transfers
+              "closing_balance": balance at the end of the day
+            and meta with "from", "to" and the "totals" over the range
+    """
+    auth_token = request.headers.get("Authorization")
+    user_details = await get_user_details(auth_token)
+    days = {}
+    for name in ("from", "to"):
+        try:
+            days[name] = date.fromisoformat(request.args.get(name)) if request.args.get(name) else None
+        except ValueError:
+            raise ValueError(f"invalid {name}!")
+
+    summary, meta = await get_daily_summary(user_details.get("customer_xid"), days["from"], days["to"])
+    return await send_serialized_response(daily_summary_serializer.many(summary), meta=meta)
+
+
 # View my wallet transactions
 
 @wallet.route('/wallet/transactions', methods=['GET'])
+@exceptions_handler
 async def get_wallet_transactions(request: Request):
     """
-        This route is responsible for fetching all
-         translations of the wallet.
+        This route is responsible for fetching
+         translations of the wallet, newest first, one page at a time.
         based on authentication token given.
 
         Args:
-            request: request with Authorization token
+            request: request with Authorization token, optional query
+            params "limit", and "before" or "after" cursor taken from
+            the meta of a previous page
 
         Returns:
             Returns json of resultant data, with these parameters.
@@ -126,17 +229,81 @@ async def get_wallet_transactions(request: Request):
               "type": nature of transaction.
               "amount": balance of the wallet
               "reference_id": unique id of transaction
+            and meta with "next_cursor" (older) and "prev_cursor" (newer)
     """
 
     auth_token = request.headers.get("Authorization")
     user_details = await get_user_details(auth_token)
-    transaction_details = await ORMWrapper.get_by_filters(Transactions, {
-        "transaction_from": user_details.get("customer_xid")
-    })
-    transaction_details_json = []
-    for details in transaction_details:
-        transaction_details_json.append(to_string(details.__dict__))
-    return await send_response(data=transaction_details_json)
+    limit = request.args.get("limit", LedgerConstant.DEFAULT_PAGE_SIZE.value)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("invalid limit!")
+
+    transaction_details, meta = await get_transactions_page(
+        user_details.get("customer_xid"),
+        limit=limit,
+        before=request.args.get("before"),
+        after=request.args.get("after")
+    )
+    return await send_serialized_response(transaction_serializer.many(transaction_details), meta=meta)
+
+
+@wallet.route('/wallet/transactions/export', methods=['GET'])
+@exceptions_handler
+async def export_wallet_transactions(request: Request):
+    """
+        This route is responsible for exporting the full transaction
+        history of the wallet, oldest first. Rows are streamed as they
+        are read from the database so memory stays flat for any size.
+
+        Args:
+            request: request with Authorization token, optional query
+            param "format": ndjson (default) or csv
+
+        Returns:
+            Streams one line per transaction with "id", "amount",
+            "final_amount", "status", "transaction_time", "transaction_from",
+            "transaction_to", "transaction_type" and "reference_id".
+            An error once streaming started cuts the connection before
+            the final chunk, ndjson exports get a last {"error": ...}
+            line first.
+    """
+    auth_token = request.headers.get("Authorization")
+    user_details = await get_user_details(auth_token)
+    export_format = request.args.get("format", ExportFormat.NDJSON.value)
+    if export_format not in [member.value for member in ExportFormat]:
+        raise ValueError("invalid format!")
+
+    is_csv = export_format == ExportFormat.CSV.value
+    customer_xid = user_details.get("customer_xid")
+    response = await request.respond(
+        content_type="text/csv" if is_csv else "application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{customer_xid}_transactions.{export_format}"'
+        }
+    )
+
+    # the status line is out, exceptions_handler can't answer from here on
+    columns = LedgerConstant.EXPORT_COLUMNS.value
+    try:
+        if is_csv:
+            await response.send(rows_to_csv([], columns, header=True))
+        async for rows in stream_transactions(customer_xid):
+            if is_csv:
+                await response.send(rows_to_csv(rows, columns))
+            else:
+                await response.send(transaction_serializer.ndjson(rows))
+    except Exception:
+        logger.exception("transaction export of %s failed mid stream", customer_xid)
+        if not is_csv:
+            with suppress(Exception):
+                await response.send(ujson.dumps({"error": "Export failed, incomplete!"}) + "\n")
+        # drop the connection without the last chunk, so the client sees
+        # a cut off transfer instead of a complete looking export
+        request.transport.close()
+        return
+    await response.eof()
 
 
 # Add virtual money to my wallet
@@ -145,7 +312,9 @@ async def get_wallet_transactions(request: Request):
 async def add_wallet_balance(request: Request):
     """
         This route is responsible for adding balance
-        in wallet based on auth token and amount given
+        in wallet based on auth token and amount given.
+        A retry with the reference_id of a settled deposit gets the
+        original transaction back, nothing is applied twice.
 
         Args:
             request: request with Authorization token
@@ -162,56 +331,7 @@ async def add_wallet_balance(request: Request):
 
     auth_token = request.headers.get("Authorization")
     user_data = request.json
-    user_details = await get_user_details(auth_token)
-
-    # fetch wallet details based on customer_xid
-    wallet_instance = await ORMWrapper.get_by_filters(Wallet, {
-        "customer_xid": user_details.get("customer_xid")
-    })
-    wallet_details = wallet_instance[0].__dict__
-    # if wallet is not active
-    if not wallet_details:
-        raise ValueError("Wallet not found!")
-    if not wallet_details.get("is_enabled"):
-        raise OperationalError("Wallet disabled!")
-
-    # update wallet balance
-    amount_to_process = user_data.get("amount")
-
-    if amount_to_process <= 0:
-        raise OperationalError("invalid amount!")
-    final_amount = amount_to_process + wallet_details.get("amount")
-    await ORMWrapper.update_with_filters(
-        wallet_instance[0],
-        Wallet,
-        {
-            "amount": final_amount,
-        }
-    )
-
-    # add entry in transactions DB
-    reference_id = user_data.get("reference_id")
-    transaction_details = await ORMWrapper.create(Transactions, {
-        "amount": amount_to_process,
-        "status": TransactionStatus.SUCCESS.value,
-        "transaction_time": datetime.now(),
-        "transaction_from": user_details.get("customer_xid"),
-        "transaction_to": "self",
-        "transaction_type": TransactionStatus.DEPOSIT.value,
-        "reference_id": reference_id,
-        "final_amount": final_amount
-    })
-    transaction_details = transaction_details.__dict__
-    result_data = {
-        "id": transaction_details.get("id"),
-        "deposited_by": user_details.get("customer_xid"),
-        "deposited_at": str(transaction_details.get("transaction_time")),
-        "amount": amount_to_process,
-        "final_amount": final_amount,
-        "transaction_type": TransactionStatus.DEPOSIT.value,
-        "reference_id": reference_id
-    }
-    return await send_response(data=result_data)
+    return await _apply_wallet_transaction(auth_token, user_data, TransactionStatus.DEPOSIT.value)
 
 
 # Use virtual money from my wallet
@@ -220,7 +340,9 @@ async def add_wallet_balance(request: Request):
 async def withdraw_money_from_wallet(request: Request):
     """
         This route is responsible for withdrawal balance
-        in wallet based on auth token and amount given
+        in wallet based on auth token and amount given.
+        A retry with the reference_id of a settled withdrawal gets the
+        original transaction back, nothing is applied twice.
 
         Args:
             request: request with Authorization token
@@ -236,58 +358,174 @@ async def withdraw_money_from_wallet(request: Request):
     """
     auth_token = request.headers.get("Authorization")
     user_data = request.json
-    user_details = await get_user_details(auth_token)
+    return await _apply_wallet_transaction(auth_token, user_data, TransactionStatus.WITHDRAWAL.value)
+
 
-    # fetch wallet details based on customer_xid
-    wallet_instance = await ORMWrapper.get_by_filters(Wallet, {
-        "customer_xid": user_details.get("customer_xid")
-    })
-    wallet_details = wallet_instance[0].__dict__
+async def _apply_wallet_transaction(auth_token: str, user_data: dict, transaction_type: str):
+    # a retried request is answered from the idempotency index, before
+    # the wallet row is read
+    user_details = await get_user_details(auth_token)
+    customer_xid = user_details.get("customer_xid")
+    if not isinstance(user_data, dict):
+        raise ValueError("Missing or invalid data for required field.")
+    amount_to_process = user_data.get("amount")
+    if type(amount_to_process) != int or amount_to_process <= 0:
+        raise OperationalError("invalid amount!")
+    reference_id = user_data.get("reference_id")
+    if not valid_reference_id(reference_id):
+        raise ValueError("invalid reference_id!")
+    transaction_details = idempotency_index.lookup(customer_xid, reference_id, transaction_type, amount_to_process)
+    if transaction_details:
+        return await _send_replay(transaction_response_formatter(transaction_details))
+
+    # fetch user and wallet details in one go
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
     # if wallet is not active
     if not wallet_details:
         raise ValueError("Wallet not found!")
     if not wallet_details.get("is_enabled"):
         raise OperationalError("Wallet disabled!")
 
-    # update wallet balance
-    amount_to_process = user_data.get("amount")
+    # update wallet balance and add entry in transactions DB atomically,
+    # deposits are possibly group committed with concurrent deposits to
+    # this wallet, insufficient balance is rejected by the database
+    try:
+        if transaction_type == TransactionStatus.DEPOSIT.value:
+            transaction_details = await deposit_coalescer.deposit(customer_xid, amount_to_process, reference_id)
+        else:
+            transaction_details = await apply_balance_change(
+                customer_xid, amount_to_process, transaction_type, reference_id
+            )
+    except IntegrityError:
+        # reference_id settled earlier, by another worker or long ago
+        transaction_details = await idempotency_index.load(
+            customer_xid, reference_id, transaction_type, amount_to_process
+        )
+        if not transaction_details:
+            raise
+        return await _send_replay(transaction_response_formatter(transaction_details))
+
+    transaction_details = dict(
+        transaction_details,
+        amount=amount_to_process,
+        transaction_from=customer_xid,
+        transaction_type=transaction_type,
+        reference_id=reference_id
+    )
+    idempotency_index.remember(transaction_details)
+    return await send_response(data=transaction_response_formatter(transaction_details))
+
 
-    if amount_to_process <= 0:
+async def _send_replay(result_data: dict):
+    return await send_response(data=result_data, headers={"Idempotent-Replayed": "true"})
+
+
+# Send virtual money to another wallet
+@wallet.route('/wallet/transfers', methods=['POST'])
+@exceptions_handler
+async def transfer_money(request: Request):
+    """
+        This route is responsible for moving balance from the wallet
+        of the token owner to the wallet of another customer, both
+        balances and both ledger entries change atomically.
+        A retry with the reference_id of a settled transfer gets the
+        original transfer back, nothing is applied twice.
+
+        Args:
+            request: request with Authorization token and json with
+            "to" (customer_xid of the receiver), "amount" and
+            "reference_id"
+
+        Returns:
+            Returns json of resultant data, with these parameters.
+              "id": id of the sender's transaction
+              "transferred_by": customer_xid of the sender
+              "transferred_to": customer_xid of the receiver
+              "transferred_at": time of transfer
+              "amount": amount moved
+              "final_amount": balance of the sender after the transfer
+              "reference_id": unique id of transaction
+    """
+    auth_token = request.headers.get("Authorization")
+    user_data = request.json or {}
+    amount_to_process = user_data.get("amount")
+    if type(amount_to_process) != int or amount_to_process <= 0:
         raise OperationalError("invalid amount!")
+    receiver_xid = user_data.get("to")
+    if not receiver_xid:
+        raise ValueError("Missing or invalid data for required field.")
+    reference_id = user_data.get("reference_id")
 
-    # if account doesn't have that much balance
-    wallet_balance = wallet_details.get("amount")
-    if wallet_balance < amount_to_process:
-        raise OperationalError("Insufficient balance!")
-
-    final_amount = wallet_details.get("amount") - amount_to_process
-    await ORMWrapper.update_with_filters(
-        wallet_instance[0],
-        Wallet,
-        {
-            "amount": final_amount,
-        }
+    # both wallets are checked by apply_transfer under lock, only the
+    # user is needed here
+    user_details = await get_user_details(auth_token)
+    customer_xid = user_details.get("customer_xid")
+    transaction_type = TransactionStatus.TRANSFER_OUT.value
+    transaction_details = idempotency_index.lookup(customer_xid, reference_id, transaction_type, amount_to_process)
+    if transaction_details:
+        return await _send_replay(transfer_response_formatter(transaction_details))
+
+    try:
+        transaction_details = await apply_transfer(customer_xid, receiver_xid, amount_to_process, reference_id)
+    except IntegrityError:
+        # a cross shard transfer may have been refunded or not be settled
+        # yet, only a settled one is replayed (and then remembered)
+        await check_transfer_settled(customer_xid, reference_id)
+        transaction_details = await idempotency_index.load(
+            customer_xid, reference_id, transaction_type, amount_to_process
+        )
+        if not transaction_details:
+            raise
+        return await _send_replay(transfer_response_formatter(transaction_details))
+
+    transaction_details = dict(
+        transaction_details,
+        amount=amount_to_process,
+        transaction_to=receiver_xid,
+        transaction_type=transaction_type,
+        reference_id=reference_id
     )
+    idempotency_index.remember(transaction_details)
+    return await send_response(data=transfer_response_formatter(transaction_details))
 
-    # add entry in transactions DB
-    reference_id = user_data.get("reference_id")
-    transaction_details = await ORMWrapper.create(Transactions, {
-        "amount": amount_to_process,
-        "status": TransactionStatus.SUCCESS.value,
-        "transaction_time": datetime.now(),
-        "transaction_from": user_details.get("customer_xid"),
-        "transaction_to": "self",
-        "reference_id": reference_id
-    })
-    transaction_details = transaction_details.__dict__
+
+# Settle many deposits and withdrawals in one call
+@wallet.route('/wallet/batch', methods=['POST'])
+@exceptions_handler
+async def apply_wallet_batch(request: Request):
+    """
+        This route is responsible for applying a batch of deposits
+        and withdrawals to the wallet, in the given order. Each
+        item succeeds or fails on its own.
+
+        Args:
+            request: request with Authorization token and a json array
+            of items with "amount", "reference_id" and "type"
+            (deposit or withdrawal)
+
+        Returns:
+            Returns json of resultant data, with these parameters.
+              "balance": balance of the wallet after the batch
+              "results": per item "reference_id", "status" and either
+              "final_amount" or "error"
+    """
+    auth_token = request.headers.get("Authorization")
+    items = request.json
+    if not items or not isinstance(items, list):
+        raise ValueError("Missing or invalid data for required field.")
+
+    # fetch user and wallet details in one go
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
+    if not wallet_details:
+        raise ValueError("Wallet not found!")
+    if not wallet_details.get("is_enabled"):
+        raise OperationalError("Wallet disabled!")
+
+    balance, results = await apply_transaction_batch(user_details.get("customer_xid"), items)
     result_data = {
-        "id": transaction_details.get("id"),
-        "deposited_by": user_details.get("customer_xid"),
-        "deposited_at": str(transaction_details.get("transaction_time")),
-        "amount": amount_to_process,
-        "final_amount": final_amount,
-        "transaction_type": TransactionStatus.WITHDRAWAL.value,
-        "reference_id": reference_id
+        "owned_by": user_details.get("customer_xid"),
+        "balance": balance,
+        "results": results
     }
     return await send_response(data=result_data)
 
@@ -312,13 +550,9 @@ async def disable_wallet(request: Request):
     """
     # if token wrong or not given
     auth_token = request.headers.get("Authorization")
-    user_details = await get_user_details(auth_token)
 
-    # fetch wallet details based on customer_xid
-    wallet_instance = await ORMWrapper.get_by_filters(Wallet, {
-        "customer_xid": user_details.get("customer_xid")
-    })
-    wallet_details = wallet_instance[0].__dict__
+    # fetch user and wallet details in one go
+    user_details, wallet_details = await get_user_wallet_details(auth_token)
     if not wallet_details:
         raise OperationalError()
 
@@ -327,13 +561,18 @@ async def disable_wallet(request: Request):
         raise ValueError("Wallet disabled!")
 
     # update wallet details - disable wallet
-    await ORMWrapper.update_with_filters(
-        wallet_instance[0],
-        Wallet,
-        {
-            "is_enabled": WalletStatus.DISABLED.value,
-        }
-    )
+    with wallet_state_cache.write(user_details.get("customer_xid")) as write:
+        await ORMWrapper.update_with_filters(
+            None,
+            Wallet,
+            {
+                "is_enabled": WalletStatus.DISABLED.value,
+            },
+            where_clause={"id": wallet_details.get("id")},
+            customer_xid=user_details.get("customer_xid")
+        )
+        write.update(is_enabled=WalletStatus.DISABLED.value)
+    replica_router.record_write(user_details.get("customer_xid"))
     wallet_details["is_enabled"] = WalletStatus.DISABLED.value
     result_json = wallet_response_formatter(user_details, wallet_details)
     return await send_response(data=result_json, status_code=HTTPStatusCodes.SUCCESS.value)
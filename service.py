@@ -1,11 +1,28 @@
-from datetime import datetime
+import os
+import time
 from urllib.request import Request
 
-import aiofiles
 import ujson
 from sanic import Sanic, response
 from tortoise.contrib.sanic import register_tortoise
 
+from managers.admission import admission_controller, admission_key, AdmissionConstant, AdmissionRejected
+from managers.coalescer import deposit_coalescer, CoalescerConstant
+from managers.database import build_tortoise_config, database_topology, generate_primary_schema, warm_pools, \
+    startup_timer, DatabaseConstant
+from managers.fast_path import prepared_statements
+from managers.helpers import send_response
+from managers.metrics import metrics, instrument_pools
+from managers.orm_wrappers import batch_loader, ORMConstant
+from managers.outbox import outbox_publisher, build_sink, OutboxConstant
+from managers.profiler import query_profiler, ProfilerConstant
+from managers.replicas import replica_router, ReplicaConstant
+from managers.request_logger import request_logger, RequestLogConstant
+from managers.shards import shard_map
+from managers.smoke_load import smoke_loader, SmokeLoadConstant
+from managers.snapshots import balance_snapshotter, SnapshotConstant
+from managers.transfers import transfer_recovery, TransferRecoveryConstant
+from managers.wallet_cache import wallet_state_cache, WalletCacheConstant
 from routes import blueprint_group
 
 
@@ -26,29 +43,128 @@ if __name__ == '__main__':
     app.run(debug=True)
 
 
-async def log_request(request: Request):
+@app.middleware('request')
+async def call_logger(request: Request):
+
     """
-        This functions logs all incoming request in request.log file.
+        This is a middleware which logs all incoming requests
+        and store all requests in request.log file in async
+        manner, batched by a single writer task (see RequestLogger).
     """
+    request_logger.log(request)
 
-    async with aiofiles.open('request.log', 'a') as f:
-        await f.write(f"Request method: {request.method}\n")
-        await f.write(f"Request Host: {request.headers.get('Host')}\n")
-        await f.write(f"Request URL: {request.url}\n")
-        await f.write(f"Request headers: {request.headers}\n")
-        await f.write(f"Request data: {request.json}\n")
-        await f.write(f"Request time: {datetime.now()}\n\n")
+
+@app.middleware('request')
+async def start_request_timer(request: Request):
+    request.ctx.started_at = time.perf_counter()
+    startup_timer.first_request()
+    query_profiler.start_request(f"/{request.route.path}" if request.route else request.path)
 
 
 @app.middleware('request')
-async def call_logger(request: Request):
+async def admit_request(request: Request):
+    """
+        Admission control of the db bound routes (see
+        AdmissionController), a refused request is answered right away
+        with 429, 503 or 408 and a Retry-After header.
+    """
+    if not admission_controller.enabled or not request.route:
+        return
+    if admission_controller.exempt(f"/{request.route.path}"):
+        return
+    try:
+        ticket = await admission_controller.admit(admission_key(request))
+    except AdmissionRejected as ex:
+        return await send_response(data={"error": str(ex)}, status_code=ex.status_code,
+                                   headers={"Retry-After": str(ex.retry_after)})
+    request.ctx.admission = ticket
+    # response middleware is skipped when the client disconnects mid
+    # request, the connection close releases the slot then
+    if request.conn_info:
+        request.conn_info.ctx.admission = ticket
+
+
+@app.middleware('response')
+async def release_admission(request: Request, response):
+    ticket = getattr(request.ctx, "admission", None)
+    if ticket is not None:
+        ticket.release()
 
+
+@app.signal('http.lifecycle.complete')
+async def release_admission_on_close(conn_info):
+    ticket = getattr(conn_info.ctx, "admission", None)
+    if ticket is not None:
+        ticket.release()
+
+
+@app.middleware('response')
+async def record_request_latency(request: Request, response):
     """
-        This is a middleware which logs all incoming requests
-        and store all requests in request.log file in async
-        manner.
+        Records the latency of every request per route, method and
+        status code for the /metrics endpoint.
     """
-    await log_request(request)
+    started_at = getattr(request.ctx, "started_at", None)
+    if started_at is None:
+        return
+    route = f"/{request.route.path}" if request.route else "unmatched"
+    metrics.observe_request(route, request.method, response.status, time.perf_counter() - started_at)
+
+
+@app.listener('after_server_start')
+async def start_request_logger(app, loop):
+    request_logger.start()
+
+
+@app.listener('after_server_start')
+async def start_pool_metrics(app, loop):
+    instrument_pools()
+    startup_timer.mark("ready")
+
+
+@app.listener('before_server_stop')
+async def stop_request_logger(app, loop):
+    await request_logger.stop()
+
+
+@app.listener('after_server_start')
+async def start_wallet_cache(app, loop):
+    wallet_state_cache.start()
+
+
+@app.listener('before_server_stop')
+async def stop_wallet_cache(app, loop):
+    wallet_state_cache.stop()
+
+
+@app.listener('after_server_start')
+async def start_balance_snapshots(app, loop):
+    balance_snapshotter.start()
+
+
+@app.listener('before_server_stop')
+async def stop_balance_snapshots(app, loop):
+    await balance_snapshotter.stop()
+
+
+@app.listener('after_server_start')
+async def start_transfer_recovery(app, loop):
+    transfer_recovery.start()
+
+
+@app.listener('before_server_stop')
+async def stop_transfer_recovery(app, loop):
+    await transfer_recovery.stop()
+
+
+@app.listener('after_server_start')
+async def start_outbox_publisher(app, loop):
+    outbox_publisher.start()
+
+
+@app.listener('before_server_stop')
+async def stop_outbox_publisher(app, loop):
+    await outbox_publisher.stop()
 
 
 def json_file_to_dict(_file: str) -> dict:
@@ -72,11 +188,132 @@ def json_file_to_dict(_file: str) -> dict:
 
 
 class CONFIG:
-    config = json_file_to_dict("config.json")
+    # CONFIG_FILE lets tools (e.g. benchmarks) boot the app on another setup
+    config = json_file_to_dict(os.environ.get("CONFIG_FILE", "config.json"))
+
+
+request_log = CONFIG.config.get("REQUEST_LOG", {})
+request_logger.configure(
+    path=request_log.get("PATH", RequestLogConstant.PATH.value),
+    log_format=request_log.get("FORMAT", RequestLogConstant.FORMAT.value),
+    sample_rate=request_log.get("SAMPLE_RATE", RequestLogConstant.SAMPLE_RATE.value),
+    queue_size=request_log.get("QUEUE_SIZE", RequestLogConstant.QUEUE_SIZE.value),
+    batch_size=request_log.get("BATCH_SIZE", RequestLogConstant.BATCH_SIZE.value),
+    flush_interval_ms=request_log.get("FLUSH_INTERVAL_MS", RequestLogConstant.FLUSH_INTERVAL_MS.value),
+    max_file_bytes=request_log.get("MAX_FILE_BYTES", RequestLogConstant.MAX_FILE_BYTES.value),
+    backup_count=request_log.get("BACKUP_COUNT", RequestLogConstant.BACKUP_COUNT.value),
+)
+
+profiling = CONFIG.config.get("QUERY_PROFILER", {})
+query_profiler.configure(
+    enabled=profiling.get("ENABLED", False),
+    slow_query_ms=profiling.get("SLOW_QUERY_MS", ProfilerConstant.SLOW_QUERY_MS.value),
+    explain_sample_rate=profiling.get("EXPLAIN_SAMPLE_RATE", ProfilerConstant.EXPLAIN_SAMPLE_RATE.value),
+)
+
+admission = CONFIG.config.get("ADMISSION_CONTROL", {})
+admission_controller.configure(
+    enabled=admission.get("ENABLED", False),
+    rate_per_s=admission.get("RATE_PER_S", AdmissionConstant.RATE_PER_S.value),
+    burst=admission.get("BURST", AdmissionConstant.BURST.value),
+    max_in_flight=admission.get("MAX_IN_FLIGHT", AdmissionConstant.MAX_IN_FLIGHT.value),
+    max_queue=admission.get("MAX_QUEUE", AdmissionConstant.MAX_QUEUE.value),
+    queue_timeout_ms=admission.get("QUEUE_TIMEOUT_MS", AdmissionConstant.QUEUE_TIMEOUT_MS.value),
+    max_buckets=admission.get("MAX_BUCKETS", AdmissionConstant.MAX_BUCKETS.value),
+)
+
+smoke_load = CONFIG.config.get("SMOKE_LOAD", {})
+smoke_loader.configure(
+    enabled=smoke_load.get("ENABLED", False),
+    token=smoke_load.get("TOKEN"),
+    max_requests=smoke_load.get("MAX_REQUESTS", SmokeLoadConstant.MAX_REQUESTS.value),
+    max_concurrency=smoke_load.get("MAX_CONCURRENCY", SmokeLoadConstant.MAX_CONCURRENCY.value),
+    timeout_s=smoke_load.get("TIMEOUT_S", SmokeLoadConstant.TIMEOUT_S.value),
+)
 
+loader = CONFIG.config.get("BATCH_LOADER", {})
+batch_loader.configure(
+    enabled=loader.get("ENABLED", False),
+    max_batch_keys=loader.get("MAX_BATCH_KEYS", ORMConstant.MAX_BATCH_KEYS.value),
+)
+
+fast_path = CONFIG.config.get("FAST_PATH", {})
+prepared_statements.configure(enabled=fast_path.get("ENABLED", False))
+
+wallet_cache = CONFIG.config.get("WALLET_CACHE", {})
+wallet_state_cache.configure(
+    enabled=wallet_cache.get("ENABLED", False),
+    max_size=wallet_cache.get("MAX_SIZE", WalletCacheConstant.MAX_SIZE.value),
+    ttl_s=wallet_cache.get("TTL_S", WalletCacheConstant.TTL.value),
+    invalidation_dir=wallet_cache.get("INVALIDATION_DIR"),
+)
+
+deposit_coalescing = CONFIG.config.get("DEPOSIT_COALESCING", {})
+deposit_coalescer.configure(
+    enabled=deposit_coalescing.get("ENABLED", False),
+    window_ms=deposit_coalescing.get("WINDOW_MS", CoalescerConstant.WINDOW_MS.value),
+    max_batch=deposit_coalescing.get("MAX_BATCH", CoalescerConstant.MAX_BATCH.value),
+)
+
+balance_snapshots = CONFIG.config.get("BALANCE_SNAPSHOTS", {})
+balance_snapshotter.configure(
+    enabled=balance_snapshots.get("ENABLED", False),
+    interval_s=balance_snapshots.get("INTERVAL_S", SnapshotConstant.INTERVAL_S.value),
+    every_transactions=balance_snapshots.get("EVERY_TRANSACTIONS", SnapshotConstant.EVERY_TRANSACTIONS.value),
+    settle_seconds=balance_snapshots.get("SETTLE_SECONDS", SnapshotConstant.SETTLE_SECONDS.value),
+)
 
-register_tortoise(
-    app, db_url=CONFIG.config["DB_URL"],
-    modules={"models": ["models"]},
-    generate_schemas=True
+recovery = CONFIG.config.get("TRANSFER_RECOVERY", {})
+transfer_recovery.configure(
+    enabled=recovery.get("ENABLED", True),
+    interval_s=recovery.get("INTERVAL_S", TransferRecoveryConstant.INTERVAL_S.value),
+    batch_size=recovery.get("BATCH_SIZE", TransferRecoveryConstant.BATCH_SIZE.value),
 )
+
+outbox = CONFIG.config.get("OUTBOX", {})
+outbox_publisher.configure(
+    enabled=outbox.get("ENABLED", False),
+    sink=build_sink(outbox.get("SINK", OutboxConstant.SINK.value),
+                    outbox.get("SINK_PATH", OutboxConstant.SINK_PATH.value)),
+    batch_size=outbox.get("BATCH_SIZE", OutboxConstant.BATCH_SIZE.value),
+    poll_interval_ms=outbox.get("POLL_INTERVAL_MS", OutboxConstant.POLL_INTERVAL_MS.value),
+    backoff_min_ms=outbox.get("BACKOFF_MIN_MS", OutboxConstant.BACKOFF_MIN_MS.value),
+    backoff_max_ms=outbox.get("BACKOFF_MAX_MS", OutboxConstant.BACKOFF_MAX_MS.value),
+    sink_timeout_s=outbox.get("SINK_TIMEOUT_S", OutboxConstant.SINK_TIMEOUT_S.value),
+    lease_s=outbox.get("LEASE_S", OutboxConstant.LEASE_S.value),
+)
+
+database = CONFIG.config.get("DATABASE", {})
+read_replicas = CONFIG.config.get("READ_REPLICAS", {})
+sharding = CONFIG.config.get("SHARDING", {})
+# DB_URL and READ_REPLICAS are shard 0, SHARDING.SHARDS the further ones
+tortoise_config = build_tortoise_config(
+    CONFIG.config["DB_URL"], database.get("POOL"), read_replicas.get("URLS", []), sharding.get("SHARDS", [])
+)
+topology = database_topology(read_replicas.get("URLS", []), sharding.get("SHARDS", []))
+shard_map.configure(
+    shards=list(topology),
+    slots=sharding.get("SLOTS"),
+    frozen_slots=sharding.get("FROZEN_SLOTS", []),
+)
+replica_router.configure(
+    replicas=topology,
+    read_your_writes_ms=read_replicas.get("READ_YOUR_WRITES_MS", ReplicaConstant.READ_YOUR_WRITES_MS.value),
+    failover_cooldown_s=read_replicas.get("FAILOVER_COOLDOWN_S", ReplicaConstant.FAILOVER_COOLDOWN_S.value),
+)
+# schemas are generated by prepare_database, on the primary only
+register_tortoise(app, config=tortoise_config, generate_schemas=False)
+startup_timer.mark("configured")
+
+
+# registered after register_tortoise, so it runs once the ORM is up
+@app.listener('before_server_start')
+async def prepare_database(app, loop):
+    startup_timer.mark("orm_ready")
+    # production sets this to false, dbmate migrations own the schema
+    if database.get("GENERATE_SCHEMAS", DatabaseConstant.GENERATE_SCHEMAS.value):
+        await generate_primary_schema()
+        startup_timer.mark("schema_ready")
+    if database.get("WARM_POOL", DatabaseConstant.WARM_POOL.value):
+        await warm_pools()
+        startup_timer.mark("pool_warm")
@@ -0,0 +1,54 @@
+import unittest
+from unittest import mock
+
+from tortoise.exceptions import DBConnectionError, OperationalError
+
+from managers.orm_wrappers import ORMWrapper
+from managers.replicas import replica_router, ReplicaConstant
+
+PRIMARY = ReplicaConstant.PRIMARY.value
+REPLICA = ReplicaConstant.CONNECTION_PREFIX.value + "0"
+
+
+class ReplicaFailoverTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        replica_router.configure(replicas={PRIMARY: [REPLICA]})
+        replica_router._down_until.clear()
+        replica_router.failovers = 0
+        # connections stand for their name, no database is opened
+        patcher = mock.patch("managers.orm_wrappers.Tortoise.get_connection", side_effect=lambda name: name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(replica_router.configure)
+
+    async def test_syntax_error_does_not_fail_over(self):
+        tried = []
+
+        async def read(connection):
+            tried.append(connection)
+            raise OperationalError('syntax error at or near "SELEC"')
+
+        with self.assertRaises(OperationalError):
+            await ORMWrapper._read(read)
+        self.assertEqual(tried, [REPLICA])
+        self.assertEqual(replica_router.failovers, 0)
+        self.assertEqual(replica_router.read_connection(), REPLICA)
+
+    async def test_connection_error_fails_over_to_the_primary(self):
+        tried = []
+
+        async def read(connection):
+            tried.append(connection)
+            if connection == REPLICA:
+                raise DBConnectionError("connection refused")
+            return ["row"]
+
+        self.assertEqual(await ORMWrapper._read(read), ["row"])
+        self.assertEqual(tried, [REPLICA, PRIMARY])
+        self.assertEqual(replica_router.failovers, 1)
+        self.assertEqual(replica_router.read_connection(), PRIMARY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+    Builds the daily summary (wallet_daily_summary) of every wallet from
+    its transactions, on every shard.
+
+    The ledger keeps the summary of the current day up to date from the
+    deploy on, so the backfill only rebuilds the days before --before,
+    today (UTC) by default. Run it once after the deploy, and again the
+    day after to complete the day of the deploy. Already built days are
+    rebuilt, so it can be run any number of times.
+
+    Usage:
+        python -m tools.backfill_summaries
+        python -m tools.backfill_summaries --config config.json --before 2026-10-18
+"""
+import argparse
+import asyncio
+from datetime import date, datetime, timezone
+
+import ujson
+from tortoise import Tortoise
+
+from managers.orm_wrappers import ORMWrapper
+from managers.rollups import backfill_daily_summary
+from models import Wallet
+from tools.rebalance import init_shards, RebalanceConstant
+
+
+async def backfill(config: dict, before: date):
+    shards = await init_shards(config)
+    try:
+        for shard in shards.shards:
+            wallets = await ORMWrapper.get_values_by_filters(Wallet, {}, ["customer_xid"], shard=shard)
+            for wallet in wallets:
+                await backfill_daily_summary(wallet["customer_xid"], before, connection=shard)
+            print(f"{shard}: {len(wallets)} wallets backfilled before {before}")
+    finally:
+        await Tortoise.close_connections()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the daily summaries of every wallet.")
+    parser.add_argument("--config", default=RebalanceConstant.CONFIG_FILE.value)
+    parser.add_argument("--before", type=date.fromisoformat, default=datetime.now(timezone.utc).date(),
+                        help="first day left to the ledger, today (UTC) by default")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config) as config_file:
+        config = ujson.load(config_file)
+    asyncio.run(backfill(config, args.before))
+
+
+if __name__ == '__main__':
+    main()
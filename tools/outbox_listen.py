@@ -0,0 +1,69 @@
+"""
+    Stand-in consumer of the unix_socket outbox sink (see managers/outbox.py),
+    for local runs and tests. Listens on a unix socket, appends every event
+    received to a json lines file (stdout by default) and acknowledges each
+    batch once written. Events sent twice (at least once delivery) are
+    written twice, dedupe by event_id downstream.
+
+    Usage:
+        python -m tools.outbox_listen --socket /tmp/wallet_events.sock
+        python -m tools.outbox_listen --socket /tmp/wallet_events.sock --output events.jsonl
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from managers.outbox import OutboxConstant
+
+
+async def handle(reader, writer, output):
+    try:
+        while True:
+            # a batch ends with an empty line, acknowledged once written
+            lines = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if line == b"\n":
+                    break
+                lines.append(line)
+            output.write(b"".join(lines).decode())
+            output.flush()
+            writer.write(OutboxConstant.SINK_ACK.value + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def listen(socket_path, output):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(lambda reader, writer: handle(reader, writer, output), socket_path)
+    print(f"listening on {socket_path}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Receive wallet outbox events on a unix socket.")
+    parser.add_argument("--socket", required=True, help="path of the unix socket, SINK_PATH of the OUTBOX config")
+    parser.add_argument("--output", help="json lines file to append the events to, stdout by default")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        asyncio.run(listen(args.socket, output))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+    Moves customers between shards after a change of SHARDING.SLOTS.
+
+    The config given lists every shard, those being drained included, and
+    the new slot assignment. Customers sitting on a shard that no longer
+    owns their slot are copied to the shard that does, then deleted from
+    the old one. Balance snapshots are not copied, the snapshot job builds
+    them again on the new shard, daily summaries are rebuilt from the
+    copied transactions.
+
+    Usage:
+        python -m tools.rebalance plan --config new_config.json
+        python -m tools.rebalance copy --config new_config.json
+        python -m tools.rebalance cleanup --config new_config.json
+
+    Procedure:
+        1. plan prints the slots that move, deploy them as
+           SHARDING.FROZEN_SLOTS of the running config, writes to their
+           customers are refused from then on. It also lists the
+           customers that can't move yet, see blocked_customers
+        2. copy copies the moving customers to their new shard, customers
+           already there are skipped so it can be run again. Nothing is
+           copied while a customer is blocked
+        3. deploy the new config, with the new SLOTS and no FROZEN_SLOTS
+        4. cleanup deletes the moved customers from their old shard
+"""
+import argparse
+import asyncio
+import sys
+from collections import defaultdict
+from datetime import date
+from enum import Enum
+
+import ujson
+from tortoise import Tortoise
+
+from constants.queries import COPY_TRANSACTIONS, COPY_TRANSACTION, IN_LIST, USED_REFERENCE_IDS
+from managers.database import build_tortoise_config, database_topology
+from managers.helpers import list_parameter
+from managers.orm_wrappers import ORMWrapper
+from managers.rollups import backfill_daily_summary
+from managers.shards import ShardMap, format_slot_ranges
+from models import Users, Wallet, Transactions, BalanceSnapshots, WalletDailySummary, TransferIntents
+
+
+class RebalanceConstant(Enum):
+    CONFIG_FILE = "config.json"
+    COMMANDS = ("plan", "copy", "cleanup")
+    USER_FIELDS = ("customer_xid", "token")
+    WALLET_FIELDS = ("customer_xid", "amount", "enabled_at", "is_enabled")
+    TRANSACTION_FIELDS = ("amount", "final_amount", "status", "transaction_time",
+                          "transaction_from", "transaction_to", "transaction_type", "reference_id")
+    COPY_BATCH_SIZE = 1000
+
+
+async def init_shards(config: dict):
+    """
+        Opens a connection to the primary of every shard of config.
+        :return: ShardMap of config
+    """
+    sharding = config.get("SHARDING", {})
+    await Tortoise.init(config=build_tortoise_config(
+        config["DB_URL"], config.get("DATABASE", {}).get("POOL"), shards=sharding.get("SHARDS", [])
+    ))
+    shards = ShardMap()
+    shards.configure(shards=list(database_topology(shards=sharding.get("SHARDS", []))), slots=sharding.get("SLOTS"))
+    return shards
+
+
+async def misplaced_customers(shards: ShardMap):
+    """
+        :return: {(source shard, target shard): [customer_xid]} of the
+        customers on a shard that doesn't own their slot
+    """
+    moves = defaultdict(list)
+    for source in shards.shards:
+        for row in await ORMWrapper.get_values_by_filters(Users, {}, ["customer_xid"], shard=source):
+            target = shards.shard_of_slot(shards.slot(row["customer_xid"]))
+            if target != source:
+                moves[(source, target)].append(row["customer_xid"])
+    return moves
+
+
+async def blocked_customers(moves: dict):
+    """
+        Customers that can't be moved yet: a reference_id of their ledger
+        is already taken on the target shard (reference_ids are unique per
+        shard, a customer moving there from another shard counts too), or
+        a cross shard transfer they sent is not settled yet (its intent
+        stays on the source shard). Customers already copied are left out.
+        :param moves: misplaced_customers
+        :return: {customer_xid: reason}
+    """
+    blocked = {}
+    moving_reference_ids = defaultdict(set)
+    for (source, target), customers in moves.items():
+        dialect = Tortoise.get_connection(target).capabilities.dialect
+        used_query = USED_REFERENCE_IDS.format(reference_ids=IN_LIST[dialect].format(column="reference_id"))
+        for customer_xid in customers:
+            if await ORMWrapper.get_values_by_filters(Users, {"customer_xid": customer_xid}, ["id"], shard=target,
+                                                      primary=True):
+                continue
+            if await ORMWrapper.get_values_by_filters(TransferIntents, {"sender_xid": customer_xid}, ["id"],
+                                                      shard=source, primary=True):
+                blocked[customer_xid] = "cross shard transfers not settled yet"
+                continue
+            rows = await ORMWrapper.get_values_by_filters(
+                Transactions, {"transaction_from": customer_xid}, ["reference_id"], shard=source, primary=True
+            )
+            reference_ids = [row["reference_id"] for row in rows]
+            if not reference_ids:
+                continue
+            used = {row["reference_id"] for row in await ORMWrapper.raw_sql(
+                used_query, [list_parameter(reference_ids, dialect)], connection=target, primary=True
+            )}
+            used.update(moving_reference_ids[target].intersection(reference_ids))
+            if used:
+                blocked[customer_xid] = f"reference_ids taken on {target}: {', '.join(sorted(used))}"
+            moving_reference_ids[target].update(reference_ids)
+    return blocked
+
+
+async def copy_customer(customer_xid: str, source: str, target: str):
+    """
+        Copies the user, wallet and transactions of a customer from source
+        to target, and builds its daily summary there, in one transaction
+        of target.
+        :return: False if target already had the customer
+    """
+    if await ORMWrapper.get_values_by_filters(Users, {"customer_xid": customer_xid}, ["id"], shard=target,
+                                              primary=True):
+        return False
+
+    users = await ORMWrapper.get_values_by_filters(
+        Users, {"customer_xid": customer_xid}, list(RebalanceConstant.USER_FIELDS.value), shard=source, primary=True
+    )
+    wallets = await ORMWrapper.get_values_by_filters(
+        Wallet, {"customer_xid": customer_xid}, list(RebalanceConstant.WALLET_FIELDS.value), shard=source,
+        primary=True
+    )
+    transactions = await ORMWrapper.get_values_by_filters(
+        Transactions, {"transaction_from": customer_xid}, ["id", *RebalanceConstant.TRANSACTION_FIELDS.value],
+        shard=source, primary=True
+    )
+    transactions.sort(key=lambda row: (row["transaction_time"], row["id"]))
+
+    async with ORMWrapper.in_transaction(target) as connection:
+        await ORMWrapper.bulk_create(Users, users, using_db=connection)
+        await ORMWrapper.bulk_create(Wallet, wallets, using_db=connection)
+        await _copy_transactions(transactions, connection)
+        # the slot is frozen, every day of the customer is settled
+        await backfill_daily_summary(customer_xid, date.max, connection)
+    return True
+
+
+async def _copy_transactions(transactions, connection):
+    # raw sql, bulk_create would stamp transaction_time (auto_now) with now
+    fields = RebalanceConstant.TRANSACTION_FIELDS.value
+    if connection.capabilities.dialect == "postgres":
+        batch_size = RebalanceConstant.COPY_BATCH_SIZE.value
+        for start in range(0, len(transactions), batch_size):
+            batch = transactions[start:start + batch_size]
+            await ORMWrapper.raw_sql(COPY_TRANSACTIONS, [[row[field] for row in batch] for field in fields],
+                                     connection)
+    else:
+        for row in transactions:
+            await ORMWrapper.raw_sql(COPY_TRANSACTION, [row[field] for field in fields], connection)
+
+
+async def delete_customer(customer_xid: str, source: str, target: str):
+    """
+        Deletes a customer from source, once target has it.
+        :return: False if target doesn't have the customer yet
+    """
+    if not await ORMWrapper.get_values_by_filters(Users, {"customer_xid": customer_xid}, ["id"], shard=target,
+                                                  primary=True):
+        return False
+    async with ORMWrapper.in_transaction(source) as connection:
+        await Transactions.filter(transaction_from=customer_xid).using_db(connection).delete()
+        await BalanceSnapshots.filter(customer_xid=customer_xid).using_db(connection).delete()
+        await WalletDailySummary.filter(customer_xid=customer_xid).using_db(connection).delete()
+        await Wallet.filter(customer_xid=customer_xid).using_db(connection).delete()
+        await Users.filter(customer_xid=customer_xid).using_db(connection).delete()
+    return True
+
+
+async def rebalance(command: str, config: dict):
+    shards = await init_shards(config)
+    try:
+        moves = await misplaced_customers(shards)
+        blocked = await blocked_customers(moves) if command != "cleanup" else {}
+        for customer_xid, reason in blocked.items():
+            print(f"blocked {customer_xid}: {reason}", file=sys.stderr)
+        if command == "plan":
+            slots = {shards.slot(customer_xid) for customers in moves.values() for customer_xid in customers}
+            for (source, target), customers in moves.items():
+                print(f"{source} -> {target}: {len(customers)} customers")
+            print("FROZEN_SLOTS", ujson.dumps(format_slot_ranges(slots)))
+            return
+        if blocked:
+            # a half moved slot can't be deployed, move none of it
+            raise SystemExit(f"{len(blocked)} customers blocked, nothing copied")
+
+        step = copy_customer if command == "copy" else delete_customer
+        for (source, target), customers in moves.items():
+            done = skipped = 0
+            for customer_xid in customers:
+                if await step(customer_xid, source, target):
+                    done += 1
+                else:
+                    skipped += 1
+            print(f"{command} {source} -> {target}: {done} customers, {skipped} skipped")
+    finally:
+        await Tortoise.close_connections()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move customers to the shard owning their slot.")
+    parser.add_argument("command", choices=RebalanceConstant.COMMANDS.value)
+    parser.add_argument("--config", default=RebalanceConstant.CONFIG_FILE.value,
+                        help="config with every shard and the new SHARDING.SLOTS")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.config) as config_file:
+        config = ujson.load(config_file)
+    asyncio.run(rebalance(args.command, config))
+
+
+if __name__ == '__main__':
+    main()